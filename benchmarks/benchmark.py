@@ -0,0 +1,538 @@
+#!/usr/bin/env python3
+
+"""benchmark.py
+
+Benchmarks the hot paths of the scripts in bin/ on the test genome under data/
+and synthetic inputs, so it runs offline on a laptop. Each case runs in its own
+process, which records the wall time (best of the repeats), the peak RSS and
+the throughput. The startup_* cases time starting each script (its imports
+and argument parsing) in a fresh interpreter. Every run is appended to a JSON
+history and compared against a stored baseline, a case regresses if its wall
+time or peak RSS exceed the baseline by more than the threshold.
+
+Usage:
+    benchmark.py [--cases=<cases>] [--sizes=<sizes>] [--repeats=<repeats>] [--history=<history>] [--baseline=<baseline>] [--threshold=<threshold>] [--save_baseline] [--workdir=<workdir>]
+    benchmark.py --list
+    benchmark.py --run_case=<case> --size=<size> --repeats=<repeats> --workdir=<workdir>
+    benchmark.py -h | --help
+
+Options:
+    -h --help                   Show this screen.
+    --list                      List the benchmark cases and their sizes.
+    --cases=<cases>             Comma-separated cases to run, defaults to all cases.
+    --sizes=<sizes>             Comma-separated sizes to run [default: small].
+    --repeats=<repeats>         Number of timed repeats per case [default: 3].
+    --history=<history>         JSON history of all runs [default: benchmarks/history.json].
+    --baseline=<baseline>       JSON baseline to compare against [default: benchmarks/baseline.json].
+    --threshold=<threshold>     Allowed slowdown (and RSS growth) over the baseline,
+                                as a fraction [default: 0.2].
+    --save_baseline             Store the results of this run as the baseline.
+    --workdir=<workdir>         Folder for the synthetic inputs, defaults to a
+                                temporary folder.
+    --run_case=<case>           Run a single case in this process (used internally).
+    --size=<size>               Size of the single case.
+
+"""
+
+from docopt import docopt
+import datetime
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+BENCHMARK_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(BENCHMARK_DIR)
+sys.path.insert(0, os.path.join(REPO_DIR, "bin"))
+
+import helper as hp  # noqa: E402
+import simulate_chimeras as sc  # noqa: E402
+
+GENOME = os.path.join(REPO_DIR, "data", "SC35M_WTWT.fasta")
+
+
+def write_genome(workdir, number_of_segments=3):
+    """
+    Write the first segments of the test genome to the workdir, so that the
+    combination arrays stay small enough for a laptop.
+
+    Returns
+    -------
+    str
+        The genome filepath.
+    """
+    genome_file = os.path.join(workdir, f"genome_{number_of_segments}.fasta")
+    if not os.path.exists(genome_file):
+        genome_dict = hp.read_fasta(GENOME)
+        with open(genome_file, "w") as genome:
+            for segment in list(genome_dict)[:number_of_segments]:
+                genome.write(f">{segment}\n{genome_dict[segment]}\n")
+    return genome_file
+
+
+def write_interactions(workdir, genome_dict, number_of_interactions, seed=0):
+    """
+    Write random ground-truth interactions between distinct segments.
+
+    Returns
+    -------
+    pandas.DataFrame
+        The interactions as an annotation table (id,segment01,start01,end01,segment02,start02,end02).
+    """
+    rng = np.random.default_rng(seed)
+    segments = list(genome_dict)
+    segment_lengths = hp.get_segment_lengths(genome_dict)
+    rows = []
+    for i in range(number_of_interactions):
+        segment01, segment02 = rng.choice(segments, 2, replace=False)
+        start01 = int(rng.integers(0, segment_lengths[segment01] - 100))
+        start02 = int(rng.integers(0, segment_lengths[segment02] - 100))
+        rows.append(
+            [i, segment01, start01, start01 + int(rng.integers(20, 100)),
+             segment02, start02, start02 + int(rng.integers(20, 100))]
+        )
+    return pd.DataFrame(
+        rows, columns=["id", "segment01", "start01", "end01", "segment02", "start02", "end02"]
+    )
+
+
+def write_trns(workdir, number_of_reads, annotation_table=None, seed=0):
+    """
+    Simulate a trns file with simulate_chimeras.py on the small test genome.
+
+    Returns
+    -------
+    str
+        The trns filepath.
+    """
+    genome_dict = hp.parse_fasta(write_genome(workdir))
+    trns_file = os.path.join(workdir, f"reads_{number_of_reads}_{seed}.trns.txt")
+    if not os.path.exists(trns_file):
+        interactions = None
+        if annotation_table is not None:
+            interactions_file = os.path.join(workdir, f"interactions_{seed}.csv")
+            annotation_table.drop(columns="id").to_csv(interactions_file, header=False, index=False)
+            interactions = sc.parse_interactions(interactions_file, list(genome_dict))
+        sc.simulate_trns_file(genome_dict, trns_file, number_of_reads, interactions=interactions, seed=seed)
+    return trns_file
+
+
+def random_count_array(shape, mean=2.0, seed=0):
+    """
+    Random interaction counts with a few hotspots.
+    """
+    rng = np.random.default_rng(seed)
+    array = rng.poisson(mean, shape).astype(float)
+    for _ in range(3):
+        row, column = rng.integers(0, shape[0]), rng.integers(0, shape[1])
+        array[max(0, row - 10) : row + 10, max(0, column - 10) : column + 10] += 50
+    return array
+
+
+def setup_trns_parsing(size, workdir):
+    import trns_handler as th
+
+    genome_dict = hp.parse_fasta(write_genome(workdir))
+    trns_file = write_trns(workdir, size, write_interactions(workdir, genome_dict, 20))
+
+    def run():
+        th.segemehlTrans2heatmap(trns_file, hp.make_combination_array(genome_dict))
+
+    return run, size, "reads"
+
+
+def setup_trns_reading(size, workdir):
+    import trns_handler as th
+
+    genome_dict = hp.parse_fasta(write_genome(workdir))
+    trns_file = write_trns(workdir, size, write_interactions(workdir, genome_dict, 20))
+
+    def run():
+        for _ in th.read_trns(trns_file):
+            pass
+
+    return run, size, "reads"
+
+
+def setup_fill_heatmap(size, workdir):
+    import trns_handler as th
+
+    genome_dict = hp.parse_fasta(write_genome(workdir))
+    trns_file = write_trns(workdir, size, write_interactions(workdir, genome_dict, 20))
+    interaction_arrays = hp.make_combination_array(genome_dict)
+    interactions = []
+    with open(trns_file) as trns:
+        for line in trns:
+            first_read, second_read = (read.split(",") for read in line.split()[:2])
+            interactions.append([
+                first_read[0], int(first_read[1]), int(first_read[1]) + int(first_read[4]),
+                second_read[0], int(second_read[1]), int(second_read[1]) + int(second_read[4]),
+            ])
+    interactions = [
+        interaction if (interaction[0], interaction[3]) in interaction_arrays
+        else interaction[3:] + interaction[:3]
+        for interaction in interactions
+        if interaction[0] != interaction[3]
+    ]
+
+    def run():
+        for interaction in interactions:
+            th.fill_heatmap(interaction, interaction_arrays)
+
+    return run, len(interactions), "interactions"
+
+
+def setup_combine_arrays(size, workdir):
+    import array_handler as ah
+
+    samples = {
+        f"sample{i}": {("A", "B"): random_count_array((size, size), seed=i)}
+        for i in range(4)
+    }
+
+    def run():
+        ah.combine_arrays({name: dict(arrays) for name, arrays in samples.items()})
+
+    return run, 4 * size * size, "cells"
+
+
+def setup_convert_to_density_array(size, workdir):
+    import array_handler as ah
+
+    array = random_count_array((size, size))
+
+    def run():
+        ah.convert_to_density_array(array)
+
+    return run, int(array.sum()), "points"
+
+
+def setup_fit_optimal_gmm(size, workdir):
+    import annotate_interactions as ai
+
+    rng = np.random.default_rng(0)
+    centers = rng.uniform(0, 1000, (4, 2))
+    density_array = np.concatenate(
+        [rng.normal(center, 20, (size // 4, 2)) for center in centers]
+    )
+
+    def run():
+        ai.fit_optimal_gmm(density_array, 1, 4)
+
+    return run, len(density_array), "points"
+
+
+def setup_make_count_table(size, workdir):
+    import make_counttable as mc
+
+    genome_dict = hp.parse_fasta(write_genome(workdir))
+    annotation_table = write_interactions(workdir, genome_dict, 50)
+    trns_file = write_trns(workdir, size, annotation_table)
+
+    def run():
+        mc.make_count_table(annotation_table, [trns_file])
+
+    return run, size, "reads"
+
+
+def setup_deduplicate_annotations(size, workdir):
+    import deduplicate_annotations as da
+
+    genome_dict = hp.parse_fasta(write_genome(workdir))
+    annotation_table = write_interactions(workdir, genome_dict, size, seed=1)
+    annotation_file = os.path.join(workdir, f"annotations_{size}.tsv")
+    annotation_table.to_csv(annotation_file, sep="\t", index=False)
+    rng = np.random.default_rng(0)
+    count_file = os.path.join(workdir, f"counts_{size}.tsv")
+    pd.DataFrame(
+        rng.poisson(20, (size, 3)), columns=["sample1", "sample2", "sample3"]
+    ).to_csv(count_file, sep="\t")
+    output_folder = os.path.join(workdir, f"deduplicated_{size}")
+    os.makedirs(output_folder, exist_ok=True)
+    argv = ["deduplicate_annotations.py", "-a", annotation_file, "-c", count_file, "-o", output_folder]
+
+    def run():
+        sys.argv = argv
+        da.main()
+
+    return run, size, "annotations"
+
+
+def setup_plot_heatmap(size, workdir):
+    import plot_heatmaps as ph
+
+    array = np.log10(random_count_array((size, size)) + 1)
+    plots_folder = os.path.join(workdir, f"plots_{size}")
+    os.makedirs(plots_folder, exist_ok=True)
+
+    def run():
+        ph.plot_heatmap(array, plots_folder, "PiYG", ("A", "B"))
+
+    return run, size * size, "cells"
+
+
+def get_scripts():
+    """
+    The command line scripts in bin/.
+    """
+    bin_dir = os.path.join(REPO_DIR, "bin")
+    scripts = []
+    for script in sorted(os.listdir(bin_dir)):
+        if script.endswith(".py"):
+            with open(os.path.join(bin_dir, script)) as file:
+                if "__main__" in file.read():
+                    scripts.append(script)
+    return scripts
+
+
+# Runs a script and reports its own peak RSS in KiB on exit. The peak RSS of
+# a child process cannot be taken from RUSAGE_CHILDREN, on Linux it includes
+# the RSS of the parent it was forked from, whereas VmHWM is reset by exec.
+STARTUP_WRAPPER = """
+import atexit, os, resource, runpy, sys
+
+def report_peak_rss():
+    try:
+        with open("/proc/self/status") as status:
+            peak_rss = next(line.split()[1] for line in status if line.startswith("VmHWM:"))
+    except (OSError, StopIteration):
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        if sys.platform == "darwin":
+            peak_rss //= 1024
+    sys.stderr.write(f"\\npeak_rss_kib={peak_rss}\\n")
+
+atexit.register(report_peak_rss)
+sys.argv = sys.argv[1:]
+sys.path.insert(0, os.path.dirname(sys.argv[0]))
+runpy.run_path(sys.argv[0], run_name="__main__")
+"""
+
+
+def make_setup_startup(script):
+    """
+    Make the setup of a startup case, which times starting the script with
+    --help in a fresh interpreter, i.e. its imports and argument parsing. The
+    peak RSS of the case is that of the script.
+    """
+
+    def setup_startup(size, workdir):
+        command = [sys.executable, "-c", STARTUP_WRAPPER, os.path.join(REPO_DIR, "bin", script), "--help"]
+
+        def run():
+            peak_rss_kib = 0
+            for _ in range(size):
+                result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True, check=True)
+                peak_rss_kib = max(peak_rss_kib, int(result.stderr.rsplit("peak_rss_kib=", 1)[1]))
+            return peak_rss_kib / 1024
+
+        return run, size, "starts"
+
+    return setup_startup
+
+
+CASES = {
+    "trns_parsing": (setup_trns_parsing, {"small": 20000, "medium": 200000, "large": 1000000}),
+    "trns_reading": (setup_trns_reading, {"small": 20000, "medium": 200000, "large": 1000000}),
+    "fill_heatmap": (setup_fill_heatmap, {"small": 20000, "medium": 200000, "large": 1000000}),
+    "combine_arrays": (setup_combine_arrays, {"small": 500, "medium": 1500, "large": 3000}),
+    "convert_to_density_array": (setup_convert_to_density_array, {"small": 50, "medium": 150, "large": 400}),
+    "fit_optimal_gmm": (setup_fit_optimal_gmm, {"small": 2000, "medium": 20000, "large": 100000}),
+    "make_count_table": (setup_make_count_table, {"small": 2000, "medium": 20000, "large": 100000}),
+    "deduplicate_annotations": (setup_deduplicate_annotations, {"small": 200, "medium": 1000, "large": 4000}),
+    "plot_heatmap": (setup_plot_heatmap, {"small": 200, "medium": 1000, "large": 2342}),
+}
+CASES.update(
+    {
+        f"startup_{os.path.splitext(script)[0]}": (make_setup_startup(script), {"small": 1, "medium": 5, "large": 20})
+        for script in get_scripts()
+    }
+)
+
+
+def get_peak_rss_mb():
+    """
+    Peak resident set size of this process in MiB.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    if sys.platform == "darwin":
+        return peak_rss / 1024**2
+    return peak_rss / 1024
+
+
+def run_case(case, size, repeats, workdir):
+    """
+    Run a single case in this process.
+
+    Returns
+    -------
+    dict
+        The wall times, the best wall time, the peak RSS and the throughput.
+    """
+    setup, sizes = CASES[case]
+    run, items, unit = setup(sizes[size], workdir)
+    wall_times = []
+    # Cases running child processes return the peak RSS of the children
+    peak_rss_mb = None
+    for _ in range(repeats):
+        start = time.perf_counter()
+        run_peak_rss_mb = run()
+        wall_times.append(time.perf_counter() - start)
+        if run_peak_rss_mb is not None:
+            peak_rss_mb = max(peak_rss_mb or 0, run_peak_rss_mb)
+    wall_time = min(wall_times)
+    return {
+        "parameter": sizes[size],
+        "wall_time": wall_time,
+        "wall_times": wall_times,
+        "peak_rss_mb": get_peak_rss_mb() if peak_rss_mb is None else peak_rss_mb,
+        "items": items,
+        "unit": unit,
+        "throughput": items / wall_time if wall_time else None,
+    }
+
+
+def run_case_in_subprocess(case, size, repeats, workdir):
+    """
+    Run a single case in a fresh process, so that its peak RSS is its own.
+
+    Returns
+    -------
+    dict
+        The result of run_case, or the error of the case.
+    """
+    command = [
+        sys.executable, os.path.abspath(__file__),
+        f"--run_case={case}", f"--size={size}", f"--repeats={repeats}", f"--workdir={workdir}",
+    ]
+    result = subprocess.run(command, capture_output=True, text=True)
+    if result.returncode != 0:
+        return {"error": result.stderr.strip().splitlines()[-1] if result.stderr.strip() else "failed"}
+    return json.loads(result.stdout.strip().splitlines()[-1])
+
+
+def get_git_commit():
+    """
+    The commit of the repository, if it is a git repository.
+    """
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def load_json(filepath, default):
+    if os.path.exists(filepath):
+        with open(filepath) as file:
+            return json.load(file)
+    return default
+
+
+def compare_to_baseline(results, baseline, threshold):
+    """
+    Compare the results with the baseline.
+
+    Returns
+    -------
+    list
+        The regressions as (case, size, metric, baseline, result) tuples.
+    """
+    regressions = []
+    for case, sizes in results.items():
+        for size, result in sizes.items():
+            reference = baseline.get(case, {}).get(size)
+            if not reference or "error" in result or "error" in reference:
+                continue
+            for metric in ("wall_time", "peak_rss_mb"):
+                if result[metric] > reference[metric] * (1 + threshold):
+                    regressions.append((case, size, metric, reference[metric], result[metric]))
+    return regressions
+
+
+def main():
+    args = docopt(__doc__)
+
+    if args["--list"]:
+        for case, (_, sizes) in CASES.items():
+            print(f"{case}\t" + "\t".join(f"{size}={parameter}" for size, parameter in sizes.items()))
+        return
+
+    if args["--run_case"]:
+        # Suppress the output of the benchmarked functions, the result is the last line
+        with open(os.devnull, "w") as devnull:
+            stdout = sys.stdout
+            sys.stdout = devnull
+            try:
+                result = run_case(args["--run_case"], args["--size"], int(args["--repeats"]), args["--workdir"])
+            finally:
+                sys.stdout = stdout
+        print(json.dumps(result))
+        return
+
+    cases = args["--cases"].split(",") if args["--cases"] else list(CASES)
+    sizes = args["--sizes"].split(",")
+    repeats = int(args["--repeats"])
+    threshold = float(args["--threshold"])
+    for case in cases:
+        if case not in CASES:
+            sys.exit(f"ERROR: unknown case {case}, see --list")
+
+    workdir = args["--workdir"] or tempfile.mkdtemp(prefix="rnaswarm_benchmark_")
+    os.makedirs(workdir, exist_ok=True)
+
+    results = {}
+    for case in cases:
+        results[case] = {}
+        for size in sizes:
+            result = run_case_in_subprocess(case, size, repeats, workdir)
+            results[case][size] = result
+            if "error" in result:
+                print(f"{case}\t{size}\tERROR: {result['error']}")
+            else:
+                print(
+                    f"{case}\t{size}\t{result['wall_time']:.3f} s\t{result['peak_rss_mb']:.0f} MiB"
+                    f"\t{result['throughput']:.0f} {result['unit']}/s"
+                )
+
+    # Append the run to the history
+    history = load_json(args["--history"], [])
+    history.append(
+        {
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "commit": get_git_commit(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "repeats": repeats,
+            "results": results,
+        }
+    )
+    with open(args["--history"], "w") as history_file:
+        json.dump(history, history_file, indent=2)
+
+    # Compare against the baseline
+    baseline = load_json(args["--baseline"], {})
+    regressions = compare_to_baseline(results, baseline, threshold)
+    for case, size, metric, reference, result in regressions:
+        print(f"REGRESSION {case} {size} {metric}: {reference:.3f} -> {result:.3f}")
+
+    if args["--save_baseline"]:
+        for case, case_results in results.items():
+            baseline.setdefault(case, {}).update(case_results)
+        with open(args["--baseline"], "w") as baseline_file:
+            json.dump(baseline, baseline_file, indent=2)
+
+    if regressions:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+"""aggregate_metrics.py
+
+Aggregates the metrics JSON files written by the scripts (see
+metrics_handler.py) into one table, with a row per script run and stage, so
+that the stages can be compared across samples and runs.
+
+Usage:
+    aggregate_metrics.py <metrics_file>... -o <output_file>
+    aggregate_metrics.py -h | --help
+
+Options:
+    -h --help                   Show this screen.
+    <metrics_file>              Metrics files or folders to search for *.metrics.json files.
+    -o --output=<output_file>   The output table (tsv).
+
+"""
+
+from docopt import docopt
+import json
+import metrics_handler as mh
+import os
+import pandas as pd
+
+
+def find_metrics_files(paths):
+    """
+    Find the metrics files in a list of files and folders
+
+    Parameters
+    ----------
+    paths : list
+        Metrics files or folders to search recursively.
+
+    Returns
+    -------
+    list
+        The metrics filepaths.
+    """
+    metrics_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for root, _, files in os.walk(path):
+                metrics_files.extend(
+                    os.path.join(root, file) for file in sorted(files) if file.endswith(".metrics.json")
+                )
+        else:
+            metrics_files.append(path)
+    return metrics_files
+
+
+def get_stage_rows(metrics, metrics_file):
+    """
+    Flatten the metrics of a script run to one row per stage, with a total
+    row for the whole run
+
+    Parameters
+    ----------
+    metrics : dict
+        The metrics, see metrics_handler.get_metrics.
+    metrics_file : str
+        The metrics filepath.
+
+    Returns
+    -------
+    list
+        The rows, one dict per stage.
+    """
+    run = {
+        "metrics_file": metrics_file,
+        "script": metrics["script"],
+        "host": metrics["host"],
+    }
+    rows = []
+    for stage in metrics["stages"] + [dict(metrics, name="total", counts={}, throughput={})]:
+        row = dict(
+            run,
+            stage=stage["name"],
+            wall_time=stage["wall_time"],
+            cpu_time=stage["cpu_time"],
+            peak_rss_mb=stage["peak_rss_mb"],
+            peak_children_rss_mb=stage["peak_children_rss_mb"],
+        )
+        row.update(stage["counts"])
+        row.update({f"{item}_per_second": number for item, number in stage["throughput"].items()})
+        rows.append(row)
+    return rows
+
+
+def aggregate_metrics(metrics_files):
+    """
+    Aggregate metrics files into a table
+
+    Parameters
+    ----------
+    metrics_files : list
+        The metrics filepaths.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per script run and stage.
+    """
+    rows = []
+    for metrics_file in metrics_files:
+        with open(metrics_file) as file:
+            rows.extend(get_stage_rows(json.load(file), metrics_file))
+    return pd.DataFrame(rows)
+
+
+def main():
+    args = docopt(__doc__)
+    metrics_table = aggregate_metrics(find_metrics_files(args["<metrics_file>"]))
+    metrics_table.to_csv(args["--output"], sep="\t", index=False)
+
+
+if __name__ == "__main__":
+    mh.run_main(main)
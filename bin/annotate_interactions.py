@@ -26,16 +26,13 @@ Options:
 """
 import helper as hp
 import trns_handler as th
+import metrics_handler as mh
 import array_handler as ah
+import cache_handler as ch
 from docopt import docopt
 import math
-import matplotlib.pyplot as plt
 import numpy as np
-import scipy.stats as stats
 import pandas as pd
-import sklearn.mixture as mix
-from matplotlib.patches import Ellipse
-from matplotlib.patches import Rectangle
 import os
 import pickle
 
@@ -57,6 +54,8 @@ def plot_bic_scores(gmm_dict, density_array, output_folder=None):
     -------
     None
     """
+    import matplotlib.pyplot as plt
+
     bic_scores = []
     components = []
     for n_components, gmm in gmm_dict.items():
@@ -93,6 +92,9 @@ def draw_ellipse(position, covariance, ax=None):
     matplotlib.patches.Ellipse
         The ellipse drawn.
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Ellipse
+
     ax = ax or plt.gca()
     # Convert covariance to principal axes
     if covariance.shape == (2, 2):
@@ -160,6 +162,8 @@ def plot_gmm(
     -------
     None
     """
+    import matplotlib.pyplot as plt
+
     plt.imshow(np.log10(interaction_matrix + 1), cmap="PiYG")
     plt.colorbar(label="log10(counts + 1)")
     plt.xlabel(f"{combination[1]}")
@@ -197,6 +201,8 @@ def fit_optimal_gmm(
     """
     Using BIC score, fit a Gaussian Mixture Model to the array, and decide the optimal number of components.
     """
+    import sklearn.mixture as mix
+
     if min_components > max_components or min_components < 1:
         raise ValueError("min_components must be less than or equal to max_components and both greater than 0")
 
@@ -249,6 +255,8 @@ def calculate_individual_pdfs(gmm, density_array, weights=None):
     pdfs : array-like
         The probability density function for each component of the Gaussian Mixture Model.
     """
+    import scipy.stats as stats
+
     pdfs = {}
     means, covariances = gmm.means_.copy(), gmm.covariances_.copy()
     if weights is None:
@@ -354,6 +362,8 @@ def calculate_individual_log_likelihoods(
     """
     log_likelihoods = {}
     if refit_gmm:
+        import sklearn.mixture as mix
+
         refitted_gmms = {}
         gmm_loglikelihood = np.sum(gmm.score_samples(density_array))
         print(f"{gmm.n_components}")
@@ -497,6 +507,9 @@ def plot_regions(
     -------
     None
     """
+    import matplotlib.pyplot as plt
+    from matplotlib.patches import Rectangle
+
     ax = plt.gca()
     plt.imshow(interaction_matrix)
     plt.colorbar()
@@ -521,6 +534,22 @@ def plot_regions(
         plt.show()
 
 
+def save_gmm(gmm, folder):
+    """
+    Save a fitted Gaussian Mixture Model to a cache folder.
+    """
+    with open(os.path.join(folder, "gmm.pickle"), "wb") as handle:
+        pickle.dump(gmm, handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def load_gmm(folder):
+    """
+    Load a Gaussian Mixture Model saved by save_gmm.
+    """
+    with open(os.path.join(folder, "gmm.pickle"), "rb") as handle:
+        return pickle.load(handle)
+
+
 def main():
     # Parse the command line arguments
     # interaction_finder.py -g <genome> -i <input_file> -o <output_folder> [-m <min_components> -M <max_components> --make_plots --ignore_intra]
@@ -542,41 +571,66 @@ def main():
     array_folder_name = array_folder_name.split(".")[0]
 
     # Import  arrays
-    combination_arrays = hp.make_combination_array(genome_dict)
-    ah.import_combination_arrays(combination_arrays, array_folder)
-
-    density_arrays = {
-        combination: ah.convert_to_density_array(combination_array)
-        for combination, combination_array in combination_arrays.items()
-    }
+    with mh.stage("load") as load_stage:
+        combination_arrays = hp.make_combination_array(genome_dict)
+        ah.import_combination_arrays(combination_arrays, array_folder)
+        load_stage.count("arrays", len(combination_arrays))
+
+    with mh.stage("density") as density_stage:
+        density_arrays = {
+            combination: ah.convert_to_density_array(combination_array)
+            for combination, combination_array in combination_arrays.items()
+        }
+        density_stage.count("points", sum(len(density_array) for density_array in density_arrays.values()))
 
     # Use BIC score to fit optimal GMMs to the density arrays
     gmms_dict = {}
-    for combination, density_array in density_arrays.items():
-        print(f"Fitting GMMs for {combination}")
-        gmms_dict[combination] = fit_optimal_gmm(
-            density_array,
-            min_components,
-            max_components,
-            max_iter=500,
-            expected_delta=0.000001,
-            get_all_gmms=False,
-            step_size=step_size,
-        )
+    with mh.stage("fit") as fit_stage:
+        for combination, density_array in density_arrays.items():
+            print(f"Fitting GMMs for {combination}")
+            # GMMs fitted to the same array are reused from the cache, e.g. when only --sigma changed
+            gmms_dict[combination] = ch.cached(
+                "fitted_gmms",
+                [os.path.join(array_folder, f"{combination[0]}-{combination[1]}.npy")],
+                {
+                    "min_components": min_components,
+                    "max_components": max_components,
+                    "step_size": step_size,
+                    "max_iter": 500,
+                    "expected_delta": 0.000001,
+                },
+                compute=lambda: fit_optimal_gmm(
+                    density_array,
+                    min_components,
+                    max_components,
+                    max_iter=500,
+                    expected_delta=0.000001,
+                    get_all_gmms=False,
+                    step_size=step_size,
+                ),
+                save=save_gmm,
+                load=load_gmm,
+                stage=fit_stage,
+            )
+            fit_stage.count("combinations")
+            fit_stage.count("components", gmms_dict[combination].n_components)
 
 
     # Save the gmms dict to a pickle file
-    gmms_pickle = f"{output_folder}/{output_folder}_gmms.pickle"
-    with open(gmms_pickle, "wb") as handle:
-        pickle.dump(gmms_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
+    with mh.stage("save"):
+        gmms_pickle = f"{output_folder}/{output_folder}_gmms.pickle"
+        with open(gmms_pickle, "wb") as handle:
+            pickle.dump(gmms_dict, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
-    # Export regions as a table
-    for combination, gmm in gmms_dict.items():
-        # Parse the regions
-        parse_rectangular_regions(
-            gmms_dict[combination], combination, sigma, f"{output_folder}/{output_folder}.csv"
-        )
+        # Export regions as a table
+        for combination, gmm in gmms_dict.items():
+            # Parse the regions
+            parse_rectangular_regions(
+                gmms_dict[combination], combination, sigma, f"{output_folder}/{output_folder}.csv"
+            )
+
+    mh.write_metrics(output_folder)
 
 
     refit_gmms=False
@@ -595,6 +649,8 @@ def main():
                 ) = calculate_individual_log_likelihoods(gmm, density_array, refit_gmm=True)
 
         # Create bar plots of the individual_log_likelihoods_refitted
+        import matplotlib.pyplot as plt
+
         for (
             combination,
             individual_log_likelihoods,
@@ -630,4 +686,4 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
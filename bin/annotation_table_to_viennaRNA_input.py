@@ -3,57 +3,109 @@
 import argparse
 import deduplicate_annotations as da
 import helper as hp
+import metrics_handler as mh
+import numpy as np
 import pandas as pd
 from pathlib import Path
 
 
-def annotation_to_sequence(annotation, genome_dict, extension=0):
-    """Extracts the sequences of the annotation from the genome file.
+def get_extension_coordinates(starts, ends, lengths, extensions):
+    """Computes the extended coordinates of all annotations for all extensions.
+
+    An end of the annotation is only extended if the extension stays within
+    the segment, i.e. the extended start is above 0 and the extended end below
+    the length of the segment.
+
+    Args:
+        starts (numpy.ndarray): The start coordinates of the annotations.
+        ends (numpy.ndarray): The end coordinates of the annotations.
+        lengths (numpy.ndarray): The lengths of the annotated segments.
+        extensions (numpy.ndarray): The extensions to add to the annotations.
+
+    Returns:
+        tuple: The extended starts and ends, arrays of shape
+            (len(extensions), len(starts)).
+    """
+    starts = np.asarray(starts, dtype=np.int64)[np.newaxis, :]
+    ends = np.asarray(ends, dtype=np.int64)[np.newaxis, :]
+    lengths = np.asarray(lengths, dtype=np.int64)[np.newaxis, :]
+    extensions = np.asarray(extensions, dtype=np.int64)[:, np.newaxis]
+    extended_starts = np.where(starts - extensions <= 0, starts, starts - extensions)
+    extended_ends = np.where(ends + extensions >= lengths, ends, ends + extensions)
+    return extended_starts, extended_ends
+
+
+def slice_sequences(segments, starts, ends, genome_dict):
+    """Slices the sequences of the given coordinates from the genome.
+
+    Args:
+        segments (numpy.ndarray): The segment of each sequence.
+        starts (numpy.ndarray): The start coordinates.
+        ends (numpy.ndarray): The end coordinates.
+        genome_dict (dict): A dictionary containing the genome.
+
+    Returns:
+        list: The sequences.
+    """
+    return [
+        genome_dict[segment][start:end]
+        for segment, start, end in zip(segments, starts.tolist(), ends.tolist())
+    ]
+
+
+def iterate_extended_seqs(annotation_table_df, genome_dict, extensions):
+    """Yields the sequences of the annotations for each extension.
+
+    The extended coordinates of all annotations are computed at once, for
+    all extensions.
 
     Args:
-        annotation (pandas.Series): The annotation.
-        genomes_dict (dict): A dictionary containing the genome.
-        extension (int): The extension to add to the start and end of the annotation.
+        annotation_table_df (pandas.DataFrame): The annotation table.
+        genome_dict (dict): A dictionary containing the genome.
+        extensions (list): The extensions to add to the annotations.
+
+    Yields:
+        tuple: The extension and a dictionary with the sequences of each
+            annotation.
+    """
+    segment_lengths = pd.Series(hp.get_segment_lengths(genome_dict))
+    index = annotation_table_df.index
+    segments01 = annotation_table_df["segment01"].to_numpy()
+    segments02 = annotation_table_df["segment02"].to_numpy()
+    starts01, ends01 = get_extension_coordinates(
+        annotation_table_df["start01"],
+        annotation_table_df["end01"],
+        segment_lengths.loc[segments01],
+        extensions,
+    )
+    starts02, ends02 = get_extension_coordinates(
+        annotation_table_df["start02"],
+        annotation_table_df["end02"],
+        segment_lengths.loc[segments02],
+        extensions,
+    )
+    for i, extension in enumerate(extensions):
+        sequences01 = slice_sequences(segments01, starts01[i], ends01[i], genome_dict)
+        sequences02 = slice_sequences(segments02, starts02[i], ends02[i], genome_dict)
+        yield extension, {
+            index: [sequence01, sequence02]
+            for index, sequence01, sequence02 in zip(index, sequences01, sequences02)
+        }
+
+
+def get_extensions(extension_window=[5, 50], extension_step=5):
+    """Lists the extensions of the extension window (inclusive).
+
+    Args:
+        extension_window (list): The first and last extension.
+        extension_step (int): The step between extensions.
+
     Returns:
-        sequences (list): The sequences of the annotation.
+        list: The extensions.
     """
-    # add checks to make sure things are within range
-    sequences = []
-    extension_start01 = extension
-    extension_start02 = extension
-    extension_end01 = extension
-    extension_end02 = extension
-    if annotation["start01"] - extension <= 0:
-        extension_start01 = 0
-    if annotation["start02"] - extension <= 0:
-        extension_start02 = 0
-    if annotation["end01"] + extension >= len(genome_dict[annotation["segment01"]]):
-        extension_end01 = 0
-    if annotation["end02"] + extension >= len(genome_dict[annotation["segment02"]]):
-        extension_end02 = 0
-    if extension:
-        sequences = [
-            genome_dict[annotation["segment01"]][
-                annotation["start01"]
-                - extension_start01 : annotation["end01"]
-                + extension_end01
-            ],
-            genome_dict[annotation["segment02"]][
-                annotation["start02"]
-                - extension_start02 : annotation["end02"]
-                + extension_end02
-            ],
-        ]
-    else:
-        sequences = [
-            genome_dict[annotation["segment01"]][
-                annotation["start01"] : annotation["end01"]
-            ],
-            genome_dict[annotation["segment02"]][
-                annotation["start02"] : annotation["end02"]
-            ],
-        ]
-    return sequences
+    return list(
+        range(extension_window[0], extension_window[1] + extension_step, extension_step)
+    )
 
 
 def create_extended_seqs(
@@ -62,25 +114,16 @@ def create_extended_seqs(
     """Creates exteded sequences for structure prediction.
 
     Args:
-        annotation_table_df ()
-        genome_dict ()
-        extension_window ()
-        extension_step ()
+        annotation_table_df (pandas.DataFrame): The annotation table.
+        genome_dict (dict): A dictionary containing the genome.
+        extension_window (list): Interval to extend the annotation (inclusive).
+        extension_step (int): Step to extend the annotation.
 
     Returns:
-        dict ()
+        dict: The sequences of each annotation, for each extension.
     """
-    sequences_extended = {}
-    # iterate over each line of the annotation_table_df
-    for i in range(
-        extension_window[0], extension_window[1] + extension_step, extension_step
-    ):
-        sequences_extended[i] = {}
-        for index, row in annotation_table_df.iterrows():
-            # extract the sequences of the annotation from the genome file
-            interaction = annotation_to_sequence(row, genome_dict, extension=i)
-            sequences_extended[i][index] = interaction
-    return sequences_extended
+    extensions = get_extensions(extension_window, extension_step)
+    return dict(iterate_extended_seqs(annotation_table_df, genome_dict, extensions))
 
 
 def write_viennaRNA_input(sequences, output_file):
@@ -90,11 +133,11 @@ def write_viennaRNA_input(sequences, output_file):
         sequences (dict): The sequences to write.
         output_file (str): The output file.
     """
-    with open(output_file, "w") as file:
-        for index, sequence in sequences.items():
-            file.write(f">{index}\n")
-            file.write(f"{sequence[0]}\n")
-            file.write(f"{sequence[1]}\n")
+    with open(output_file, "w", buffering=1024 * 1024) as file:
+        file.writelines(
+            f">{index}\n{sequence[0]}\n{sequence[1]}\n"
+            for index, sequence in sequences.items()
+        )
 
 
 def main():
@@ -104,11 +147,13 @@ def main():
     parser.add_argument(
         "-e",
         "--extension_window",
+        nargs=2,
+        type=int,
         default=[5, 50],
         help="Interval to extend the annotation (inclusive).",
     )
     parser.add_argument(
-        "-s", "--extension_step", default=5, help="Step to extend the annotation"
+        "-s", "--extension_step", type=int, default=5, help="Step to extend the annotation"
     )
     parser.add_argument("-o", "--output_folder", help="The output folder.")
     args = parser.parse_args()
@@ -116,29 +161,30 @@ def main():
     annotation_table_df = da.parse_annotation_table(args.annotation_table)
     genome_dict = hp.parse_fasta(args.genome_file)
 
-    sequences = {}
-    # iterate over each line of the annotation_table_df
-    for index, row in annotation_table_df.iterrows():
-        # extract the sequences of the annotation from the genome file
-        interaction = annotation_to_sequence(row, genome_dict)
-        sequences[index] = interaction
-
-    sequences_extended = create_extended_seqs(
-        annotation_table_df, genome_dict, extension_window=[5, 50], extension_step=5
-    )
+    # the unextended sequences are sliced as they are annotated
+    sequences = create_extended_seqs(
+        annotation_table_df, genome_dict, extension_window=[0, 0], extension_step=1
+    )[0]
 
     # write the sequences to a fasta file
     output_file = Path(args.output_folder) / Path(
         f"{Path(args.genome_file).stem}_annotations.fasta"
     )
-
     write_viennaRNA_input(sequences, output_file)
-    for extension, sequences_extended in sequences_extended.items():
-        output_file_extended = Path(args.output_folder) / Path(
-            f"{Path(args.genome_file).stem}_annotations_extended_{extension}.fasta"
-        )
-        write_viennaRNA_input(sequences_extended, output_file_extended)
 
+    # write each extension as soon as its sequences are sliced
+    extensions = get_extensions(args.extension_window, args.extension_step)
+    with mh.stage("extend") as extend_stage:
+        for extension, sequences_extended in iterate_extended_seqs(
+            annotation_table_df, genome_dict, extensions
+        ):
+            output_file_extended = Path(args.output_folder) / Path(
+                f"{Path(args.genome_file).stem}_annotations_extended_{extension}.fasta"
+            )
+            write_viennaRNA_input(sequences_extended, output_file_extended)
+            extend_stage.count("sequence_pairs", len(sequences_extended))
+
+    mh.write_metrics(args.output_folder)
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
@@ -1,5 +1,104 @@
+from array import array as typed_array
 import numpy as np
 import os
+import shutil
+
+
+class SparseArray:
+    """
+    A count array filled with rectangles, kept as the four corner updates of
+    its 2D difference array per rectangle. Its memory grows with the number of
+    rectangles instead of the number of cells, it is materialized block by
+    block with toarray, e.g. into a memory-mapped .npy file.
+
+    Parameters
+    ----------
+    shape : tuple
+        The shape of the array.
+    dtype : numpy.dtype, optional
+        The dtype of the materialized array. The default is float64, as the
+        arrays of helper.make_combination_array.
+    """
+
+    # Bytes per filled rectangle: four corners of a row, a column and a value
+    BYTES_PER_RECTANGLE = 4 * 3 * 8
+
+    def __init__(self, shape, dtype=np.float64):
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+        self._rows = typed_array("q")
+        self._columns = typed_array("q")
+        self._values = typed_array("q")
+
+    @property
+    def nbytes(self):
+        return len(self._values) * 3 * 8
+
+    def add_rectangle(self, row_start, row_end, column_start, column_end, value=1):
+        """
+        Add value to the rectangle, the ends are clipped as numpy slices are.
+        """
+        row_start, row_end = slice(row_start, row_end).indices(self.shape[0])[:2]
+        column_start, column_end = slice(column_start, column_end).indices(self.shape[1])[:2]
+        if row_end <= row_start or column_end <= column_start:
+            return
+        for row, column, corner_value in (
+            (row_start, column_start, value),
+            (row_start, column_end, -value),
+            (row_end, column_start, -value),
+            (row_end, column_end, value),
+        ):
+            # Corners past the last row or column do not change the array
+            if row < self.shape[0] and column < self.shape[1]:
+                self._rows.append(row)
+                self._columns.append(column)
+                self._values.append(corner_value)
+
+    def toarray(self, out=None, block_rows=256):
+        """
+        Materialize the array, block_rows rows at a time.
+
+        Parameters
+        ----------
+        out : array-like, optional
+            The array to write to, e.g. a numpy.memmap. The default is a new array.
+        block_rows : int, optional
+            Number of rows materialized at once.
+
+        Returns
+        -------
+        array-like
+            The dense array.
+        """
+        if out is None:
+            out = np.empty(self.shape, dtype=self.dtype)
+        rows = np.frombuffer(self._rows, dtype=np.int64)
+        columns = np.frombuffer(self._columns, dtype=np.int64)
+        values = np.frombuffer(self._values, dtype=np.int64)
+        order = np.argsort(rows, kind="stable")
+        rows, columns, values = rows[order], columns[order], values[order]
+        carry = np.zeros(self.shape[1], dtype=np.int64)
+        for block_start in range(0, self.shape[0], block_rows):
+            block_end = min(block_start + block_rows, self.shape[0])
+            first, last = np.searchsorted(rows, [block_start, block_end])
+            block = np.zeros((block_end - block_start, self.shape[1]), dtype=np.int64)
+            np.add.at(block, (rows[first:last] - block_start, columns[first:last]), values[first:last])
+            np.cumsum(block, axis=1, out=block)
+            np.cumsum(block, axis=0, out=block)
+            block += carry
+            carry = block[-1].copy()
+            out[block_start:block_end] = block
+        return out
+
+
+def fill_rectangle(array, row_start, row_end, column_start, column_end, value=1):
+    """
+    Add value to a rectangle of a dense, memory-mapped or sparse array.
+    """
+    if isinstance(array, SparseArray):
+        array.add_rectangle(row_start, row_end, column_start, column_end, value)
+    else:
+        array[row_start:row_end, column_start:column_end] += value
 
 
 def normalize_array(array, max_value=200000, mode="number_of_data_points", round=True):
@@ -107,7 +206,53 @@ def convert_to_density_array(interaction_matrix):
     return np.array(density_list)
 
 
-def save_combination_arrays(combination_arrays, output_folder):
+def downsample_array(array, max_size, mode="max", block_bytes=64 * 1024**2):
+    """
+    Pool an array so that neither side has more than max_size cells. Blocks of
+    factor x factor cells are reduced to their maximum or sum; the last row
+    and column of blocks may be smaller. The array is read in bands of rows of
+    about block_bytes, so memory-mapped arrays are never fully loaded.
+
+    Parameters
+    ----------
+    array : array-like
+        The array to downsample.
+
+    max_size : int
+        The maximum number of cells per side of the downsampled array.
+
+    mode : str, optional
+        The pooling mode, "max" or "sum". The default is "max".
+
+    block_bytes : int, optional
+        The approximate number of bytes read at once. The default is 64 MiB.
+
+    Returns
+    -------
+    tuple
+        The downsampled array and the number of original cells per downsampled
+        cell along each side.
+    """
+    if mode == "max":
+        reduce = np.maximum.reduceat
+    elif mode == "sum":
+        reduce = np.add.reduceat
+    else:
+        raise ValueError("Invalid mode")
+    factor = int(np.ceil(max(array.shape) / max_size))
+    if factor <= 1:
+        return array, 1
+    column_starts = np.arange(0, array.shape[1], factor)
+    rows_per_band = max(1, block_bytes // (array.shape[1] * array.itemsize * factor)) * factor
+    bands = []
+    for band_start in range(0, array.shape[0], rows_per_band):
+        band = np.asarray(array[band_start : band_start + rows_per_band])
+        band = reduce(band, np.arange(0, band.shape[0], factor), axis=0)
+        bands.append(reduce(band, column_starts, axis=1))
+    return np.concatenate(bands, axis=0), factor
+
+
+def save_combination_arrays(combination_arrays, output_folder, temporary_folder=None):
     """
     Save the combination arrays as a numpy array.
 
@@ -118,13 +263,76 @@ def save_combination_arrays(combination_arrays, output_folder):
 
     output_folder : str
         The output folder to save the arrays to.
+
+    temporary_folder : str, optional
+        A folder of temporary memory-mapped .npy files, arrays mapped from it
+        are moved into the output folder instead of copied. The arrays can not
+        be saved again afterwards.
     """
     for combination, array in combination_arrays.items():
         output_file = os.path.join(output_folder, f"{combination[0]}-{combination[1]}.npy")
-        np.save(output_file, array)
+        if isinstance(array, SparseArray):
+            # Materialize sparse arrays straight into the output file
+            dense_array = np.lib.format.open_memmap(output_file, mode="w+", dtype=array.dtype, shape=array.shape)
+            array.toarray(out=dense_array)
+            dense_array.flush()
+            del dense_array
+        elif isinstance(array, np.memmap) and array.filename is not None:
+            # Memory-mapped arrays are .npy files already, see
+            # numpy.lib.format.open_memmap, they are not read into memory
+            array.flush()
+            if temporary_folder is not None and os.path.dirname(array.filename) == os.path.abspath(temporary_folder):
+                shutil.move(array.filename, output_file)
+            else:
+                shutil.copyfile(array.filename, output_file)
+        else:
+            np.save(output_file, array)
 
 
-def import_combination_arrays(combination_arrays, input_folder, inter_only=True):
+def save_profiles(profiles, output_folder):
+    """
+    Save the marginal profiles of the combination arrays next to the arrays.
+
+    Parameters
+    ----------
+    profiles : dict
+        A dictionary of (row profile, column profile) tuples, with the keys
+        being the combination of segments.
+
+    output_folder : str
+        The output folder to save the profiles to.
+    """
+    for combination, (row_profile, column_profile) in profiles.items():
+        output_file = os.path.join(output_folder, f"{combination[0]}-{combination[1]}.profiles.npz")
+        np.savez(output_file, rows=row_profile, columns=column_profile)
+
+
+def import_profiles(combinations, input_folder):
+    """
+    Import the marginal profiles saved by save_profiles.
+
+    Parameters
+    ----------
+    combinations : iterable
+        The combinations of segments to import the profiles of.
+
+    input_folder : str
+        The input folder to import the profiles from.
+
+    Returns
+    -------
+    dict
+        A dictionary of (row profile, column profile) tuples, with the keys
+        being the combination of segments.
+    """
+    profiles = {}
+    for combination in combinations:
+        with np.load(os.path.join(input_folder, f"{combination[0]}-{combination[1]}.profiles.npz")) as profile:
+            profiles[combination] = (profile["rows"], profile["columns"])
+    return profiles
+
+
+def import_combination_arrays(combination_arrays, input_folder, inter_only=True, mmap_mode=None):
     """
     Import the combination arrays as a numpy array.
 
@@ -136,6 +344,10 @@ def import_combination_arrays(combination_arrays, input_folder, inter_only=True)
     input_folder : str
         The input folder to import the arrays from.
 
+    mmap_mode : str, optional
+        If given, the arrays are memory-mapped with this mode (see numpy.load)
+        instead of being read into memory. The default is None.
+
     Returns
     -------
     dict
@@ -144,8 +356,8 @@ def import_combination_arrays(combination_arrays, input_folder, inter_only=True)
     for combination, array in combination_arrays.items():
         if inter_only:
             if combination[0] != combination[1]:
-                combination_arrays[combination] = np.load(os.path.join(input_folder, f"{combination[0]}-{combination[1]}.npy"))
+                combination_arrays[combination] = np.load(os.path.join(input_folder, f"{combination[0]}-{combination[1]}.npy"), mmap_mode=mmap_mode)
         else:
-            combination_arrays[combination] = np.load(os.path.join(input_folder, f"{combination[0]}-{combination[1]}.npy"))
+            combination_arrays[combination] = np.load(os.path.join(input_folder, f"{combination[0]}-{combination[1]}.npy"), mmap_mode=mmap_mode)
 
     return combination_arrays
\ No newline at end of file
@@ -13,6 +13,7 @@ Options:
 """
 from docopt import docopt
 import helper
+import metrics_handler as mh
 
 
 def parse_interactions(interactions):
@@ -55,7 +56,7 @@ def make_interaction_fasta(fasta_filepath, interaction_dict):
     # This whole function assumes ordered dictionaries, that basically means
     # that it only works on Python 3.6+, which shouldn't be a problem for our
     # purposes.
-    genome = [segment for segment in helper.parse_genome(fasta_filepath).values()]
+    genome = [segment for segment in helper.parse_fasta(fasta_filepath).values()]
     interaction_fasta = ""
     for idx, interactions in interaction_dict.items():
         first_subkey = True
@@ -86,6 +87,6 @@ def main():
 
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
 
 
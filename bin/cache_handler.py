@@ -0,0 +1,227 @@
+"""cache_handler.py
+
+Content-addressed cache of intermediate results (filled arrays, merged arrays,
+fitted models), shared across runs and samples. A result is keyed by its kind,
+the hashes of the contents of its input files and the parameters it was
+computed with, so it is reused whenever the same inputs are given again, no
+matter where or under which name they are staged:
+
+    combination_arrays = ch.cached(
+        "merged_arrays",
+        array_files,
+        {"intra_only": False},
+        compute=lambda: ah.combine_arrays(combination_arrays),
+        save=ah.save_combination_arrays,
+        load=load_merged_arrays,
+        stage=merge_stage,
+    )
+
+The cache is opt-in, it is enabled by setting RNASWARM_CACHE to a folder.
+RNASWARM_CACHE_SIZE bounds the size of the folder (e.g. 500M or 20G, by
+default 20G), the least recently used results are evicted first. Hits and
+misses are counted on the metrics stage given, see metrics_handler.py.
+"""
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import helper as hp
+
+CACHE_VARIABLE = "RNASWARM_CACHE"
+CACHE_SIZE_VARIABLE = "RNASWARM_CACHE_SIZE"
+DEFAULT_CACHE_SIZE = "20G"
+# Bump to invalidate all cached results, e.g. when their format changes
+CACHE_VERSION = 1
+HASH_BLOCK_SIZE = 1 << 20
+
+
+def get_cache_folder():
+    """Returns the cache folder, None if the cache is disabled."""
+    return os.environ.get(CACHE_VARIABLE) or None
+
+
+def get_max_cache_size():
+    """Returns the maximum size of the cache folder in bytes."""
+    return hp.parse_size(os.environ.get(CACHE_SIZE_VARIABLE) or DEFAULT_CACHE_SIZE)
+
+
+def get_file_hash(filepath, cache_folder=None):
+    """Returns the sha256 hash of the contents of a file. Within a cache
+    folder the hash is remembered for the file (its real path, size and
+    modification time), so that unchanged files are only read once.
+
+    Parameters
+    ----------
+    filepath : str
+        The file.
+    cache_folder : str, optional
+        The cache folder to remember the hash in.
+
+    Returns
+    -------
+    str
+        The hash of the contents.
+    """
+    memo_file = None
+    if cache_folder is not None:
+        status = os.stat(filepath)
+        signature = f"{os.path.realpath(filepath)}\n{status.st_size}\n{status.st_mtime_ns}"
+        memo_file = os.path.join(
+            cache_folder, "hashes", hashlib.sha256(signature.encode()).hexdigest()
+        )
+        if os.path.exists(memo_file):
+            with open(memo_file) as memo:
+                return memo.read().strip()
+    file_hash = hashlib.sha256()
+    with open(filepath, "rb") as file:
+        for block in iter(lambda: file.read(HASH_BLOCK_SIZE), b""):
+            file_hash.update(block)
+    file_hash = file_hash.hexdigest()
+    if memo_file is not None:
+        os.makedirs(os.path.dirname(memo_file), exist_ok=True)
+        with tempfile.NamedTemporaryFile("w", dir=os.path.dirname(memo_file), delete=False) as memo:
+            memo.write(file_hash)
+        os.replace(memo.name, memo_file)
+    return file_hash
+
+
+def get_key(kind, input_files, parameters, cache_folder=None):
+    """Returns the cache key of a result.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of result, e.g. filled_arrays.
+    input_files : list
+        The files the result is computed from, in a fixed order.
+    parameters : dict
+        The parameters the result is computed with, JSON serialisable.
+    cache_folder : str, optional
+        The cache folder to remember the hashes of the input files in.
+
+    Returns
+    -------
+    str
+        The key.
+    """
+    description = {
+        "version": CACHE_VERSION,
+        "kind": kind,
+        "inputs": [get_file_hash(input_file, cache_folder) for input_file in input_files],
+        "parameters": parameters,
+    }
+    return hashlib.sha256(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+
+def get_folder_size(folder):
+    """Returns the size in bytes of the files in a folder."""
+    return sum(
+        os.path.getsize(os.path.join(root, file))
+        for root, _, files in os.walk(folder)
+        for file in files
+    )
+
+
+def evict(cache_folder, max_size):
+    """Removes the least recently used results until the cache folder is no
+    larger than max_size.
+
+    Parameters
+    ----------
+    cache_folder : str
+        The cache folder.
+    max_size : int
+        The maximum size in bytes.
+
+    Returns
+    -------
+    int
+        The number of results removed.
+    """
+    entries = []
+    for kind in os.listdir(cache_folder):
+        kind_folder = os.path.join(cache_folder, kind)
+        if kind == "hashes" or not os.path.isdir(kind_folder):
+            continue
+        for key in os.listdir(kind_folder):
+            if key.startswith("."):
+                # Being written by another process
+                continue
+            entry = os.path.join(kind_folder, key)
+            try:
+                entries.append((os.stat(entry).st_mtime, get_folder_size(entry), entry))
+            except OSError:
+                # Removed or being written by another process
+                continue
+    size = sum(entry_size for _, entry_size, _ in entries)
+    removed = 0
+    for _, entry_size, entry in sorted(entries):
+        if size <= max_size:
+            break
+        shutil.rmtree(entry, ignore_errors=True)
+        size -= entry_size
+        removed += 1
+    return removed
+
+
+def cached(kind, input_files, parameters, compute, save, load, stage=None):
+    """Returns a result from the cache or computes it and stores it in the
+    cache. Without a cache folder the result is always computed.
+
+    Parameters
+    ----------
+    kind : str
+        The kind of result, e.g. filled_arrays.
+    input_files : list
+        The files the result is computed from, in a fixed order.
+    parameters : dict
+        The parameters the result is computed with, JSON serialisable.
+    compute : function
+        Computes the result.
+    save : function
+        Saves a result to a folder, save(result, folder).
+    load : function
+        Loads a result from a folder, load(folder).
+    stage : metrics_handler.Stage, optional
+        The stage to count the cache hits and misses on.
+
+    Returns
+    -------
+    object
+        The result.
+    """
+    cache_folder = get_cache_folder()
+    if cache_folder is None:
+        return compute()
+    os.makedirs(cache_folder, exist_ok=True)
+    key = get_key(kind, input_files, parameters, cache_folder)
+    entry = os.path.join(cache_folder, kind, key)
+
+    if os.path.isdir(entry):
+        try:
+            result = load(entry)
+            # The modification time orders the results for the eviction
+            os.utime(entry)
+            if stage is not None:
+                stage.count(f"{kind}_cache_hits")
+            return result
+        except Exception:
+            # Evicted or corrupted meanwhile (e.g. a truncated pickle), the
+            # result is computed and stored again
+            shutil.rmtree(entry, ignore_errors=True)
+
+    result = compute()
+    if stage is not None:
+        stage.count(f"{kind}_cache_misses")
+    os.makedirs(os.path.dirname(entry), exist_ok=True)
+    temporary_entry = tempfile.mkdtemp(prefix=f".{key}.", dir=os.path.dirname(entry))
+    try:
+        save(result, temporary_entry)
+        os.rename(temporary_entry, entry)
+    except OSError:
+        # Another process stored the same result first
+        shutil.rmtree(temporary_entry, ignore_errors=True)
+    evict(cache_folder, get_max_cache_size())
+    return result
@@ -20,6 +20,7 @@ Options:
 from docopt import docopt
 import os
 import pandas as pd
+import metrics_handler as mh
 
 
 def convert_to_annotation_table(structure_table_pd, interaction_type=None):
@@ -100,6 +101,8 @@ def main():
     # Write the table to file
     annotation_table_pd.to_csv(output_file, sep=",", index=False)
 
+    mh.write_metrics(output_file)
+
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
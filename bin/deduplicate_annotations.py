@@ -23,6 +23,7 @@ Options:
 from docopt import docopt
 import pandas as pd
 import os
+import metrics_handler as mh
 
 def parse_annotation_table(annotation_table):
     """Parses the annotation table into a pandas dataframe.
@@ -102,12 +103,14 @@ def main():
     count_table = arguments['--count_table']
     output_folder = arguments['--output']
 
-    # parse the annotation table
-    annotation_table_df = parse_annotation_table(annotation_table)
-    annotation_table_df['area'] = (annotation_table_df['end01'] - annotation_table_df['start01']) * (annotation_table_df['end02'] - annotation_table_df['start02'])
+    with mh.stage('load') as load_stage:
+        # parse the annotation table
+        annotation_table_df = parse_annotation_table(annotation_table)
+        annotation_table_df['area'] = (annotation_table_df['end01'] - annotation_table_df['start01']) * (annotation_table_df['end02'] - annotation_table_df['start02'])
 
-    # parse the count table
-    count_table_df = parse_count_table(count_table)
+        # parse the count table
+        count_table_df = parse_count_table(count_table)
+        load_stage.count('annotations', len(annotation_table_df))
 
     # Reorder the annotation table to match the count table
     annotation_table_df = annotation_table_df.loc[count_table_df.index]
@@ -125,25 +128,28 @@ def main():
     # List to store rows for the deduplicated DataFrame
     deduplicated_rows = []
 
-    # Iterate over the count table
-    for index, row in count_table_df.iterrows():
-        # Get the annotation
-        annotation = annotation_dict[index]
-
-        # Check if the annotation overlaps with any of the following annotations
-        if not any(check_if_overlap(annotation, annotation_dict[idx]) for idx in deduplicated_rows):
-            deduplicated_rows.append(index)
-
-    # Check wich interactions overlap with each of the deduplicated interactions
-    main_interactions = {}
-    graveyard_interactions = []
-    for index in deduplicated_rows:
-        annotation = annotation_dict[index]
-        main_interactions[index] = []
-        for idx, annotation2 in annotation_dict.items():
-            if check_if_overlap(annotation, annotation2) and index != idx and idx not in graveyard_interactions:
-                main_interactions[index].append(idx)
-                graveyard_interactions.append(idx)
+    with mh.stage('deduplicate') as deduplicate_stage:
+        # Iterate over the count table
+        for index, row in count_table_df.iterrows():
+            # Get the annotation
+            annotation = annotation_dict[index]
+
+            # Check if the annotation overlaps with any of the following annotations
+            if not any(check_if_overlap(annotation, annotation_dict[idx]) for idx in deduplicated_rows):
+                deduplicated_rows.append(index)
+
+        # Check wich interactions overlap with each of the deduplicated interactions
+        main_interactions = {}
+        graveyard_interactions = []
+        for index in deduplicated_rows:
+            annotation = annotation_dict[index]
+            main_interactions[index] = []
+            for idx, annotation2 in annotation_dict.items():
+                if check_if_overlap(annotation, annotation2) and index != idx and idx not in graveyard_interactions:
+                    main_interactions[index].append(idx)
+                    graveyard_interactions.append(idx)
+        deduplicate_stage.count('annotations', len(count_table_df))
+        deduplicate_stage.count('deduplicated_annotations', len(deduplicated_rows))
 
 
     new_column = {}
@@ -173,5 +179,7 @@ def main():
     count_table_deduplicated_df.to_csv(os.path.join(output_folder, 'count_table_deduplicated.tsv'), sep='\t')
     annotation_table_deduplicated_df.to_csv(os.path.join(output_folder, 'annotation_table_deduplicated.tsv'), sep='\t')
 
+    mh.write_metrics(output_folder)
+
 if __name__ == '__main__':
-    main()
+    mh.run_main(main)
@@ -2,8 +2,13 @@
 
 """fill_arrays.py
 
+Fills the combination arrays from trns files and saves them, together with
+their marginal profiles (the sums along each axis), to the output folder.
+Arrays which do not fit into the memory budget are filled sparse or
+memory-mapped, see resource_planner.py.
+
 Usage:
-    fill_arrays.py <trns_file>... -g <genome> [--intra_only] -o <output_folder>
+    fill_arrays.py <trns_file>... -g <genome> [--intra_only] [--memory=<memory>] -o <output_folder>
 
 Options:
     -h --help                    Show this screen.
@@ -11,14 +16,113 @@ Options:
     -g --genome=<genome>         The genome filepath.
     -o --output=<output_folder>  The output folder.
     --intra_only                 Only plot intra-segment interactions.
+    --memory=<memory>            Memory budget of the task, e.g. 8G, defaults to
+                                 the memory available to the task.
 
 """
 
 from docopt import docopt
+import json
 import os
+import shutil
+import tempfile
 import helper as hp
 import trns_handler as th
 import array_handler as ah
+import cache_handler as ch
+import resource_planner as rp
+import metrics_handler as mh
+
+
+def fill_trns_file(trns_file, genome_file, genome_dict, intra_only=False, memory_budget=None, memmap_folder=None, stage=None):
+    """
+    Fills the combination arrays and their marginal profiles from a trns file,
+    or loads them from the cache if the same trns file and genome were filled
+    before.
+
+    Parameters
+    ----------
+    trns_file : str
+        Path to the trns file.
+    genome_file : str
+        Path to the genome, part of the cache key.
+    genome_dict : dict
+        The parsed genome, see helper.parse_fasta.
+    intra_only : bool, optional
+        Fill the intra-segment instead of the inter-segment combinations.
+    memory_budget : int, optional
+        Memory budget in bytes, arrays exceeding it are filled sparse or
+        memory-mapped (in memmap_folder). By default all arrays are dense.
+    memmap_folder : str, optional
+        Folder of the memory-mapped arrays.
+    stage : metrics_handler.Stage, optional
+        The stage to count the reads, interactions and cache hits on.
+
+    Returns
+    -------
+    tuple
+        The combination arrays and their (row profile, column profile) tuples.
+    """
+
+    def fill():
+        if memory_budget is None:
+            combination_dict = hp.make_combination_array(genome_dict, intra_only=intra_only)
+        else:
+            estimates = rp.get_array_estimates(
+                hp.get_segment_lengths(genome_dict),
+                hp.get_segment_combinations(genome_dict, intra_only=intra_only),
+                rp.estimate_number_of_lines(trns_file),
+                intra_only=intra_only,
+            )
+            plan = rp.plan_arrays(estimates, memory_budget)
+            combination_dict = rp.make_combination_array(
+                genome_dict, plan, memmap_folder=memmap_folder, intra_only=intra_only
+            )
+            if stage is not None:
+                for representation in plan.values():
+                    stage.count(f"{representation}_arrays")
+        profile_arrays = th.make_profile_arrays(combination_dict)
+        number_of_reads, number_of_interactions = th.segemehlTrans2heatmap(
+            trns_file,
+            combination_dict,
+            intra_only=intra_only,
+            profile_arrays=profile_arrays,
+        )
+        counts = {"reads": number_of_reads, "interactions": number_of_interactions}
+        return combination_dict, th.get_profiles(profile_arrays), counts
+
+    def save(result, folder):
+        combination_dict, profiles, counts = result
+        ah.save_combination_arrays(combination_dict, folder)
+        ah.save_profiles(profiles, folder)
+        with open(os.path.join(folder, "counts.json"), "w") as counts_file:
+            json.dump(counts, counts_file)
+
+    def load(folder):
+        combination_dict = ah.import_combination_arrays(
+            hp.make_combination_array(genome_dict, intra_only=intra_only),
+            folder,
+            inter_only=False,
+            mmap_mode="r",
+        )
+        profiles = ah.import_profiles(combination_dict.keys(), folder)
+        with open(os.path.join(folder, "counts.json")) as counts_file:
+            counts = json.load(counts_file)
+        return combination_dict, profiles, counts
+
+    combination_dict, profiles, counts = ch.cached(
+        "filled_arrays",
+        [genome_file, trns_file],
+        {"intra_only": intra_only},
+        compute=fill,
+        save=save,
+        load=load,
+        stage=stage,
+    )
+    if stage is not None:
+        for item, number in counts.items():
+            stage.count(item, number)
+    return combination_dict, profiles
 
 
 def main():
@@ -30,23 +134,45 @@ def main():
     intra_only = False
     if args["--intra_only"]:
         intra_only = True
+    if args["--memory"]:
+        memory_budget = hp.parse_size(args["--memory"])
+    else:
+        memory_budget = hp.get_available_memory()
 
-    # Process input files
-    genome_dict = hp.parse_fasta(genome_file)
+    # Process input files, the index is written next to the genome so that
+    # later scripts read the sequences through it instead of scanning it again
+    with mh.stage("parse_genome"):
+        genome_dict = hp.parse_fasta(genome_file, write_index=True)
 
-    # Process trns files
-    combination_dicts = {}
+    # Memory-mapped arrays are filled next to the output, then moved into it
+    memmap_folder = tempfile.mkdtemp(prefix=".memmap_", dir=output_folder)
+    try:
+        for trns_file in trns_files:
+            # Create and fill the combination dict, together with its marginal
+            # profiles, each trns file has the whole memory budget as its
+            # arrays are saved and released before the next one is filled
+            with mh.stage("fill") as fill_stage:
+                combination_dict, profiles = fill_trns_file(
+                    trns_file,
+                    genome_file,
+                    genome_dict,
+                    intra_only=intra_only,
+                    memory_budget=memory_budget,
+                    memmap_folder=memmap_folder,
+                    stage=fill_stage,
+                )
 
-    # Create and fill combination dicts
-    for trns_file in trns_files:
-        trns_file_name = os.path.basename(trns_file)
-        combination_dicts[trns_file_name] = hp.make_combination_array(genome_dict, intra_only=intra_only)
-        th.segemehlTrans2heatmap(trns_file, combination_dicts[trns_file_name], intra_only=intra_only)
+            # Save the combination arrays and their profiles
+            with mh.stage("save") as save_stage:
+                ah.save_combination_arrays(combination_dict, output_folder, temporary_folder=memmap_folder)
+                ah.save_profiles(profiles, output_folder)
+                save_stage.count("arrays", len(combination_dict))
+            del combination_dict, profiles
+    finally:
+        shutil.rmtree(memmap_folder, ignore_errors=True)
 
-    # Save combination arrays
-    for trns_file_name, combination_dict in combination_dicts.items():
-        ah.save_combination_arrays(combination_dict, output_folder)
+    mh.write_metrics(output_folder)
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    mh.run_main(main)
\ No newline at end of file
@@ -3,37 +3,103 @@
 """get_library_size.py
 
 Usage:
-    get_library_size.py -f <bam_file> [--output=<output>]
-    get_library_size.py -f <bam_file>... [--output=<output>]
-    get_library_size.py -F <bam_file_folder> [--output=<output>]
-    get_library_size.py -F <bam_file_folder>... [--output=<output>]
+    get_library_size.py -f <bam_file>... [--output=<output>] [--threads=<threads>] [--cache=<cache_file>]
+    get_library_size.py -F <bam_file_folder>... [--output=<output>] [--threads=<threads>] [--cache=<cache_file>]
     get_library_size.py -h | --help
 
 Options:
-    -h --help           Show this screen.
-    -f --file           Bam file
-    -F --folder         Bam file folder
-    --output=<output>   Output file [default: library_size.txt]
+    -h --help               Show this screen.
+    -f --file               Bam file
+    -F --folder             Bam file folder
+    --output=<output>       Output file [default: library_size.txt]
+    --threads=<threads>     Number of cores to use, defaults to the cores
+                            allocated to the task.
+    --cache=<cache_file>    Cache of previously computed library sizes
+                            [default: .library_size_cache.json]
 
 """
 
 from docopt import docopt
 import pysam
-import sys
 import os
+import json
 import multiprocessing as mp
+import helper as hp
+import metrics_handler as mh
 
-def get_library_size(bam_file):
+
+def has_index(bam_file):
+    """Check if a bam file has a .bai or .csi index
+
+    Args:
+        bam_file (str): Bam file
+
+    Returns:
+        bool: True if an index is found next to the bam file
+    """
+    for index_file in (f"{bam_file}.bai", f"{bam_file}.csi", f"{os.path.splitext(bam_file)[0]}.bai"):
+        if os.path.exists(index_file):
+            return True
+    return False
+
+
+def get_library_size(bam_file, threads=1):
     """Get library size from bam file
 
+    The number of mapped reads is read from the bam index (as samtools idxstats
+    does) when one is present, otherwise the whole file is scanned with
+    `threads` decompression threads.
+
     Args:
         bam_file (str): Bam file
+        threads (int): Number of decompression threads for the scan
 
     Returns:
         int: Library size
     """
-    library_size = pysam.view('-c', '-F', '4', bam_file)
-    return library_size
+    if has_index(bam_file):
+        with pysam.AlignmentFile(bam_file, "rb") as bam:
+            return sum(statistic.mapped for statistic in bam.get_index_statistics())
+    library_size = pysam.view('-c', '-F', '4', '-@', str(threads), bam_file)
+    return int(library_size)
+
+
+def load_cache(cache_file):
+    """Load the library size cache
+
+    Args:
+        cache_file (str): Cache file
+
+    Returns:
+        dict: Cached entries, keyed by absolute bam file path
+    """
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as cache:
+            try:
+                return json.load(cache)
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+
+def get_cache_key(bam_file):
+    """Get the cache key and file signature of a bam file
+
+    Args:
+        bam_file (str): Bam file
+
+    Returns:
+        tuple: Absolute path and [size, mtime] of the bam file
+    """
+    stat = os.stat(bam_file)
+    return os.path.abspath(bam_file), [stat.st_size, stat.st_mtime_ns]
+
+
+def get_library_size_star(arguments):
+    """Unpack arguments for get_library_size, to be used with mp.Pool.map
+    """
+    return get_library_size(*arguments)
+
 
 def main():
     """Main function
@@ -42,25 +108,58 @@ def main():
     if args['--folder']:
         bam_file_list = []
         for bam_file_folder in args['<bam_file_folder>']:
-            bam_file_list.extend([bam_file_folder + '/' + bam_file for bam_file in os.listdir(bam_file_folder) if bam_file.endswith('.bam')])
+            bam_file_list.extend([bam_file_folder + '/' + bam_file for bam_file in sorted(os.listdir(bam_file_folder)) if bam_file.endswith('.bam')])
     else:
-        bam_file_list = [args['--file']]
-    # Check if --output was given
-    if args['--output']:
-        output_file = args['--output']
-    else:
-        # Print to stdout
-        output_file = sys.stdout
-    # Open output file
+        bam_file_list = args['<bam_file>']
+    output_file = args['--output']
+    cache_file = args['--cache']
     # Check it output folder exists
-    if not os.path.exists(os.path.dirname(output_file)):
+    if os.path.dirname(output_file) and not os.path.exists(os.path.dirname(output_file)):
         os.makedirs(os.path.dirname(output_file))
-    # In parallel process each bam file and write to output file
-    with mp.Pool() as pool, open(output_file, 'w') as output:
-        for bam_file, library_size in zip(bam_file_list, pool.map(get_library_size, bam_file_list)):
-            print(f"processing {bam_file}...")
-            output.write(f"{bam_file}\t{library_size}")
+    # Bound the work to the cores allocated to the task
+    if args['--threads']:
+        cpus = int(args['--threads'])
+    else:
+        cpus = hp.get_available_cpus()
+
+    # Only process bam files which changed since they were cached
+    cache = load_cache(cache_file)
+    library_sizes = {}
+    to_process = []
+    for bam_file in bam_file_list:
+        key, signature = get_cache_key(bam_file)
+        if key in cache and cache[key]["signature"] == signature:
+            library_sizes[bam_file] = cache[key]["library_size"]
+        else:
+            to_process.append(bam_file)
+
+    # In parallel process each bam file, splitting the cores between processes
+    # and decompression threads
+    with mh.stage("count") as count_stage:
+        count_stage.count("cached_bam_files", len(bam_file_list) - len(to_process))
+        if to_process:
+            processes = max(1, min(cpus, len(to_process)))
+            threads = max(1, cpus // processes)
+            with mp.Pool(processes) as pool:
+                results = pool.map(get_library_size_star, [(bam_file, threads) for bam_file in to_process])
+            for bam_file, library_size in zip(to_process, results):
+                print(f"processing {bam_file}...")
+                library_sizes[bam_file] = library_size
+                key, signature = get_cache_key(bam_file)
+                cache[key] = {"signature": signature, "library_size": library_size}
+                count_stage.count("bam_files")
+                count_stage.count("reads", library_size)
+            if cache_file:
+                with open(cache_file, 'w') as cache_handle:
+                    json.dump(cache, cache_handle, indent=2)
+
+    # Write library sizes to output file
+    with open(output_file, 'w') as output:
+        for bam_file in bam_file_list:
+            output.write(f"{bam_file}\t{library_sizes[bam_file]}\n")
+
+    mh.write_metrics(output_file)
 
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    mh.run_main(main)
@@ -1,13 +1,89 @@
-import matplotlib.pyplot as plt
 import itertools
 import numpy as np
-import itertools
-from matplotlib.colors import LogNorm
-import pandas as pd
+import os
+import gzip
+import mmap
+from multiprocessing.pool import ThreadPool
 
 
-def parse_fasta(fasta_file):
-    """Parses a fasta file and returns a dictionary of segment names and sequences.
+class FastaSequence:
+    """Sequence of a fasta record, read lazily from a memory-mapped fasta file.
+
+    Behaves like a read-only string for len() and indexing/slicing, which
+    only decode the requested bases. str() returns the whole sequence.
+
+    Parameters
+    ----------
+    buffer : mmap.mmap
+        Memory-mapped fasta file.
+    length : int
+        Number of bases of the record.
+    offset : int
+        Byte offset of the first base of the record.
+    line_bases : int
+        Number of bases per line.
+    line_width : int
+        Number of bytes per line, including the line terminator.
+
+    """
+
+    def __init__(self, buffer, length, offset, line_bases, line_width):
+        self.buffer = buffer
+        self.length = length
+        self.offset = offset
+        self.line_bases = line_bases
+        self.line_width = line_width
+
+    def __len__(self):
+        return self.length
+
+    def _byte_offset(self, position):
+        return (
+            self.offset
+            + (position // self.line_bases) * self.line_width
+            + position % self.line_bases
+        )
+
+    def _fetch(self, start, stop):
+        if start >= stop:
+            return ""
+        chunk = self.buffer[self._byte_offset(start) : self._byte_offset(stop - 1) + 1]
+        return chunk.replace(b"\n", b"").replace(b"\r", b"").decode()
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.length)
+            if step == 1:
+                return self._fetch(start, stop)
+            return str(self)[key]
+        if key < 0:
+            key += self.length
+        if not 0 <= key < self.length:
+            raise IndexError("sequence index out of range")
+        return self._fetch(key, key + 1)
+
+    def __iter__(self):
+        return iter(str(self))
+
+    def __str__(self):
+        return self._fetch(0, self.length)
+
+    def __repr__(self):
+        return f"FastaSequence(length={self.length})"
+
+    def __eq__(self, other):
+        return str(self) == str(other)
+
+    def __hash__(self):
+        return hash(str(self))
+
+    def __reduce__(self):
+        # memory maps cannot be pickled, so we pickle the plain sequence
+        return (str, (str(self),))
+
+
+def index_fasta(fasta_file):
+    """Builds a samtools faidx-style index of a fasta file.
 
     Parameters
     ----------
@@ -16,41 +92,171 @@ def parse_fasta(fasta_file):
 
     Returns
     -------
-    genome_dict : dict
+    fasta_index : dict or None
+        Dictionary of segment names and (length, offset, line_bases, line_width)
+        tuples, or None if a record has lines of irregular length and cannot
+        be indexed.
+
+    """
+    fasta_index = {}
+    header = None
+    offset = 0
+    with open(fasta_file, "rb") as file:
+        for line in file:
+            if line.startswith(b">"):
+                if header is not None:
+                    fasta_index[header] = (length, sequence_offset, line_bases, line_width)
+                header = line[1:].decode().split()[0]
+                sequence_offset = offset + len(line)
+                length = 0
+                line_bases = line_width = 0
+                last_line_short = False
+            elif header is not None:
+                bases = len(line.rstrip(b"\r\n"))
+                if bases == 0:
+                    # * blank lines are only allowed after the last sequence line
+                    if not line_bases:
+                        return None
+                    last_line_short = True
+                    offset += len(line)
+                    continue
+                # * every line but the last has to have the same length,
+                # * otherwise positions cannot be computed from the index
+                if last_line_short or (line_bases and bases > line_bases):
+                    return None
+                if not line_bases:
+                    line_bases, line_width = bases, len(line)
+                elif bases < line_bases or len(line) != line_width:
+                    last_line_short = True
+                length += bases
+            offset += len(line)
+        if header is not None:
+            fasta_index[header] = (length, sequence_offset, line_bases, line_width)
+    return fasta_index
+
+
+def read_fasta_index(index_file):
+    """Reads a samtools faidx-style index.
+
+    Parameters
+    ----------
+    index_file : str
+        Path to .fai file.
+
+    Returns
+    -------
+    fasta_index : dict
+        Dictionary of segment names and (length, offset, line_bases, line_width)
+        tuples.
+
+    """
+    fasta_index = {}
+    with open(index_file) as file:
+        for line in file:
+            name, length, offset, line_bases, line_width = line.split("\t")[:5]
+            fasta_index[name] = (int(length), int(offset), int(line_bases), int(line_width))
+    return fasta_index
+
+
+def write_fasta_index(fasta_index, index_file):
+    """Writes a samtools faidx-style index.
+
+    Parameters
+    ----------
+    fasta_index : dict
+        Dictionary of segment names and (length, offset, line_bases, line_width)
+        tuples.
+    index_file : str
+        Path to .fai file.
+
+    """
+    with open(index_file, "w") as file:
+        for name, entry in fasta_index.items():
+            file.write("\t".join([name] + [str(value) for value in entry]) + "\n")
+
+
+def read_fasta(fasta_file):
+    """Reads a (possibly gzipped) fasta file into memory.
+
+    Parameters
+    ----------
+    fasta_file : str
+        Path to fasta file.
+
+    Returns
+    -------
+    fasta_dict : dict
         Dictionary of segment names and sequences.
 
     """
     fasta_dict = {}
-
-    header = ""
-    seq = ""
-
-    with open(fasta_file) as file:  # read genome file
-        for line in file:  # parse genome file
-            if line.startswith(">"):  # parse header
-                # * if there is a header already, we store the current sequence
-                # * to this header.
-                if header:
-                    fasta_dict[header] = seq
-                    # * then we flush the sequence
-                    seq = ""
-                # * and parse the new header
-                header = line.strip()[1:]
+    header = None
+    seq = []
+    opener = gzip.open if fasta_file.endswith(".gz") else open
+    with opener(fasta_file, "rt") as file:
+        for line in file:
+            if line.startswith(">"):
+                if header is not None:
+                    fasta_dict[header] = "".join(seq)
+                header = line[1:].split()[0]
+                seq = []
             else:
-                # * if no header is detected, we append the new line
-                # * to the current sequence
-                seq += line.strip()
-        # * after the last line, we have to store
-        # * the last sequence as well. Since no new line with ">" occurs, we
-        # * do this manually
-        fasta_dict[header] = seq
+                seq.append(line.strip())
+        if header is not None:
+            fasta_dict[header] = "".join(seq)
     return fasta_dict
 
 
-def make_combination_array(genome_dict, intra_only=False):
+def parse_fasta(fasta_file, write_index=False):
+    """Parses a fasta file and returns a dictionary of segment names and sequences.
+
+    The sequences are read lazily from the memory-mapped fasta file through a
+    samtools faidx-style index, which is read from <fasta_file>.fai when it is
+    up to date and built otherwise. The index is only written next to the
+    fasta file when asked for, so that input folders are left untouched.
+    Segment names
+    are the first word of the headers. Files which cannot be indexed (gzipped
+    or with irregular line lengths) are read into memory.
+
+    Parameters
+    ----------
+    fasta_file : str
+        Path to fasta file.
+    write_index : bool, optional
+        Write the built index to <fasta_file>.fai for later runs.
+
+    Returns
+    -------
+    genome_dict : dict
+        Dictionary of segment names and sequences (helper.FastaSequence).
+
     """
-    Creates a dictionary of numpy array of all possible genome segment combinations.
-    Use helper.parse_genome() to create genome_dict.
+    if fasta_file.endswith(".gz") or os.path.getsize(fasta_file) == 0:
+        return read_fasta(fasta_file)
+
+    index_file = f"{fasta_file}.fai"
+    if os.path.exists(index_file) and os.path.getmtime(index_file) >= os.path.getmtime(fasta_file):
+        fasta_index = read_fasta_index(index_file)
+    else:
+        fasta_index = index_fasta(fasta_file)
+        if fasta_index is None:
+            return read_fasta(fasta_file)
+        if write_index:
+            try:
+                write_fasta_index(fasta_index, index_file)
+            except OSError:
+                # * the index is only a shortcut for later runs
+                pass
+
+    with open(fasta_file, "rb") as file:
+        buffer = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    return {
+        segment: FastaSequence(buffer, *entry) for segment, entry in fasta_index.items()
+    }
+
+
+def get_segment_lengths(genome_dict):
+    """Returns the length of each segment of the genome.
 
     Parameters
     ----------
@@ -59,11 +265,135 @@ def make_combination_array(genome_dict, intra_only=False):
 
     Returns
     -------
-    combination_arrays : dict
-        Dictionary of numpy arrays of all relevant genome segment combinations.
+    segment_lengths : dict
+        Dictionary of segment names and lengths.
+
+    """
+    return {segment: len(sequence) for segment, sequence in genome_dict.items()}
+
+
+def get_available_cpus():
+    """Returns the number of cores available to the current task.
+
+    Cores pinned to the process (e.g. by SLURM or a container cpuset) are
+    preferred over the total number of cores of the node.
+
+    Returns
+    -------
+    cpus : int
+        Number of available cores.
+
+    """
+    if os.environ.get("SLURM_CPUS_PER_TASK", "").isdigit():
+        return int(os.environ["SLURM_CPUS_PER_TASK"])
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    return os.cpu_count() or 1
+
+
+def parse_size(size):
+    """Parses a size in bytes, with an optional K, M, G or T suffix.
+
+    Parameters
+    ----------
+    size : str
+        The size, e.g. 500M, 20G or 8 GB.
+
+    Returns
+    -------
+    size : int
+        The size in bytes.
+
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = str(size).replace(" ", "").upper().rstrip("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(float(size))
+
+
+def get_available_memory():
+    """Returns the memory available to the current task in bytes.
+
+    The memory limit of the task (SLURM or a container cgroup) is preferred
+    over the memory available on the node.
+
+    Returns
+    -------
+    memory : int
+        Available memory in bytes, None if it is unknown.
+
+    """
+    limits = []
+    if os.environ.get("SLURM_MEM_PER_NODE", "").isdigit():
+        # In MiB
+        limits.append(int(os.environ["SLURM_MEM_PER_NODE"]) * 1024**2)
+    for cgroup_file in (
+        "/sys/fs/cgroup/memory.max",
+        "/sys/fs/cgroup/memory/memory.limit_in_bytes",
+    ):
+        try:
+            with open(cgroup_file) as cgroup:
+                limit = cgroup.read().strip()
+        except OSError:
+            continue
+        # Unlimited cgroups report "max" or a huge number
+        if limit.isdigit() and int(limit) < 1 << 60:
+            limits.append(int(limit))
+    try:
+        with open("/proc/meminfo") as meminfo:
+            for line in meminfo:
+                if line.startswith("MemAvailable:"):
+                    limits.append(int(line.split()[1]) * 1024)
+    except OSError:
+        pass
+    return min(limits) if limits else None
+
+
+def read_tables(tables, threads=1, **kwargs):
+    """Reads several tables with pandas.read_csv, optionally in threads.
+
+    Parameters
+    ----------
+    tables : list
+        Paths of the tables.
+    threads : int
+        Number of tables to read at once.
+    **kwargs
+        Passed on to pandas.read_csv.
+
+    Returns
+    -------
+    dataframes : list
+        The tables, in the given order.
+
+    """
+    import pandas as pd
+
+    if threads > 1 and len(tables) > 1:
+        with ThreadPool(min(threads, len(tables))) as pool:
+            return pool.map(lambda table: pd.read_csv(table, **kwargs), tables)
+    return [pd.read_csv(table, **kwargs) for table in tables]
+
+
+def get_segment_combinations(genome_dict, intra_only=False):
+    """
+    Returns the genome segment combinations of the combination arrays, see
+    make_combination_array.
+
+    Parameters
+    ----------
+    genome_dict : dict
+        Dictionary of segment names and sequences.
+    intra_only : bool
+        Only the intra-segment combinations instead of the inter-segment ones.
+
+    Returns
+    -------
+    segment_combinations : list
+        The (segment, segment) tuples.
 
     """
-    combination_arrays = {}
     segments = list(genome_dict.keys())
 
     # segment_combinations = [
@@ -92,6 +422,28 @@ def make_combination_array(genome_dict, intra_only=False):
             if segment_combination[0] != segment_combination[1]
         ]
 
+    return segment_combinations
+
+
+def make_combination_array(genome_dict, intra_only=False):
+    """
+    Creates a dictionary of numpy array of all possible genome segment combinations.
+    Use helper.parse_fasta() to create genome_dict.
+
+    Parameters
+    ----------
+    genome_dict : dict
+        Dictionary of segment names and sequences.
+
+    Returns
+    -------
+    combination_arrays : dict
+        Dictionary of numpy arrays of all relevant genome segment combinations.
+
+    """
+    combination_arrays = {}
+    segment_combinations = get_segment_combinations(genome_dict, intra_only=intra_only)
+
     for segment_combination in segment_combinations:
         # for segment_combination in itertools.combinations_with_replacement(segments,2): # * this should work as well
         combination_arrays[segment_combination] = np.zeros(
@@ -199,6 +551,8 @@ def parse_annotation_table(annotation_table):
     regions : pandas.DataFrame
         A table containing the annotations for the rectangular regions.
     """
+    import pandas as pd
+
     # read the annotation table
     if annotation_table.lower().endswith(".xlsx"):
         regions = pd.read_excel(annotation_table)
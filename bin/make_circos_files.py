@@ -17,13 +17,109 @@ Options:
     -a --annotation=<annotation_table>        The annotation table.
     -g --genome=<genome_file>                 The genome file filepath.
     -o --output=<output_dir>                  The output directory.
-    --number_of_top_hits=<number_of_top_hits> The number of top hits to plot [default: 20].
+    --number_of_top_hits=<number_of_top_hits>  The number of top hits to plot [default: 20].
 """
 
 from docopt import docopt
+import numpy as np
 import pandas as pd
 import helper as hp
 import os
+import metrics_handler as mh
+
+
+def add_hit_positions(hits, annotation_table):
+    """
+    Adds the positions of the hits in the genome (segment_1, start_1, end_1,
+    segment_2, start_2, end_2) by joining the hits with the annotation table
+    on the id column. If an id occurs more than once in the annotation table,
+    its first occurrence is used.
+
+    Parameters
+    ----------
+    hits : pandas.DataFrame
+        The hits, with an id column.
+    annotation_table : pandas.DataFrame
+        The annotation table (id,segment01,start01,end01,segment02,start02,end02).
+
+    Returns
+    -------
+    pandas.DataFrame
+        The hits with their positions.
+    """
+    positions = (
+        annotation_table.drop_duplicates(subset="id")
+        .set_index("id")[["segment01", "start01", "end01", "segment02", "start02", "end02"]]
+        .rename(
+            columns={
+                "segment01": "segment_1",
+                "start01": "start_1",
+                "end01": "end_1",
+                "segment02": "segment_2",
+                "start02": "start_2",
+                "end02": "end_2",
+            }
+        )
+    )
+    # Raises a KeyError if a hit is missing from the annotation table
+    positions = positions.loc[hits["id"]]
+    hits_with_positions = hits.drop(columns=positions.columns, errors="ignore").copy()
+    for column in positions.columns:
+        hits_with_positions[column] = positions[column].to_numpy()
+    for column in ["segment_1", "segment_2"]:
+        hits_with_positions[column] = hits_with_positions[column].astype(str)
+    for column in ["start_1", "end_1", "start_2", "end_2"]:
+        hits_with_positions[column] = hits_with_positions[column].astype(int)
+    return hits_with_positions
+
+
+def write_karyotype_file(genome_dict, karyotype_file):
+    """
+    Writes the circos karyotype file, one chromosome per genome segment.
+
+    Parameters
+    ----------
+    genome_dict : dict
+        The genome dictionary.
+    karyotype_file : str
+        The karyotype filepath.
+
+    Returns
+    -------
+    None
+    """
+    segment_lengths = hp.get_segment_lengths(genome_dict)
+    with open(karyotype_file, "w") as karyotype:
+        # Write the segments to the karyotype file with biological positions
+        karyotype.writelines(
+            f"chr - {segment} {segment} 1 {length} grey\n"
+            for segment, length in segment_lengths.items()
+        )
+
+
+def write_links_file(hits_with_positions, links_file):
+    """
+    Writes a circos links file, two lines (one per segment) for each hit.
+
+    Parameters
+    ----------
+    hits_with_positions : pandas.DataFrame
+        The hits with their positions, see add_hit_positions.
+    links_file : str
+        The links filepath.
+
+    Returns
+    -------
+    None
+    """
+    first_ends = hits_with_positions[["id", "segment_1", "start_1", "end_1"]].to_numpy()
+    second_ends = hits_with_positions[["id", "segment_2", "start_2", "end_2"]].to_numpy()
+    # Interleave both ends of each hit
+    links = np.empty((2 * len(first_ends), 4), dtype=object)
+    links[0::2] = first_ends
+    links[1::2] = second_ends
+    pd.DataFrame(links).to_csv(links_file, sep=" ", header=False, index=False)
+
 
 def make_circos_files_count_table(
     count_table,
@@ -60,67 +156,14 @@ def make_circos_files_count_table(
     annotation_table = annotation_table.sort_values(by="mean_counts", ascending=False)
     # Get the top hits
     top_hits = annotation_table.head(number_of_top_hits)
-    # Copy the hits data frame to hits_with_positions
-    top_hits_with_positions = top_hits.copy()
-    # Create columns for segment_1, start_1, end_1, segment_2, start_2, end_2
-    top_hits_with_positions["segment_1"] = ""
-    top_hits_with_positions["start_1"] = 0
-    top_hits_with_positions["end_1"] = 0
-    top_hits_with_positions["segment_2"] = ""
-    top_hits_with_positions["start_2"] = 0
-    top_hits_with_positions["end_2"] = 0
-    # Extract hit position in the genome from the annotation table (id,segment01,start01,end01,segment02,start02,end02)
-    # and add it to the hits_with_positions data frame
-    # iterate over the hits
-    for index, row in top_hits_with_positions.iterrows():
-        # split the hit id at the underscore
-        hit_name = row["id"]
-        # get the start and end positions in segment 1
-        start_1 = annotation_table.loc[annotation_table["id"] == hit_name, "start01"].iloc[0]
-        end_1 = annotation_table.loc[annotation_table["id"] == hit_name, "end01"].iloc[0]
-        # get the start and end positions in segment 2
-        start_2 = annotation_table.loc[annotation_table["id"] == hit_name, "start02"].iloc[0]
-        end_2 = annotation_table.loc[annotation_table["id"] == hit_name, "end02"].iloc[0]
-        # get the segment names
-        segment_1 = str(annotation_table.loc[annotation_table["id"] == hit_name, "segment01"].iloc[0])
-        segment_2 = str(annotation_table.loc[annotation_table["id"] == hit_name, "segment02"].iloc[0])
-        # add the segment names and positions to the hits_with_positions data frame
-        top_hits_with_positions.loc[index, "segment_1"] = str(segment_1)
-        top_hits_with_positions.loc[index, "start_1"] = int(start_1)
-        top_hits_with_positions.loc[index, "end_1"] = int(end_1)
-        top_hits_with_positions.loc[index, "segment_2"] = str(segment_2)
-        top_hits_with_positions.loc[index, "start_2"] = int(start_2)
-        top_hits_with_positions.loc[index, "end_2"] = int(end_2)
-
-    # Create a dict of segments
-    segments = {}
-    # Iterate over the segments in the genome dictionary
-    for segment, sequence in genome_dict.items():
-        # Get the length of the segment
-        length = len(sequence)
-        # Add the segment to the segments dict
-        segments[segment] = length
+    # Add the hit positions in the genome from the annotation table
+    top_hits_with_positions = add_hit_positions(top_hits, annotation_table)
 
     # Create karyotype file
-    with open(f"{output_dir}/karyotype.txt", "w") as karyotype_file:
-        # Iterate over the segments
-        chr_number = 1
-        for segment, length in segments.items():
-            # Write the segment to the karyotype file with biological positions
-            karyotype_file.write(
-                f"chr - {segment} {segment} 1 {length} grey\n"
-            )
-            chr_number += 1
+    write_karyotype_file(genome_dict, f"{output_dir}/karyotype.txt")
 
     # Create the top_hits.txt file
-    with open(f"{output_dir}/top_hits.txt", "w") as hits_file:
-        # Iterate over the hits
-        for index, row in top_hits_with_positions.iterrows():
-            # Write the hit to the hits.txt file
-            hits_file.write(
-                f"{row['id']} {row['segment_1']} {int(row['start_1'])} {int(row['end_1'])}\n"
-                f"{row['id']} {row['segment_2']} {int(row['start_2'])} {int(row['end_2'])}\n"
-            )
+    write_links_file(top_hits_with_positions, f"{output_dir}/top_hits.txt")
 
     # Create the circos.conf file
     # hits are to be represented as links in the final circos plot
@@ -238,103 +281,16 @@ def make_circos_files_deseq2(
     bottom_hits = DESeq2_results.sort_values(by="log2FoldChange", ascending=True).head(
         number_of_top_hits
     )
-    # Copy the hits data frame to hits_with_positions
-    top_hits_with_positions = top_hits.copy()
-    bottom_hits_with_positions = bottom_hits.copy()
-    # Create columns for segment_1, start_1, end_1, segment_2, start_2, end_2
-    top_hits_with_positions["segment_1"] = ""
-    top_hits_with_positions["start_1"] = 0
-    top_hits_with_positions["end_1"] = 0
-    top_hits_with_positions["segment_2"] = ""
-    top_hits_with_positions["start_2"] = 0
-    top_hits_with_positions["end_2"] = 0
-    bottom_hits_with_positions["segment_1"] = ""
-    bottom_hits_with_positions["start_1"] = 0
-    bottom_hits_with_positions["end_1"] = 0
-    bottom_hits_with_positions["segment_2"] = ""
-    bottom_hits_with_positions["start_2"] = 0
-    bottom_hits_with_positions["end_2"] = 0
-    # Extract hit position in the genome from the annotation table (id,segment01,start01,end01,segment02,start02,end02)
-    # and add it to the hits_with_positions data frame
-    # iterate over the hits
-    for index, row in top_hits_with_positions.iterrows():
-        # split the hit id at the underscore
-        hit_name = row["id"]
-        # get the start and end positions in segment 1
-        start_1 = annotation_table.loc[annotation_table["id"] == hit_name, "start01"].iloc[0]
-        end_1 = annotation_table.loc[annotation_table["id"] == hit_name, "end01"].iloc[0]
-        # get the start and end positions in segment 2
-        start_2 = annotation_table.loc[annotation_table["id"] == hit_name, "start02"].iloc[0]
-        end_2 = annotation_table.loc[annotation_table["id"] == hit_name, "end02"].iloc[0]
-        # get the segment names
-        segment_1 = str(annotation_table.loc[annotation_table["id"] == hit_name, "segment01"].iloc[0])
-        segment_2 = str(annotation_table.loc[annotation_table["id"] == hit_name, "segment02"].iloc[0])
-        # add the segment names and positions to the hits_with_positions data frame
-        top_hits_with_positions.loc[index, "segment_1"] = str(segment_1)
-        top_hits_with_positions.loc[index, "start_1"] = int(start_1)
-        top_hits_with_positions.loc[index, "end_1"] = int(end_1)
-        top_hits_with_positions.loc[index, "segment_2"] = str(segment_2)
-        top_hits_with_positions.loc[index, "start_2"] = int(start_2)
-        top_hits_with_positions.loc[index, "end_2"] = int(end_2)
-    for index, row in bottom_hits_with_positions.iterrows():
-        # split the hit id at the underscore
-        hit_name = row["id"]
-        # get the start and end positions in segment 1
-        start_1 = annotation_table.loc[annotation_table["id"] == hit_name, "start01"].iloc[0]
-        end_1 = annotation_table.loc[annotation_table["id"] == hit_name, "end01"].iloc[0]
-        # get the start and end positions in segment 2
-        start_2 = annotation_table.loc[annotation_table["id"] == hit_name, "start02"].iloc[0]
-        end_2 = annotation_table.loc[annotation_table["id"] == hit_name, "end02"].iloc[0]
-        # get the segment names
-        segment_1 = str(annotation_table.loc[annotation_table["id"] == hit_name, "segment01"].iloc[0])
-        segment_2 = str(annotation_table.loc[annotation_table["id"] == hit_name, "segment02"].iloc[0])
-        # add the segment names and positions to the hits_with_positions data frame
-        bottom_hits_with_positions.loc[index, "segment_1"] = str(segment_1)
-        bottom_hits_with_positions.loc[index, "start_1"] = int(start_1)
-        bottom_hits_with_positions.loc[index, "end_1"] = int(end_1)
-        bottom_hits_with_positions.loc[index, "segment_2"] = str(segment_2)
-        bottom_hits_with_positions.loc[index, "start_2"] = int(start_2)
-        bottom_hits_with_positions.loc[index, "end_2"] = int(end_2)
-
-    # Create a dict of segments
-    segments = {}
-    # Iterate over the segments in the genome dictionary
-    for segment, sequence in genome_dict.items():
-        # Get the length of the segment
-        length = len(sequence)
-        # Add the segment to the segments dict
-        segments[segment] = length
+    # Add the hit positions in the genome from the annotation table
+    top_hits_with_positions = add_hit_positions(top_hits, annotation_table)
+    bottom_hits_with_positions = add_hit_positions(bottom_hits, annotation_table)
 
     # Create karyotype file
-    with open(f"{output_dir}/karyotype.txt", "w") as karyotype_file:
-        # Iterate over the segments
-        chr_number = 1
-        for segment, length in segments.items():
-            # Write the segment to the karyotype file with biological positions
-            karyotype_file.write(
-                f"chr - {segment} {segment} 1 {length} grey\n"
-            )
-            chr_number += 1
+    write_karyotype_file(genome_dict, f"{output_dir}/karyotype.txt")
 
-    # Create the top_hits.txt file
-    with open(f"{output_dir}/top_hits.txt", "w") as hits_file:
-        # Iterate over the hits
-        for index, row in top_hits_with_positions.iterrows():
-            # Write the hit to the hits.txt file
-            hits_file.write(
-                f"{row['id']} {row['segment_1']} {int(row['start_1'])} {int(row['end_1'])}\n"
-                f"{row['id']} {row['segment_2']} {int(row['start_2'])} {int(row['end_2'])}\n"
-            )
-
-    # Create the bottom_hits.txt file
-    with open(f"{output_dir}/bottom_hits.txt", "w") as hits_file:
-        # Iterate over the hits
-        for index, row in bottom_hits_with_positions.iterrows():
-            # Write the hit to the hits.txt file
-            hits_file.write(
-                f"{row['id']} {row['segment_1']} {int(row['start_1'])} {int(row['end_1'])}\n"
-                f"{row['id']} {row['segment_2']} {int(row['start_2'])} {int(row['end_2'])}\n"
-            )
+    # Create the top_hits.txt and bottom_hits.txt files
+    write_links_file(top_hits_with_positions, f"{output_dir}/top_hits.txt")
+    write_links_file(bottom_hits_with_positions, f"{output_dir}/bottom_hits.txt")
 
     # Create the circos.conf file
     # hits are to be represented as links in the final circos plot
@@ -435,7 +391,7 @@ def main():
     annotation_table = args["--annotation"]
     genome_file = args["--genome"]
     output_dir = args["--output"]
-    number_of_top_hits = args["--number_of_top_hits"]
+    number_of_top_hits = int(args["--number_of_top_hits"])
 
     # Check if output directory exists, create it if not
     if not os.path.exists(output_dir):
@@ -451,13 +407,20 @@ def main():
         annotation_table = hp.parse_annotation_table(annotation_table)
 
         # Remove rows in DESeq2 results that are not in the annotation table
-        DESeq2_results = DESeq2_results[DESeq2_results["id"].isin(annotation_table.index)]
+        DESeq2_results = DESeq2_results[DESeq2_results["id"].isin(annotation_table["id"])]
 
         # Parse genome segment names and sequences
         genome_dict = hp.parse_fasta(genome_file)
 
         # Create circos plot files
-        make_circos_files_deseq2(DESeq2_results, annotation_table, genome_dict, output_dir)
+        with mh.stage("write"):
+            make_circos_files_deseq2(
+                DESeq2_results,
+                annotation_table,
+                genome_dict,
+                output_dir,
+                number_of_top_hits=number_of_top_hits,
+            )
     elif count_table:
         # Read input file with pandas, rename unnamed column to id, first line is the header
         count_table = pd.read_csv(count_table, sep="\t", header=0)
@@ -470,9 +433,17 @@ def main():
         genome_dict = hp.parse_fasta(genome_file)
 
         # Create circos plot files
-        make_circos_files_count_table(count_table, annotation_table, genome_dict, output_dir)
+        with mh.stage("write"):
+            make_circos_files_count_table(
+                count_table,
+                annotation_table,
+                genome_dict,
+                output_dir,
+                number_of_top_hits=number_of_top_hits,
+            )
 
+    mh.write_metrics(output_dir)
 
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
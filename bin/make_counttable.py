@@ -11,7 +11,7 @@ Usage:
 
 Options:
   -h --help                                 Show this screen.
-  <input_file>                              The input files to process, has to be a trns file generated by segemehl.
+  <input_file>                              The input files to process, has to be a trns file generated by segemehl (plain or gzipped).
   -a --annotation_table=<annotation_table>  The annotation table filepath.
   -o --output=<output_file>
   --use_peaks                               Use the peak regions instead of the full regions.
@@ -20,6 +20,7 @@ Options:
 from docopt import docopt
 import pandas as pd
 import trns_handler as th
+import metrics_handler as mh
 
 
 def fill_count_table(
@@ -129,15 +130,13 @@ def make_count_table(annotation_table, trns_files, use_peaks=False):
         for row in annotation_table_dict.values():
             count_table[trns_file][int(row["id"])] = 0
     for trns_file in trns_files:
-        with open(trns_file) as input_stream:
-            for line in input_stream:
-                line = line.strip().split()
-                firstRead = line[0].split(",")
-                secondRead = line[1].split(",")
-                currentRow = th.__extract_start_stop_segemehl(
-                    firstRead
-                ) + th.__extract_start_stop_segemehl(secondRead)
-                interaction = th.__check_interaction(currentRow)
+        for segments, interactions in th.read_trns(trns_file):
+            # Numeric segment names are compared as numbers, as in the
+            # annotation table
+            segments = [th.__convert_to_int(segment) for segment in segments]
+            for interaction in th.iterate_interactions(
+                th.check_interactions(interactions, segments), segments
+            ):
                 fill_count_table(
                     interaction,
                     count_table,
@@ -169,14 +168,20 @@ def main():
     # Read trns files
     trns_files = args["<input_file>"]
     # Create count table
-    count_table = make_count_table(
-        annotation_table, trns_files, use_peaks=args["--use_peaks"]
-    )
+    with mh.stage("count") as count_stage:
+        count_table = make_count_table(
+            annotation_table, trns_files, use_peaks=args["--use_peaks"]
+        )
+        count_stage.count("trns_files", len(trns_files))
+        count_stage.count("annotations", len(annotation_table))
     # Transform count table to pandas.DataFrame
     count_table_df = pd.DataFrame(count_table)
     # Write count table to file
-    count_table_df.to_csv(args["--output"], sep="\t", header=True, index=True)
+    with mh.stage("save"):
+        count_table_df.to_csv(args["--output"], sep="\t", header=True, index=True)
+
+    mh.write_metrics(args["--output"])
 
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
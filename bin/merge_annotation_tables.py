@@ -5,29 +5,38 @@
 Takes an arbitrary number of annotation tables and merge the lines into one csv
 
 Usage:
-    merge_annotation_tables.py <annotation_table>... -o <output_file>
+    merge_annotation_tables.py <annotation_table>... -o <output_file> [--threads=<threads>]
 
 Options:
     -h --help                                 Show this screen.
     <annotation_table>                        The annotation tables to merge.
     -o --output=<output_file>
+    --threads=<threads>                       Number of annotation tables to read at once [default: 1].
 """
 
 from docopt import docopt
 import pandas as pd
+import helper as hp
+import metrics_handler as mh
 
 def main():
     args = docopt(__doc__)
     annotation_tables = args["<annotation_table>"]
     output_file = args["--output"]
+    threads = int(args["--threads"])
 
-    merged_annotation_table = pd.DataFrame()
+    # Read all annotation tables, then merge the lines at once
+    with mh.stage("load") as load_stage:
+        annotation_tables = hp.read_tables(annotation_tables, threads=threads, header=None)
+        load_stage.count("tables", len(annotation_tables))
+    with mh.stage("merge") as merge_stage:
+        merged_annotation_table = pd.concat(annotation_tables, ignore_index=True)
+        merge_stage.count("rows", len(merged_annotation_table))
 
-    for annotation_table in annotation_tables:
-        annotation_table_df = pd.read_csv(annotation_table, header=None)
-        merged_annotation_table = pd.concat([merged_annotation_table, annotation_table_df], ignore_index=True)
+    with mh.stage("save"):
+        merged_annotation_table.to_csv(output_file, sep="\t", mode="a", header=False)
 
-    merged_annotation_table.to_csv(output_file, sep="\t", mode="a", header=False)
+    mh.write_metrics(output_file)
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    mh.run_main(main)
\ No newline at end of file
@@ -17,8 +17,14 @@ Options:
 """
 
 from docopt import docopt
+import os
 import helper as hp
 import array_handler as ah
+import cache_handler as ch
+import metrics_handler as mh
+
+# Parameters of ah.combine_arrays, also part of the cache key of the merge
+MERGE_PARAMETERS = {"normalise_array": True, "max_value": 2000000, "mode": "number_of_data_points"}
 
 def main():
     args = docopt(__doc__)
@@ -26,20 +32,51 @@ def main():
     genome_file = args["-g"]
     output = args["-o"]
 
-    # Process input files
-    genome_dict = hp.parse_fasta(genome_file)
+    # Process input files, the index is written next to the genome so that
+    # later scripts read the sequences through it instead of scanning it again
+    genome_dict = hp.parse_fasta(genome_file, write_index=True)
+    combinations = hp.make_combination_array(genome_dict, intra_only=False).keys()
+    array_files = [
+        os.path.join(array_folder, f"{combination[0]}-{combination[1]}.npy")
+        for array_folder in array_folders
+        for combination in combinations
+    ]
+
+    with mh.stage("merge") as merge_stage:
 
-    # Create and fill combination arrays
-    combination_arrays = {}
-    for array_folder in array_folders:
-        combination_arrays[array_folder] = hp.make_combination_array(genome_dict, intra_only=False)
-        ah.import_combination_arrays(combination_arrays[array_folder], array_folder)
+        def load_and_merge():
+            # Create and fill combination arrays
+            combination_arrays = {}
+            for array_folder in array_folders:
+                combination_arrays[array_folder] = hp.make_combination_array(genome_dict, intra_only=False)
+                ah.import_combination_arrays(combination_arrays[array_folder], array_folder)
+                merge_stage.count("arrays", len(combination_arrays[array_folder]))
+            # Merge combination arrays
+            return ah.combine_arrays(combination_arrays, **MERGE_PARAMETERS)
 
-    # Merge combination arrays
-    merged_combination_arrays = ah.combine_arrays(combination_arrays)
+        def load_merged(folder):
+            return ah.import_combination_arrays(
+                hp.make_combination_array(genome_dict, intra_only=False), folder
+            )
+
+        # Merged arrays of the same arrays are reused from the cache
+        merged_combination_arrays = ch.cached(
+            "merged_arrays",
+            array_files,
+            MERGE_PARAMETERS,
+            compute=load_and_merge,
+            save=ah.save_combination_arrays,
+            load=load_merged,
+            stage=merge_stage,
+        )
+        merge_stage.count("samples", len(array_folders))
 
     # Save merged combination arrays
-    ah.save_combination_arrays(merged_combination_arrays, output)
+    with mh.stage("save") as save_stage:
+        ah.save_combination_arrays(merged_combination_arrays, output)
+        save_stage.count("arrays", len(merged_combination_arrays))
+
+    mh.write_metrics(output)
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
@@ -5,16 +5,19 @@
 Takes an arbitrary number of count tables and merge the columns into one csv
 
 Usage:
-  merge_counttable.py <count_table>... -o <output_file>
+  merge_counttable.py <count_table>... -o <output_file> [--threads=<threads>]
 
 Options:
   -h --help                                 Show this screen.
   <count_table>                             The count tables to merge.
   -o --output=<output_file>
+  --threads=<threads>                       Number of count tables to read at once [default: 1].
 """
 
 from docopt import docopt
 import pandas as pd
+import helper as hp
+import metrics_handler as mh
 
 
 def check_first_column(count_tables):
@@ -24,52 +27,46 @@ def check_first_column(count_tables):
     Parameters
     ----------
     count_tables : list
-        A list containing the count tables.
+        A list containing the count tables, read with the first column as index.
 
     Returns
     -------
     bool
         True if the first column of all count tables are the same, False otherwise.
     """
-    # Get the first column of the first count table
-    first_column = pd.read_csv(count_tables[0], sep="\t", usecols=[0]).iloc[:, 0]
-
-    # Iterate over all count tables
-    for count_table in count_tables[1:]:
-        # Get the first column of the count table
-        first_column_tmp = pd.read_csv(
-            count_table, sep="\t", usecols=[0]
-        ).iloc[:, 0]
-
-        # Check if the first column of the count table is the same as the first column of the first count table
-        if not first_column.equals(first_column_tmp):
-            return False
-
-    return True
+    first_column = count_tables[0].index
+    return all(count_table.index.equals(first_column) for count_table in count_tables[1:])
 
 
 def main():
     args = docopt(__doc__)
     count_tables = args["<count_table>"]
     output_file = args["--output"]
+    threads = int(args["--threads"])
+
+    # Read all count tables
+    with mh.stage("load") as load_stage:
+        count_tables = hp.read_tables(count_tables, threads=threads, sep="\t", index_col=0)
+        load_stage.count("tables", len(count_tables))
 
     # Check if the first column of all count tables are the same
     if not check_first_column(count_tables):
         raise ValueError("The first column of all count tables has to be the same.")
-    
-    # Read the first count table
-    count_table = pd.read_csv(count_tables[0], sep="\t", index_col=0)
-
-    # Iterate over all count tables
-    for count_table_tmp in count_tables[1:]:
-        # Read the count table
-        count_table_tmp = pd.read_csv(count_table_tmp, sep="\t", index_col=0)
 
-        # Merge the count table
-        count_table = count_table.join(count_table_tmp)
+    # Merge the columns of all count tables at once
+    with mh.stage("merge") as merge_stage:
+        count_table = pd.concat(count_tables, axis=1)
+        # concat keeps columns of the same name side by side, a join refused them
+        duplicated_columns = count_table.columns[count_table.columns.duplicated()]
+        if len(duplicated_columns):
+            raise ValueError(f"The count tables share the columns {', '.join(map(str, duplicated_columns.unique()))}.")
+        merge_stage.count("rows", len(count_table))
 
     # Write the count table
-    count_table.to_csv(output_file, sep="\t")
+    with mh.stage("save"):
+        count_table.to_csv(output_file, sep="\t")
+
+    mh.write_metrics(output_file)
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
@@ -1,11 +1,54 @@
 #!/usr/bin/env python3
 
+"""merge_peak_tables.py
+
+Merges the peak tables of several samples. From the peak table of each alias
+only the peaks where both 01type and 02type are that alias are kept.
+
+Usage:
+    merge_peak_tables.py <alias_peak_table>... -o <output_file>
+    merge_peak_tables.py -h | --help
+
+Options:
+    -h --help                   Show this screen.
+    <alias_peak_table>          The peak tables to merge, each given as
+                                <alias>=<peak_table>, e.g. WyNAwt=WyNAwt_correct_peak_cells.tsv
+    -o --output=<output_file>   The output filepath.
+
+"""
+
+from docopt import docopt
+import os
 import pandas as pd
+import metrics_handler as mh
+
+
+def parse_alias_peak_tables(alias_peak_tables):
+    """
+    Parse the <alias>=<peak_table> arguments
+
+    Parameters
+    ----------
+    alias_peak_tables : list
+        The <alias>=<peak_table> arguments
+
+    Returns
+    -------
+    alias_dict : dict
+        A dictionary with the aliases as keys and the filepaths as values
+    """
+    alias_dict = {}
+    for alias_peak_table in alias_peak_tables:
+        alias, separator, filepath = alias_peak_table.partition("=")
+        if not separator or not alias or not filepath:
+            raise ValueError(
+                f"Peak tables have to be given as <alias>=<peak_table>, got {alias_peak_table}"
+            )
+        if alias in alias_dict:
+            raise ValueError(f"The alias {alias} is given more than once!")
+        alias_dict[alias] = filepath
+    return alias_dict
 
-alias_dict = {
-    "WyNAwt": "/home/ru27wav/Projects/gl_iav-splash_freiburg/results/schwemmle_group/20230218/WyNAwt_correct_peak_cells.tsv",
-    "WyNA_Udsub": "/home/ru27wav/Projects/gl_iav-splash_freiburg/results/schwemmle_group/20230218/WyNAUdsub_correct_peak_cells.tsv",
-}
 
 def merge_peak_tables(alias_dict, output_file):
     """
@@ -22,39 +65,48 @@ def merge_peak_tables(alias_dict, output_file):
     for alias, filepath in alias_dict.items():
         # Read the peak table
         df_dict[alias] = pd.read_csv(filepath, sep="\t")
+    first_df = next(iter(df_dict.values()))
 
     # Check if the headers are the same for all peak tables
-    for alias, df in df_dict.items():
-        if not df.columns.equals(df_dict["WyNAwt"].columns):
-            raise ValueError("The headers of the peak tables are not the same!")
+    if not all(df.columns.equals(first_df.columns) for df in df_dict.values()):
+        raise ValueError("The headers of the peak tables are not the same!")
 
     # Check if the first 9 columns (I am counting index as column 0) are the same for all peak tables
-    for alias, df in df_dict.items():
-        if not df.iloc[:, :9].equals(df_dict["WyNAwt"].iloc[:, :9]):
-            raise ValueError("The first 8 columns of the peak tables are not the same!")
-
-    # Create an empty dataframe with the same columns as the peak tables
-    merged_df = pd.DataFrame(columns=df_dict["WyNAwt"].columns)
-
-    # For each alias check if "01type" and "02type" are the same as the alias
-    for alias, df in df_dict.items():
-        # Iterate over the rows
-        for index, row in df.iterrows():
-            # Check if the "01type" and "02type" are both the same as the alias
-            if row["01type"] == alias and row["02type"] == alias:
-                # The frame.append method is deprecated and will be removed from pandas in a 
-                # future version. Use pandas.concat instead.
-                # merged_df.append(row)
-                # make sure to keep the index
-                merged_df = pd.concat([merged_df, pd.DataFrame(row).T], ignore_index=False)
-            elif row["01type"] != row["02type"]:
-                raise ValueError("The 01type and 02type are not the same!")
+    if not all(df.iloc[:, :9].equals(first_df.iloc[:, :9]) for df in df_dict.values()):
+        raise ValueError("The first 8 columns of the peak tables are not the same!")
+
+    # Check if "01type" and "02type" are the same for all peaks
+    if any((df["01type"] != df["02type"]).any() for df in df_dict.values()):
+        raise ValueError("The 01type and 02type are not the same!")
+
+    # For each alias keep the peaks where "01type" and "02type" are the alias
+    merged_df = pd.concat(
+        [
+            df[(df["01type"] == alias) & (df["02type"] == alias)]
+            for alias, df in df_dict.items()
+        ]
+    )
 
     # Write the sorted merged peak table (sort using the id column)
-    merged_df.sort_values(by=["id"]).to_csv(output_file, sep="\t", index=False)
+    merged_df.sort_values(by=["id"], kind="stable").to_csv(output_file, sep="\t", index=False)
+
 
 def main():
-    merge_peak_tables(alias_dict, "/home/ru27wav/Projects/gl_iav-splash_freiburg/results/schwemmle_group/20230218/PR8-Wy_merged_peak_tables.tsv")
+    args = docopt(__doc__)
+    alias_dict = parse_alias_peak_tables(args["<alias_peak_table>"])
+    output_file = args["--output"]
+
+    # Check if the output directory exists, if not create it
+    output_dir = os.path.dirname(output_file)
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+
+    with mh.stage("merge") as merge_stage:
+        merge_peak_tables(alias_dict, output_file)
+        merge_stage.count("tables", len(alias_dict))
+
+    mh.write_metrics(output_file)
+
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
@@ -0,0 +1,291 @@
+"""metrics_handler.py
+
+Per-stage instrumentation for the scripts in bin/. A stage records its wall
+time, CPU time (including finished child processes, e.g. of a mp.Pool), the
+resident set size and item counts:
+
+    with mh.stage("fill") as fill_stage:
+        ...
+        fill_stage.count("reads", number_of_reads)
+
+The stages of a script are written to one metrics JSON next to its outputs
+with write_metrics, these can be aggregated across samples with
+aggregate_metrics.py.
+
+The scripts run their main function through run_main, which profiles it when
+the script is given --profile or the RNASWARM_PROFILE environment variable is
+set (to 1, or to the folder to write the profiles to). The profile of a script
+is written to the task folder as <script>.pstats, of the deterministic
+profiler, and <script>.collapsed, stacks sampled every few milliseconds of CPU
+time in the collapsed format of flamegraph.pl and speedscope. Only the main
+process is profiled, not the workers of a mp.Pool.
+"""
+
+import cProfile
+import json
+import os
+import platform
+import resource
+import signal
+import sys
+import time
+from collections import Counter
+from contextlib import contextmanager
+from functools import wraps
+
+PROFILE_FLAG = "--profile"
+PROFILE_VARIABLE = "RNASWARM_PROFILE"
+SAMPLING_INTERVAL = 0.005
+
+_start_wall_time = time.perf_counter()
+_stages = []
+
+
+class Stage:
+    """A named stage of a script, with counts of the items it processed."""
+
+    def __init__(self, name):
+        self.name = name
+        self.counts = {}
+
+    def count(self, item, number=1):
+        """Adds number to the count of item."""
+        self.counts[item] = self.counts.get(item, 0) + number
+
+
+def get_cpu_time():
+    """Returns the CPU time (user and system) of this process and its finished
+    children, in seconds.
+    """
+    times = os.times()
+    return times.user + times.system + times.children_user + times.children_system
+
+
+def get_peak_rss_mb(who=resource.RUSAGE_SELF):
+    """Returns the peak resident set size in MiB, of this process or (with
+    resource.RUSAGE_CHILDREN) of its largest finished child.
+    """
+    peak_rss = resource.getrusage(who).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in KiB elsewhere
+    if sys.platform == "darwin":
+        return peak_rss / 1024**2
+    return peak_rss / 1024
+
+
+def get_rss_mb():
+    """Returns the current resident set size in MiB, None if it is unknown."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / 1024**2
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+@contextmanager
+def stage(name):
+    """Records a stage of the script.
+
+    Parameters
+    ----------
+    name : str
+        Name of the stage, e.g. parse, fill or save.
+
+    Yields
+    ------
+    Stage
+        The stage, to count the items processed in it.
+    """
+    record = Stage(name)
+    start_wall_time = time.perf_counter()
+    start_cpu_time = get_cpu_time()
+    try:
+        yield record
+    finally:
+        wall_time = time.perf_counter() - start_wall_time
+        _stages.append(
+            {
+                "name": record.name,
+                "wall_time": wall_time,
+                "cpu_time": get_cpu_time() - start_cpu_time,
+                "rss_mb": get_rss_mb(),
+                "peak_rss_mb": get_peak_rss_mb(),
+                "peak_children_rss_mb": get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+                "counts": record.counts,
+                "throughput": {
+                    item: number / wall_time for item, number in record.counts.items()
+                } if wall_time else {},
+            }
+        )
+
+
+def timed(name=None):
+    """Decorator recording each call of a function as a stage.
+
+    Parameters
+    ----------
+    name : str, optional
+        Name of the stage, by default the name of the function.
+    """
+
+    def decorator(function):
+        @wraps(function)
+        def wrapper(*args, **kwargs):
+            with stage(name or function.__name__):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_metrics():
+    """Returns the metrics of the script so far.
+
+    Returns
+    -------
+    dict
+        The script, its arguments, the host and the recorded stages.
+    """
+    return {
+        "script": os.path.basename(sys.argv[0]),
+        "arguments": sys.argv[1:],
+        "host": platform.node(),
+        "python": platform.python_version(),
+        "wall_time": time.perf_counter() - _start_wall_time,
+        "cpu_time": get_cpu_time(),
+        "peak_rss_mb": get_peak_rss_mb(),
+        "peak_children_rss_mb": get_peak_rss_mb(resource.RUSAGE_CHILDREN),
+        "stages": list(_stages),
+    }
+
+
+def get_metrics_file(output):
+    """Returns the metrics filepath for an output of the script: inside an
+    output folder, the metrics are named after the script, next to an output
+    file they are named after the file.
+
+    Parameters
+    ----------
+    output : str
+        An output file or folder of the script.
+
+    Returns
+    -------
+    str
+        The metrics filepath.
+    """
+    if os.path.isdir(output):
+        script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "metrics"
+        return os.path.join(output, f"{script}.metrics.json")
+    return f"{os.path.splitext(output)[0]}.metrics.json"
+
+
+def write_metrics(output):
+    """Writes the metrics of the script next to one of its outputs.
+
+    Parameters
+    ----------
+    output : str
+        An output file or folder of the script.
+
+    Returns
+    -------
+    str
+        The metrics filepath.
+    """
+    metrics_file = get_metrics_file(output)
+    with open(metrics_file, "w") as metrics:
+        json.dump(get_metrics(), metrics, indent=2)
+    return metrics_file
+
+
+class StackSampler:
+    """Samples the stack of the main thread at a fixed interval of CPU time."""
+
+    def __init__(self, interval=SAMPLING_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._previous_handler = None
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        """Starts sampling, if the platform has a CPU time interval timer."""
+        if hasattr(signal, "SIGPROF"):
+            self._previous_handler = signal.signal(signal.SIGPROF, self._sample)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+
+    def stop(self):
+        """Stops sampling."""
+        if hasattr(signal, "SIGPROF"):
+            signal.setitimer(signal.ITIMER_PROF, 0)
+            signal.signal(signal.SIGPROF, self._previous_handler or signal.SIG_DFL)
+
+    def write(self, path):
+        """Writes the sampled stacks in the collapsed format, one stack per
+        line from the outermost frame, followed by its number of samples.
+        """
+        with open(path, "w") as collapsed:
+            for stack, samples in self.stacks.most_common():
+                collapsed.write(f"{stack} {samples}\n")
+
+
+def get_profile_folder(argv=None):
+    """Returns the folder to write the profile of the script to, None if the
+    script is not profiled. Removes the --profile flag from the arguments,
+    so that the script does not have to know about it.
+
+    Parameters
+    ----------
+    argv : list, optional
+        The arguments of the script, by default sys.argv.
+
+    Returns
+    -------
+    str
+        The profile folder or None.
+    """
+    argv = sys.argv if argv is None else argv
+    profile = PROFILE_FLAG in argv[1:]
+    while PROFILE_FLAG in argv[1:]:
+        argv.remove(PROFILE_FLAG)
+    variable = os.environ.get(PROFILE_VARIABLE, "0")
+    if variable not in ("0", "1"):
+        return variable
+    if profile or variable == "1":
+        return os.getcwd()
+    return None
+
+
+def run_main(main):
+    """Runs the main function of a script, profiled if the script is given
+    --profile or RNASWARM_PROFILE is set.
+
+    Parameters
+    ----------
+    main : function
+        The main function of the script.
+    """
+    profile_folder = get_profile_folder()
+    if profile_folder is None:
+        return main()
+    os.makedirs(profile_folder, exist_ok=True)
+    script = os.path.splitext(os.path.basename(sys.argv[0]))[0] or "profile"
+    profiler = cProfile.Profile()
+    sampler = StackSampler()
+    sampler.start()
+    profiler.enable()
+    try:
+        return main()
+    finally:
+        profiler.disable()
+        sampler.stop()
+        profiler.dump_stats(os.path.join(profile_folder, f"{script}.pstats"))
+        sampler.write(os.path.join(profile_folder, f"{script}.collapsed"))
+        print(f"Profile written to {profile_folder}/{script}.pstats and .collapsed", file=sys.stderr)
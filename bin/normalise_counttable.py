@@ -6,7 +6,7 @@ Normalises the count table by dividing the counts by the total number mapped
 reads.
 
 Usage:
-    normalise_counttable.py <samples_table> -c <count_table> --output=<output_repository>
+    normalise_counttable.py <samples_table> -c <count_table> --output=<output_repository> [--mode=<mode>]
     normalise_counttable.py -h | --help
 
 Options:
@@ -14,13 +14,17 @@ Options:
     <samples_table>                         The samples table filepath.
     -c <count_table>                        The count table filepath.
     --output=<output_repository>            The output repository.
+    --mode=<mode>                           The normalisation mode, one of RPM, CPM,
+                                            TMM or fraction [default: RPM].
 
 """
 
 from docopt import docopt
+import numpy as np
 import pandas as pd
 import os
 import sys
+import metrics_handler as mh
 
 def parse_samples_table(samples_table):
     """
@@ -65,6 +69,120 @@ def parse_count_table(count_table):
     count_table = pd.read_csv(count_table, sep="\t", index_col=0)
     return count_table
 
+def resolve_library_sizes(columns, samples_dict):
+    """
+    Resolves the library size of each count table column. Column names are
+    looked up in the samples table first by exact name and then by sample
+    names contained in the column name. When several sample names are
+    contained in a column name, the longest one wins as long as it contains
+    all the others (e.g. "sample1" and "sample10" for "sample10.trns.txt").
+
+    Parameters
+    ----------
+    columns : iterable
+        The column names of the count table.
+
+    samples_dict : dict
+        A dictionary containing the sample names and the library sizes.
+
+    Returns
+    -------
+    pandas.Series
+        The library sizes, indexed by column name.
+    """
+    library_sizes = {}
+    for column in columns:
+        # Exact matches are resolved through the dictionary index.
+        if column in samples_dict:
+            library_sizes[column] = int(samples_dict[column])
+            continue
+        # Otherwise, look for sample names that are substrings of the column.
+        matches = [key for key in samples_dict if key in column]
+        # Drop matches which are themselves contained in a longer match.
+        matches = [
+            key
+            for key in matches
+            if not any(key != other and key in other for other in matches)
+        ]
+        if not matches:
+            sys.exit(f"ERROR: Sample {column} not found in samples table.")
+        if len(matches) > 1:
+            sys.exit(
+                f"ERROR: Sample {column} is ambiguous, it matches the samples "
+                f"{', '.join(sorted(matches))} in the samples table."
+            )
+        library_sizes[column] = int(samples_dict[matches[0]])
+    return pd.Series(library_sizes, dtype="float64")
+
+
+def calculate_tmm_factors(count_table, library_sizes, logratio_trim=0.3, sum_trim=0.05):
+    """
+    Calculates TMM (trimmed mean of M-values) normalisation factors, following
+    the procedure of edgeR's calcNormFactors. The sample whose upper quartile
+    is closest to the mean upper quartile is used as reference.
+
+    Parameters
+    ----------
+    count_table : pandas.DataFrame
+        The count table.
+
+    library_sizes : numpy.ndarray
+        The library sizes, in the same order as the count table columns.
+
+    logratio_trim : float, optional
+        The fraction of M-values to trim on each side, by default 0.3
+
+    sum_trim : float, optional
+        The fraction of A-values to trim on each side, by default 0.05
+
+    Returns
+    -------
+    numpy.ndarray
+        The normalisation factors, scaled to have a geometric mean of 1.
+    """
+    counts = count_table.to_numpy(dtype="float64")
+    proportions = counts / library_sizes
+    upper_quartiles = np.quantile(proportions, 0.75, axis=0)
+    reference = np.argmin(np.abs(upper_quartiles - upper_quartiles.mean()))
+    reference_counts = counts[:, [reference]]
+    reference_size = library_sizes[reference]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # M-values (log ratios) and A-values (absolute expression levels)
+        log_reference = np.log2(reference_counts / reference_size)
+        log_samples = np.log2(proportions)
+        m_values = log_samples - log_reference
+        a_values = (log_samples + log_reference) / 2
+        # Asymptotic variances, used as inverse weights
+        variances = (library_sizes - counts) / library_sizes / counts + (
+            reference_size - reference_counts
+        ) / reference_size / reference_counts
+    valid = np.isfinite(m_values) & np.isfinite(a_values)
+
+    factors = np.ones(counts.shape[1])
+    for sample in range(counts.shape[1]):
+        m_sample = m_values[valid[:, sample], sample]
+        a_sample = a_values[valid[:, sample], sample]
+        v_sample = variances[valid[:, sample], sample]
+        n_values = len(m_sample)
+        if n_values == 0:
+            continue
+        # Ranks are used to trim both tails of the M- and A-values.
+        m_ranks = m_sample.argsort().argsort() + 1
+        a_ranks = a_sample.argsort().argsort() + 1
+        keep = (
+            (m_ranks >= np.floor(n_values * logratio_trim) + 1)
+            & (m_ranks <= n_values + 1 - np.floor(n_values * logratio_trim) - 1)
+            & (a_ranks >= np.floor(n_values * sum_trim) + 1)
+            & (a_ranks <= n_values + 1 - np.floor(n_values * sum_trim) - 1)
+        )
+        if keep.any():
+            factors[sample] = 2 ** (
+                np.sum(m_sample[keep] / v_sample[keep]) / np.sum(1 / v_sample[keep])
+            )
+    return factors / np.exp(np.mean(np.log(factors)))
+
+
 def normalise_count_table(count_table, samples_dict, mode="RPM"):
     """
     Normalises the count table by dividing the counts by the total number mapped
@@ -75,36 +193,38 @@ def normalise_count_table(count_table, samples_dict, mode="RPM"):
     count_table : pandas.DataFrame
         The count table.
 
-    total_reads : int
-        The total number of mapped reads.
+    samples_dict : dict
+        A dictionary containing the sample names and the library sizes.
 
     mode : str, optional
-        The normalisation mode, by default "RPM"
+        The normalisation mode, by default "RPM". Options are "RPM" and "CPM"
+        (counts per million mapped reads), "TMM" (counts per million, with the
+        library sizes scaled by TMM normalisation factors) and "fraction"
+        (counts divided by the library size).
 
     Returns
     -------
     pandas.DataFrame
         The normalised count table.
     """
-    # For each column get the corresponding library size and divide the counts
-    # by the library size.
-    for column in count_table.columns:
-        # Check if the sample_name is a substring of the column name.
-        # if no key is found in the whole dictionary, raise an error.
-        for key, value in samples_dict.items():
-            if key in column:
-                # Get the library size.
-                library_size = value
-                # Divide the counts by the library size.
-                count_table[column] = count_table[column].div(int(library_size))
-                break
-        else:
-            sys.exit(f"ERROR: Sample {column} not found in samples table.")
-    # If the normalisation mode is RPM.
-    if mode == "RPM":
-        # Multiply the counts by 1,000,000.
-        count_table = count_table.mul(1e6)
-    return count_table
+    # Get the library size of each column once, in column order.
+    library_sizes = resolve_library_sizes(count_table.columns, samples_dict)
+    library_sizes = library_sizes.to_numpy()
+    # Get the scaling of each column.
+    if mode in ("RPM", "CPM"):
+        scaling = library_sizes / 1e6
+    elif mode == "TMM":
+        scaling = library_sizes * calculate_tmm_factors(count_table, library_sizes) / 1e6
+    elif mode == "fraction":
+        scaling = library_sizes
+    else:
+        sys.exit(f"ERROR: Normalisation mode {mode} is not supported.")
+    # Divide all columns by their scaling at once.
+    return pd.DataFrame(
+        count_table.to_numpy(dtype="float64") / scaling,
+        index=count_table.index,
+        columns=count_table.columns,
+    )
 
 def write_count_table(count_table, normalised_count_table_df, output_repository):
     """
@@ -147,12 +267,20 @@ def main():
     # Get the count table filepath.
     count_table = args["-c"]
     # Parse the count table.
-    count_table_df = parse_count_table(count_table)
+    with mh.stage("load") as load_stage:
+        count_table_df = parse_count_table(count_table)
+        load_stage.count("rows", len(count_table_df))
     # Normalise the count table.
-    normalised_count_table_df = normalise_count_table(count_table_df, samples_dict)
+    with mh.stage("normalise"):
+        normalised_count_table_df = normalise_count_table(
+            count_table_df, samples_dict, mode=args["--mode"]
+        )
     # Write the normalised count table to a file.
-    write_count_table(count_table, normalised_count_table_df, output_repository)
+    with mh.stage("save"):
+        write_count_table(count_table, normalised_count_table_df, output_repository)
+
+    mh.write_metrics(output_repository)
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
 
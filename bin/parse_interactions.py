@@ -30,6 +30,8 @@ Options:
 from docopt import docopt
 import os
 import pandas as pd
+import helper as hp
+import metrics_handler as mh
 
 
 def parse_interactions(annotation_table, genome, output_file, complement=False, peaks=False):
@@ -114,18 +116,9 @@ def read_genome(genome):
     Returns
     -------
     genome : dict
-        Dictionary of sequences.
+        Dictionary of sequences, see helper.parse_fasta.
     """
-    genome_dict = {}
-    with open(genome, "r") as f:
-        for line in f:
-            if line.startswith(">"):
-                segment = line.strip().split()[0][1:]
-                genome_dict[segment] = ""
-            else:
-                genome_dict[segment] += line.strip()
-
-    return genome_dict
+    return hp.parse_fasta(genome)
 
 
 def main():
@@ -138,8 +131,11 @@ def main():
     output_file = os.path.abspath(arguments["--output"])
 
     # Parse interactions
-    parse_interactions(annotation_table, genome, output_file, complement=arguments["--complement"], peaks=arguments["--peaks"])
+    with mh.stage("parse"):
+        parse_interactions(annotation_table, genome, output_file, complement=arguments["--complement"], peaks=arguments["--peaks"])
+
+    mh.write_metrics(output_file)
 
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
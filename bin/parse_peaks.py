@@ -4,6 +4,7 @@
 
 This script takes an annotation table, a genome file (fasta format) and one or more trns files, and returns a table with the annotation and the peak base pair for each interaction.
 The annotation table must have the following columns: id,segment01,start01,end01,segment02,start02,end02
+Instead of trns files, folders of (merged) combination arrays can be given, these are memory-mapped.
 
 Usage:
     parse_peaks.py <input_file> <input_file>... -a <annotation_table> -g <genome> -o <output_file>
@@ -13,7 +14,8 @@ Usage:
 Options:
     -h --help                                 Show this screen.
     <input_file>                              The input files to process, 
-                                              has to be a trns file generated by segemehl.
+                                              has to be a trns file generated by segemehl
+                                              or a folder of combination arrays.
     -a --annotation_table=<annotation_table>  The annotation table filepath.
     -g --genome=<genome>                      The genome filepath.
     -o --output=<output_file>                 The output directory.
@@ -24,71 +26,88 @@ import os
 import numpy as np
 import pandas as pd
 import helper as hp
-import trns_handler as th
 import array_handler as ah
+import fill_arrays as fa
+import metrics_handler as mh
 
 
-def get_peak_cell_from_annotation_table(combination_arrays, annotation):
+def get_peak_cells(combination_arrays, annotation_table):
     """
-    Get the peak cell of the interaction matrix from the annotation table.
+    Get the peak cells of the interaction matrices for all annotations of the
+    annotation table. The annotations are grouped by segment combination and
+    the peak cells of each group are computed together.
 
     Parameters
     ----------
-    combination_arrays : dict
-        A dictionary of arrays, with the keys being the combination of segments.
+    combination_arrays : list
+        A list of dictionaries of arrays, with the keys being the combination
+        of segments. The arrays of all dictionaries are summed.
 
-    annotation : pandas.DataFrame
+    annotation_table : pandas.DataFrame
         The annotation data frame.
 
     Returns
     -------
-    dict
-        A dictionary of peak cells, with the keys being the combination of segments.
+    pandas.DataFrame
+        The peak cells (segment01_peak, segment02_peak, value_peak), with the
+        index of the annotation table.
     """
-    segment_combination = (annotation["segment01"], annotation["segment02"])
-    segment_1_start = int(annotation["start01"])
-    segment_1_end = int(annotation["end01"])
-    segment_2_start = int(annotation["start02"])
-    segment_2_end = int(annotation["end02"])
-
-    if (
-        segment_combination not in combination_arrays
-        and (segment_combination[::-1]) not in combination_arrays
-    ):
-        raise ValueError("Combination not found")
-
-    if segment_combination in combination_arrays:
-        combination_array = combination_arrays[segment_combination]
-        region_of_interest = combination_array[
-            segment_1_start:segment_1_end, segment_2_start:segment_2_end
-        ]
-        segment1_peak, segment2_peak = np.unravel_index(
-            np.argmax(region_of_interest), region_of_interest.shape
-        )
-    else:
-        segment_combination = segment_combination[::-1]
-        combination_array = combination_arrays[segment_combination]
-        region_of_interest = combination_array[
-            segment_2_start:segment_2_end, segment_1_start:segment_1_end
-        ]
-        segment2_peak, segment1_peak = np.unravel_index(
-            np.argmax(region_of_interest), region_of_interest.shape
-        )
-
-    peak_cell_value = np.max(region_of_interest)
-    peak_dict = {
-        "segment01_peak": segment1_peak + segment_1_start,
-        "segment02_peak": segment2_peak + segment_2_start,
-        "value_peak": peak_cell_value,
-    }
-    if (
-        peak_cell_value
-        != combination_array[peak_dict["segment01_peak"], peak_dict["segment02_peak"]]
-    ):
-        raise ValueError(
-            "The value of the peak cell is not the same as the value of the cell in the peak_cell_coordinates"
-        )
-    return peak_dict
+    segment01_peaks = np.zeros(len(annotation_table), dtype=np.int64)
+    segment02_peaks = np.zeros(len(annotation_table), dtype=np.int64)
+    value_peaks = np.zeros(len(annotation_table))
+    starts01 = annotation_table["start01"].to_numpy(dtype=np.int64)
+    ends01 = annotation_table["end01"].to_numpy(dtype=np.int64)
+    starts02 = annotation_table["start02"].to_numpy(dtype=np.int64)
+    ends02 = annotation_table["end02"].to_numpy(dtype=np.int64)
+
+    groups = annotation_table.groupby(["segment01", "segment02"], sort=False).indices
+    for segment_combination, positions in groups.items():
+        segment_combination = tuple(segment_combination)
+        reverse_combination = segment_combination not in combination_arrays[0]
+        if not reverse_combination:
+            row_starts, row_ends = starts01[positions], ends01[positions]
+            column_starts, column_ends = starts02[positions], ends02[positions]
+        elif segment_combination[::-1] in combination_arrays[0]:
+            segment_combination = segment_combination[::-1]
+            row_starts, row_ends = starts02[positions], ends02[positions]
+            column_starts, column_ends = starts01[positions], ends01[positions]
+        else:
+            raise ValueError("Combination not found")
+        arrays = [arrays[segment_combination] for arrays in combination_arrays]
+
+        # Regions may run past the edges of the arrays (e.g. mean ± sigma·std),
+        # the starts are clamped and the peaks taken from the clipped regions
+        row_starts = np.maximum(row_starts, 0)
+        column_starts = np.maximum(column_starts, 0)
+        # Only the regions are read from the (memory-mapped) arrays
+        row_peaks = np.zeros(len(positions), dtype=np.int64)
+        column_peaks = np.zeros(len(positions), dtype=np.int64)
+        for i, (row_start, row_end, column_start, column_end) in enumerate(
+            zip(row_starts, row_ends, column_starts, column_ends)
+        ):
+            region_of_interest = sum(
+                array[row_start:row_end, column_start:column_end] for array in arrays
+            )
+            row_peak, column_peak = np.unravel_index(
+                np.argmax(region_of_interest), region_of_interest.shape
+            )
+            row_peaks[i] = row_peak + row_start
+            column_peaks[i] = column_peak + column_start
+            value_peaks[positions[i]] = region_of_interest[row_peak, column_peak]
+
+        if reverse_combination:
+            row_peaks, column_peaks = column_peaks, row_peaks
+        segment01_peaks[positions] = row_peaks
+        segment02_peaks[positions] = column_peaks
+
+    return pd.DataFrame(
+        {
+            "segment01_peak": segment01_peaks,
+            "segment02_peak": segment02_peaks,
+            "value_peak": value_peaks,
+        },
+        index=annotation_table.index,
+    )
 
 
 def main():
@@ -115,34 +134,31 @@ def main():
 
     # Parse genome file
     genome_dict = hp.parse_fasta(genome)
-    combination_arrays = {}
-
-    for trns_file in input_files:
-        # Get the name of the current trns file
-        trns_file_name = os.path.basename(trns_file)
-        trns_file_name = trns_file_name.split(".")[0]
-
-        # Create and fill combination arrays
-        combination_arrays[trns_file_name] = hp.make_combination_array(genome_dict)
-        th.segemehlTrans2heatmap(trns_file, combination_arrays[trns_file_name])
-
-    # Merge combination arrays
-    merged_combination_arrays = ah.combine_arrays(
-        combination_arrays, normalise_array=False
-    )
+    combination_arrays = []
+
+    with mh.stage("load") as load_stage:
+        for input_file in input_files:
+            if os.path.isdir(input_file):
+                # Memory-map precomputed or merged combination arrays
+                combination_arrays.append(
+                    ah.import_combination_arrays(
+                        hp.make_combination_array(genome_dict), input_file, mmap_mode="r"
+                    )
+                )
+            else:
+                # Create and fill combination arrays, or reuse the arrays
+                # fill_arrays.py cached for the same trns file
+                combination_arrays.append(
+                    fa.fill_trns_file(input_file, genome, genome_dict, stage=load_stage)[0]
+                )
 
     # Check the peak cell for each annotation
-    peak_cell_dict = {}
-    for index, row in annotation_table.iterrows():
-        peak_cel = get_peak_cell_from_annotation_table(merged_combination_arrays, row)
-        peak_cell_dict[index] = peak_cel
-        # make peak cell dict into a dataframe
-        peak_cell_df = pd.DataFrame.from_dict(peak_cell_dict, orient="index")
+    with mh.stage("peaks") as peaks_stage:
+        peak_cell_df = get_peak_cells(combination_arrays, annotation_table)
+        peaks_stage.count("annotations", len(annotation_table))
 
     # Merge the peak cell data frame with the annotation table
-    merged_df = pd.merge(
-        annotation_table, peak_cell_df, left_index=True, right_index=True
-    )
+    merged_df = pd.concat([annotation_table, peak_cell_df], axis=1)
 
     # Check if the output directory exists, if not create it
     if not os.path.exists(args["--output"]):
@@ -154,6 +170,8 @@ def main():
     output_file = args["--output"] + "/" + output_file + "_peak_cells.tsv"
     merged_df.to_csv(output_file, sep="\t")
 
+    mh.write_metrics(output_file)
+
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
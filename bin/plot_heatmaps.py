@@ -3,8 +3,8 @@
 """plot_heatmaps.py
 
 Usage:
-    plot_heatmaps.py -t <trns_file>... -g <genome> [-a <annotation_table> --intra_only] -o <output_folder>
-    plot_heatmaps.py -d <array_dir> -g <genome> [-a <annotation_table> --intra_only] -o <output_folder>
+    plot_heatmaps.py -t <trns_file>... -g <genome> [-a <annotation_table> --intra_only --threads=<threads> --max_pixels=<max_pixels> --downsample_mode=<mode> --incremental] -o <output_folder>
+    plot_heatmaps.py -d <array_dir> -g <genome> [-a <annotation_table> --intra_only --threads=<threads> --max_pixels=<max_pixels> --downsample_mode=<mode> --incremental] -o <output_folder>
 
 Options:
     -h --help                                 Show this screen.
@@ -14,26 +14,53 @@ Options:
     -o --output=<output_folder>               The output folder.
     -a --annotation_table=<annotation_table>  The annotation table filepath.
     --intra_only                              Only plot intra-segment interactions.
+    --threads=<threads>                       Number of processes used to render the plots,
+                                              defaults to the cores allocated to the task.
+    --max_pixels=<max_pixels>                 Pool arrays with more cells per side than max_pixels
+                                              down to at most max_pixels before plotting.
+    --downsample_mode=<mode>                  How cells are pooled, max or sum [default: max].
+    --incremental                             Store the signature of the inputs of each heatmap in a
+                                              <plot>.json next to it and only redraw the heatmaps whose
+                                              array, regions or plot parameters changed since the last
+                                              run into the same output folder.
 """
 
 from docopt import docopt
 import os
+import json
+import hashlib
 import numpy as np
 import pandas as pd
+import multiprocessing as mp
+import matplotlib
+
+matplotlib.use("Agg")
 import matplotlib.pyplot as plt
 from matplotlib.patches import Rectangle
 import helper as hp
 import trns_handler as th
 import array_handler as ah
-import helper as hp
+import metrics_handler as mh
 
 
 def plot_heatmaps(
-    combination_array, plots_folder, color_palette="PiYG", regions=None
+    combination_array,
+    plots_folder,
+    color_palette="PiYG",
+    regions=None,
+    threads=1,
+    max_pixels=None,
+    downsample_mode="max",
+    incremental=False,
 ):
     """
     Plot heatmaps for manual fitting of GMMs
 
+    The raw and log10 heatmaps of every combination are rendered as
+    independent tasks, in a pool of `threads` processes. In incremental mode,
+    the signature of the inputs of each heatmap is stored next to it, and
+    heatmaps whose signature did not change are not redrawn.
+
     Parameters
     ----------
     combination_array : dict
@@ -42,33 +69,296 @@ def plot_heatmaps(
         Path to folder where plots should be saved
     color_palette : str
         color palette to use for plotting
+    regions : pandas.DataFrame, optional
+        A table containing the annotations for the rectangular regions, by default None
+    threads : int, optional
+        Number of processes used to render the plots, by default 1
+    max_pixels : int, optional
+        Pool arrays with more cells per side than max_pixels down to at most
+        max_pixels cells per side before plotting, by default None
+    downsample_mode : str, optional
+        How cells are pooled, "max" or "sum", by default "max"
+    incremental : bool, optional
+        Skip heatmaps whose array, regions and plot parameters did not change,
+        by default False
 
     Returns
-
     -------
-    None
+    int
+        Number of heatmaps drawn, heatmaps skipped as unchanged are not counted
     """
-    for combination in combination_array.keys():
-        # Plot raw heatmap
-        plot_heatmap(
-            combination_array[combination],
+    tasks = [
+        (
+            combination,
             plots_folder,
             color_palette,
-            combination,
-            colorbar_label="read count",
-            regions=regions,
+            log10,
+            max_pixels,
+            downsample_mode,
+            incremental,
         )
+        for combination in combination_array.keys()
+        for log10 in (False, True)
+    ]
+    if threads > 1 and len(tasks) > 1:
+        # The arrays and regions are handed to each worker once, tasks only
+        # carry the combination to plot
+        with mp.Pool(
+            min(threads, len(tasks)),
+            initializer=_init_plot_worker,
+            initargs=(combination_array, regions),
+        ) as pool:
+            return sum(pool.imap_unordered(_plot_heatmap_task, tasks))
+    _init_plot_worker(combination_array, regions)
+    return sum(_plot_heatmap_task(task) for task in tasks)
+
+
+# Arrays and regions shared with the worker processes of plot_heatmaps
+_worker_arrays = None
+_worker_regions = None
+
+
+def _init_plot_worker(combination_array, regions):
+    """
+    Initialise a worker process of plot_heatmaps
+    """
+    global _worker_arrays, _worker_regions
+    _worker_arrays = combination_array
+    _worker_regions = regions
+
 
+def _plot_heatmap_task(task):
+    """
+    Plot the raw or log10 transformed heatmap of a single combination
+
+    Parameters
+    ----------
+    task : tuple
+        Combination, plots folder, color palette, whether to log10 transform the
+        data, maximum number of pixels per side, downsampling mode and whether
+        to skip unchanged heatmaps
+
+    Returns
+    -------
+    bool
+        False if the heatmap was skipped as unchanged, True otherwise
+    """
+    (
+        combination,
+        plots_folder,
+        color_palette,
+        log10,
+        max_pixels,
+        downsample_mode,
+        incremental,
+    ) = task
+    combination_array = _worker_arrays[combination]
+    regions = get_regions_subset(_worker_regions, combination)
+    # Skip the heatmap if it was drawn from the same inputs before
+    if incremental:
+        output_name = get_output_name(
+            combination, get_plot_suffix("_log10" if log10 else "", regions)
+        )
+        signature = get_plot_signature(
+            combination_array,
+            regions,
+            {
+                "color_palette": color_palette,
+                "log10": log10,
+                "max_pixels": max_pixels,
+                "downsample_mode": downsample_mode,
+            },
+        )
+        if is_plot_up_to_date(plots_folder, output_name, signature):
+            return False
+    # Pool large arrays before plotting, the log10 transformation is applied
+    # to the pooled cells
+    scale = 1
+    if max_pixels:
+        combination_array, scale = ah.downsample_array(
+            combination_array, max_pixels, mode=downsample_mode
+        )
+    if log10:
         # Plot log10 transformed data
         plot_heatmap(
-            np.log10(combination_array[combination] + 1),
+            np.log10(combination_array + 1),
             plots_folder,
             color_palette,
             combination,
             colorbar_label="log10(read count + 1)",
             suffix="_log10",
             regions=regions,
+            scale=scale,
+        )
+    else:
+        # Plot raw heatmap
+        plot_heatmap(
+            combination_array,
+            plots_folder,
+            color_palette,
+            combination,
+            colorbar_label="read count",
+            regions=regions,
+            scale=scale,
         )
+    if incremental:
+        write_plot_signature(plots_folder, output_name, signature)
+    return True
+
+
+def get_regions_subset(regions, combination):
+    """
+    Get the regions which are annotated on the heatmap of a combination.
+
+    Parameters
+    ----------
+    regions : pandas.DataFrame
+        A table containing the annotations for the rectangular regions, or None
+    combination : tuple
+        Tuple of combination
+
+    Returns
+    -------
+    pandas.DataFrame
+        The regions of the combination, in either orientation, or None
+    """
+    if regions is None:
+        return None
+    is_subset = (
+        (regions["segment01"] == combination[0]) & (regions["segment02"] == combination[1])
+    ) | ((regions["segment01"] == combination[1]) & (regions["segment02"] == combination[0]))
+    return regions[is_subset]
+
+
+def get_plot_signature(combination_array, regions, parameters, block_bytes=64 * 1024**2):
+    """
+    Get the signature of the inputs of a heatmap: a hash of the array content,
+    a hash of the regions and the plot parameters. The array is hashed in
+    bands of rows, so memory-mapped arrays are never fully loaded.
+
+    Parameters
+    ----------
+    combination_array : np.ndarray
+        Array representing the heatmap data
+    regions : pandas.DataFrame
+        The regions annotated on the heatmap, or None
+    parameters : dict
+        The plot parameters
+    block_bytes : int, optional
+        The approximate number of bytes hashed at once, by default 64 MiB
+
+    Returns
+    -------
+    dict
+        The signature of the heatmap
+    """
+    array_hash = hashlib.sha256(
+        f"{combination_array.dtype.str}{combination_array.shape}".encode()
+    )
+    row_bytes = max(1, combination_array[:1].nbytes)
+    rows_per_band = max(1, block_bytes // row_bytes)
+    for band_start in range(0, combination_array.shape[0], rows_per_band):
+        band = combination_array[band_start : band_start + rows_per_band]
+        array_hash.update(np.ascontiguousarray(band).tobytes())
+    if regions is None:
+        regions_hash = None
+    else:
+        regions_hash = hashlib.sha256(regions.to_csv(index=False).encode()).hexdigest()
+    return {
+        "array": array_hash.hexdigest(),
+        "regions": regions_hash,
+        "parameters": parameters,
+    }
+
+
+def is_plot_up_to_date(plots_folder, output_name, signature):
+    """
+    Check if a heatmap was drawn from inputs with the given signature.
+
+    Parameters
+    ----------
+    plots_folder : str
+        Path to folder where plots are saved
+    output_name : str
+        Name of the output files, without extension
+    signature : dict
+        The signature of the heatmap
+
+    Returns
+    -------
+    bool
+        True if the heatmap files exist and their stored signature is the same
+    """
+    signature_file = os.path.join(plots_folder, f"{output_name}.json")
+    for extension in ("json", "pdf", "svg"):
+        if not os.path.exists(os.path.join(plots_folder, f"{output_name}.{extension}")):
+            return False
+    with open(signature_file) as handle:
+        try:
+            return json.load(handle) == signature
+        except json.JSONDecodeError:
+            return False
+
+
+def write_plot_signature(plots_folder, output_name, signature):
+    """
+    Store the signature of a heatmap next to it.
+
+    Parameters
+    ----------
+    plots_folder : str
+        Path to folder where plots are saved
+    output_name : str
+        Name of the output files, without extension
+    signature : dict
+        The signature of the heatmap
+
+    Returns
+    -------
+    None
+    """
+    with open(os.path.join(plots_folder, f"{output_name}.json"), "w") as handle:
+        json.dump(signature, handle, indent=2)
+
+
+def get_plot_suffix(suffix: str, regions: pd.DataFrame = None) -> str:
+    """
+    Get the suffix of the output files of a heatmap.
+
+    Parameters
+    ----------
+    suffix : str
+        Suffix for the output file
+    regions : pandas.DataFrame, optional
+        The regions annotated on the heatmap, by default None
+
+    Returns
+    -------
+    str
+        The suffix, marking the heatmap as annotated or unannotated
+    """
+    if regions is not None:
+        return f"{suffix}_annotated"
+    return f"{suffix}_unannotated"
+
+
+def get_output_name(combination: tuple, suffix: str) -> str:
+    """
+    Get the name of the output files of a heatmap, without extension.
+
+    Parameters
+    ----------
+    combination : tuple
+        Tuple of combination
+    suffix : str
+        Suffix for the output file
+
+    Returns
+    -------
+    str
+        The name of the output files
+    """
+    return f"{combination[0]}_{combination[1]}{suffix}"
 
 
 def plot_heatmap(
@@ -79,6 +369,7 @@ def plot_heatmap(
     regions: pd.DataFrame = None,
     colorbar_label: str = "read count",
     suffix: str = "",
+    scale: int = 1,
 ) -> None:
     """
     Plot heatmap from a given combination.
@@ -99,6 +390,9 @@ def plot_heatmap(
         Label for colorbar, by default "Read counts"
     suffix : str, optional
         Suffix for the output file, by default ""
+    scale : int, optional
+        Number of cells of the original array per cell of combination_array,
+        for downsampled arrays, by default 1
 
     Returns
     -------
@@ -106,21 +400,19 @@ def plot_heatmap(
     """
     ax = plt.gca()
     plt.imshow(combination_array, cmap=color_palette)
-    set_ticks_and_grid(combination_array, ax)
+    set_ticks_and_grid(combination_array, ax, scale=scale)
     plt.colorbar(label=colorbar_label)
     plt.xlabel(f"{combination[1]}")
     plt.ylabel(f"{combination[0]}")
     if regions is not None:
-        suffix = f"{suffix}_annotated"
-        annotate_regions(ax, combination, regions)
-    else:
-        suffix = f"{suffix}_unannotated"
+        annotate_regions(ax, combination, regions, scale=scale)
+    suffix = get_plot_suffix(suffix, regions)
     save_plot(plots_folder, combination, suffix)
 
     plt.close()
 
 
-def set_ticks_and_grid(combination_array: np.ndarray, ax: plt.Axes) -> None:
+def set_ticks_and_grid(combination_array: np.ndarray, ax: plt.Axes, scale: int = 1) -> None:
     """
     Set ticks, grid and tick parameters for the given axis.
 
@@ -130,15 +422,18 @@ def set_ticks_and_grid(combination_array: np.ndarray, ax: plt.Axes) -> None:
         Array representing the heatmap data
     ax : plt.Axes
         Axis to set ticks and grid
+    scale : int, optional
+        Number of cells of the original array per cell of combination_array,
+        tick labels are given in original coordinates, by default 1
 
     Returns
     -------
     None
     """
     ax.set_xticks(np.arange(0, combination_array.shape[1], 25))
-    ax.set_xticklabels(np.arange(0, combination_array.shape[1], 25), rotation=90)
+    ax.set_xticklabels(np.arange(0, combination_array.shape[1], 25) * scale, rotation=90)
     ax.set_yticks(np.arange(0, combination_array.shape[0], 25))
-    ax.set_yticklabels(np.arange(0, combination_array.shape[0], 25))
+    ax.set_yticklabels(np.arange(0, combination_array.shape[0], 25) * scale)
     ax.tick_params(
         axis="both", which="major", labelsize=3, labeltop=True, labelright=True
     )
@@ -146,7 +441,9 @@ def set_ticks_and_grid(combination_array: np.ndarray, ax: plt.Axes) -> None:
     ax.grid(which="major", axis="y", linestyle="-", linewidth="0.05", color="grey")
 
 
-def annotate_regions(ax: plt.Axes, combination: tuple, regions: pd.DataFrame) -> None:
+def annotate_regions(
+    ax: plt.Axes, combination: tuple, regions: pd.DataFrame, scale: int = 1
+) -> None:
     """
     Annotate the regions on the given axis based on the combination.
 
@@ -158,6 +455,9 @@ def annotate_regions(ax: plt.Axes, combination: tuple, regions: pd.DataFrame) ->
         Tuple of combination
     regions : pandas.DataFrame
         A table containing the annotations for the rectangular regions
+    scale : int, optional
+        Number of cells of the original array per plotted cell, region
+        coordinates are divided by it, by default 1
 
     Returns
     -------
@@ -167,12 +467,15 @@ def annotate_regions(ax: plt.Axes, combination: tuple, regions: pd.DataFrame) ->
         if region.segment01 == combination[0] and region.segment02 == combination[1]:
             ax.add_patch(
                 create_rectangle(
-                    region.start01, region.start02, region.end01, region.end02
+                    region.start01 / scale,
+                    region.start02 / scale,
+                    region.end01 / scale,
+                    region.end02 / scale,
                 )
             )
             ax.text(
-                get_center(region.start02, region.end02),
-                get_center(region.start01, region.end01),
+                get_center(region.start02 / scale, region.end02 / scale),
+                get_center(region.start01 / scale, region.end01 / scale),
                 region.id,
                 color="black",
                 fontsize=4,
@@ -182,12 +485,15 @@ def annotate_regions(ax: plt.Axes, combination: tuple, regions: pd.DataFrame) ->
         elif region.segment01 == combination[1] and region.segment02 == combination[0]:
             ax.add_patch(
                 create_rectangle(
-                    region.start02, region.start01, region.end02, region.end01
+                    region.start02 / scale,
+                    region.start01 / scale,
+                    region.end02 / scale,
+                    region.end01 / scale,
                 )
             )
             ax.text(
-                get_center(region.start01, region.end01),
-                get_center(region.start02, region.end02),
+                get_center(region.start01 / scale, region.end01 / scale),
+                get_center(region.start02 / scale, region.end02 / scale),
                 region.id,
                 color="black",
                 fontsize=4,
@@ -263,18 +569,18 @@ def save_plot(plots_folder: str, combination: tuple, suffix: str) -> None:
     None
     """
     plt.savefig(
-        os.path.join(plots_folder, f"{combination[0]}_{combination[1]}{suffix}.pdf"),
+        os.path.join(plots_folder, f"{get_output_name(combination, suffix)}.pdf"),
         format="pdf",
     )
     plt.savefig(
-        os.path.join(plots_folder, f"{combination[0]}_{combination[1]}{suffix}.svg"),
+        os.path.join(plots_folder, f"{get_output_name(combination, suffix)}.svg"),
         format="svg",
     )
 
 
 
 def prepare_arrays(
-    array_dir=None, intra_only=True, genome_dict=None
+    array_dir=None, intra_only=True, genome_dict=None, mmap_mode=None
 ):
     """
     Prepare arrays for plotting and merge them.
@@ -287,6 +593,9 @@ def prepare_arrays(
         If True, only intra-chromosomal interactions are considered
     genome_dict : dict
         Dictionary of genome segments
+    mmap_mode : str, optional
+        If given, the arrays are memory-mapped with this mode instead of being
+        read into memory
 
     Returns
     -------
@@ -304,7 +613,7 @@ def prepare_arrays(
         combination_array = hp.make_combination_array(
             genome_dict, intra_only=intra_only
         )
-        ah.import_combination_arrays(combination_array, array_dir)
+        ah.import_combination_arrays(combination_array, array_dir, mmap_mode=mmap_mode)
     return combination_array
 
 
@@ -328,6 +637,18 @@ def main():
     if args["--intra_only"]:
         intra_only = True
 
+    # Get the number of processes used to render the plots
+    if args["--threads"]:
+        threads = int(args["--threads"])
+    else:
+        threads = hp.get_available_cpus()
+
+    # Check if the arrays should be downsampled before plotting
+    max_pixels = None
+    if args["--max_pixels"]:
+        max_pixels = int(args["--max_pixels"])
+    downsample_mode = args["--downsample_mode"]
+
     # check if --annotation_table is given
     if args["--annotation_table"]:
         annotation_table = args["--annotation_table"]
@@ -339,33 +660,51 @@ def main():
         os.makedirs(output_folder)
 
     # Process input files
-    genome_dict = hp.parse_fasta(genome_file)
-
-    if args.get("--array_dir"):
-        array_dir = args.get("--array_dir")
-        combination_array = prepare_arrays(
-            array_dir=array_dir,
-            intra_only=intra_only,
-            genome_dict=genome_dict,
-        )
+    with mh.stage("load") as load_stage:
+        genome_dict = hp.parse_fasta(genome_file)
+
+        if args.get("--array_dir"):
+            array_dir = args.get("--array_dir")
+            combination_array = prepare_arrays(
+                array_dir=array_dir,
+                intra_only=intra_only,
+                genome_dict=genome_dict,
+                mmap_mode="r" if max_pixels else None,
+            )
+            load_stage.count("arrays", len(combination_array))
 
     # Define color palettes
     color_palette = "Greens"
 
     # Plot heatmaps
-    if annotation_table is not None:
-        regions = hp.parse_annotation_table(annotation_table)
-        plot_heatmaps(
-            combination_array,
-            output_folder,
-            color_palette=color_palette,
-            regions=regions,
-        )
-    else:
-        plot_heatmaps(
-            combination_array, output_folder, color_palette=color_palette
-        )
+    with mh.stage("plot") as plot_stage:
+        if annotation_table is not None:
+            regions = hp.parse_annotation_table(annotation_table)
+            heatmaps = plot_heatmaps(
+                combination_array,
+                output_folder,
+                color_palette=color_palette,
+                regions=regions,
+                threads=threads,
+                max_pixels=max_pixels,
+                downsample_mode=downsample_mode,
+                incremental=args["--incremental"],
+            )
+        else:
+            heatmaps = plot_heatmaps(
+                combination_array,
+                output_folder,
+                color_palette=color_palette,
+                threads=threads,
+                max_pixels=max_pixels,
+                downsample_mode=downsample_mode,
+                incremental=args["--incremental"],
+            )
+        plot_stage.count("heatmaps", heatmaps)
+        plot_stage.count("skipped_heatmaps", 2 * len(combination_array) - heatmaps)
+
+    mh.write_metrics(output_folder)
 
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""predict_structures.py
+
+Predicts the RNA-RNA structures of the annotated interactions with RNAduplex
+or RNAcofold and merges the energies and structures back into the annotation
+table. Takes the fasta files written by annotation_table_to_viennaRNA_input.py,
+the sequences are batched and each batch is streamed through its own RNAduplex
+or RNAcofold process, with one process per core. Predictions are cached by the
+hash of the sequence pair, so that only new pairs are predicted on reruns.
+
+Usage:
+    predict_structures.py <fasta_file>... -a <annotation_table> -o <output_file> [--program=<program>] [--binary=<binary>] [--threads=<threads>] [--batch_size=<batch_size>] [--cache=<cache_file>]
+    predict_structures.py -h | --help
+
+Options:
+    -h --help                           Show this screen.
+    <fasta_file>                        Fasta files written by annotation_table_to_viennaRNA_input.py.
+    -a --annotation=<annotation_table>  The annotation table the fasta files were written from.
+    -o --output=<output_file>           The annotation table with the predicted structures.
+    --program=<program>                 RNAduplex or RNAcofold [default: RNAduplex].
+    --binary=<binary>                   The executable to run, defaults to the program.
+    --threads=<threads>                 Number of cores to use, defaults to the cores
+                                        allocated to the task.
+    --batch_size=<batch_size>           Number of sequence pairs per process [default: 1000].
+    --cache=<cache_file>                Cache of previous predictions [default: .structure_cache.json]
+
+"""
+
+from docopt import docopt
+import deduplicate_annotations as da
+import helper as hp
+import metrics_handler as mh
+import hashlib
+import json
+import multiprocessing as mp
+import os
+import re
+import subprocess
+import pandas as pd
+from pathlib import Path
+
+
+PROGRAMS = ["RNAduplex", "RNAcofold"]
+
+# RNAduplex:  .((((...&..))))  1,5  :  3,8  (-5.30)
+DUPLEX_PATTERN = re.compile(
+    r"^(\S+)\s+(\d+),(\d+)\s+:\s+(\d+),(\d+)\s+\(\s*([-+]?\d+(?:\.\d+)?)\)"
+)
+# RNAcofold:  .((((...&..)))) ( -5.30)
+COFOLD_PATTERN = re.compile(r"^(\S+)\s+\(\s*([-+]?\d+(?:\.\d+)?)\)")
+
+
+def read_viennaRNA_input(fasta_file):
+    """Reads a fasta file written by annotation_table_to_viennaRNA_input.py
+
+    Args:
+        fasta_file (str): The fasta file, a header and two sequences per record.
+
+    Returns:
+        dict: The sequence pair of each annotation index.
+    """
+    sequences = {}
+    with open(fasta_file) as file:
+        lines = [line.strip() for line in file if line.strip()]
+    for header, sequence01, sequence02 in zip(lines[0::3], lines[1::3], lines[2::3]):
+        if not header.startswith(">"):
+            raise ValueError(f"Malformed record {header} in {fasta_file}")
+        sequences[header[1:]] = (sequence01, sequence02)
+    return sequences
+
+
+def get_pair_key(program, sequence01, sequence02):
+    """Gets the cache key of a sequence pair
+
+    Args:
+        program (str): RNAduplex or RNAcofold.
+        sequence01 (str): The first sequence.
+        sequence02 (str): The second sequence.
+
+    Returns:
+        str: The sha256 hash of the program and sequence pair.
+    """
+    return hashlib.sha256(f"{program}\n{sequence01}&{sequence02}".encode()).hexdigest()
+
+
+def format_batch(program, pairs):
+    """Formats a batch of sequence pairs as input for RNAduplex or RNAcofold
+
+    Args:
+        program (str): RNAduplex or RNAcofold.
+        pairs (list): The sequence pairs.
+
+    Returns:
+        str: The program input, records are named by their position in the batch.
+    """
+    if program == "RNAcofold":
+        return "".join(
+            f">{i}\n{sequence01}&{sequence02}\n"
+            for i, (sequence01, sequence02) in enumerate(pairs)
+        )
+    return "".join(
+        f">{i}\n{sequence01}\n{sequence02}\n"
+        for i, (sequence01, sequence02) in enumerate(pairs)
+    )
+
+
+def parse_prediction(line):
+    """Parses a RNAduplex or RNAcofold result line
+
+    Args:
+        line (str): The result line.
+
+    Returns:
+        dict: The structure, energy and, for RNAduplex, the interacting
+            positions in each sequence (1-based, inclusive).
+    """
+    match = DUPLEX_PATTERN.match(line)
+    if match:
+        structure, start01, end01, start02, end02, energy = match.groups()
+        return {
+            "structure": structure,
+            "position_seq01": f"{start01},{end01}",
+            "position_seq02": f"{start02},{end02}",
+            "energy": float(energy),
+        }
+    match = COFOLD_PATTERN.match(line)
+    if match:
+        structure, energy = match.groups()
+        return {
+            "structure": structure,
+            "position_seq01": None,
+            "position_seq02": None,
+            "energy": float(energy),
+        }
+    return None
+
+
+def parse_output(output, batch_length):
+    """Parses the output of a RNAduplex or RNAcofold run
+
+    Args:
+        output (str): The program output.
+        batch_length (int): Number of records in the batch.
+
+    Returns:
+        list: The prediction of each record of the batch.
+    """
+    predictions = [None] * batch_length
+    record = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line.startswith(">"):
+            record = int(line[1:].split()[0])
+        elif record is not None:
+            prediction = parse_prediction(line)
+            if prediction is not None:
+                predictions[record] = prediction
+    return predictions
+
+
+def predict_batch(arguments):
+    """Predicts the structures of a batch of sequence pairs, to be used with
+    mp.Pool.map
+
+    Args:
+        arguments (tuple): The program, the binary and the sequence pairs.
+
+    Returns:
+        list: The prediction of each sequence pair.
+    """
+    program, binary, pairs = arguments
+    command = [binary]
+    if program == "RNAcofold":
+        command.append("--noPS")
+    result = subprocess.run(
+        command,
+        input=format_batch(program, pairs),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return parse_output(result.stdout, len(pairs))
+
+
+def predict_structures(pairs, program="RNAduplex", binary=None, threads=1, batch_size=1000, cache=None):
+    """Predicts the structures of sequence pairs which are not yet cached
+
+    Args:
+        pairs (dict): The sequence pair of each cache key.
+        program (str): RNAduplex or RNAcofold.
+        binary (str): The executable to run, defaults to the program.
+        threads (int): Number of processes to run at once.
+        batch_size (int): Number of sequence pairs per process.
+        cache (dict): Previous predictions, updated in place.
+
+    Returns:
+        dict: The prediction of each cache key.
+    """
+    if cache is None:
+        cache = {}
+    binary = binary or program
+    keys = [key for key in pairs if key not in cache]
+    batches = [keys[i : i + batch_size] for i in range(0, len(keys), batch_size)]
+    tasks = [(program, binary, [pairs[key] for key in batch]) for batch in batches]
+    if tasks:
+        with mp.Pool(max(1, min(threads, len(tasks)))) as pool:
+            results = pool.map(predict_batch, tasks)
+        for batch, predictions in zip(batches, results):
+            for key, prediction in zip(batch, predictions):
+                if prediction is not None:
+                    cache[key] = prediction
+    return {key: cache.get(key) for key in pairs}
+
+
+def get_column_suffix(fasta_file):
+    """Gets the suffix of the result columns of a fasta file, e.g. _extended_5
+    for genome_annotations_extended_5.fasta and no suffix for
+    genome_annotations.fasta
+
+    Args:
+        fasta_file (str): The fasta file.
+
+    Returns:
+        str: The column suffix.
+    """
+    stem = Path(fasta_file).stem
+    if "_annotations" in stem:
+        return stem.rsplit("_annotations", 1)[1]
+    return f"_{stem}"
+
+
+def load_cache(cache_file):
+    """Loads the prediction cache
+
+    Args:
+        cache_file (str): Cache file.
+
+    Returns:
+        dict: Cached predictions, keyed by sequence pair hash.
+    """
+    if cache_file and os.path.exists(cache_file):
+        with open(cache_file) as cache:
+            try:
+                return json.load(cache)
+            except json.JSONDecodeError:
+                return {}
+    return {}
+
+
+def main():
+    args = docopt(__doc__)
+    fasta_files = args["<fasta_file>"]
+    program = args["--program"]
+    if program not in PROGRAMS:
+        raise ValueError(f"The program has to be one of the following: {', '.join(PROGRAMS)}")
+    if args["--threads"]:
+        threads = int(args["--threads"])
+    else:
+        threads = hp.get_available_cpus()
+    cache_file = args["--cache"]
+
+    annotation_table_df = da.parse_annotation_table(args["--annotation"])
+    cache = load_cache(cache_file)
+
+    # Collect the sequence pairs of all fasta files, predicting each one once
+    records = {}
+    pairs = {}
+    for fasta_file in fasta_files:
+        records[fasta_file] = {}
+        for index, (sequence01, sequence02) in read_viennaRNA_input(fasta_file).items():
+            key = get_pair_key(program, sequence01, sequence02)
+            records[fasta_file][index] = key
+            pairs[key] = (sequence01, sequence02)
+    with mh.stage("predict") as predict_stage:
+        cached_pairs = sum(key in cache for key in pairs)
+        predictions = predict_structures(
+            pairs,
+            program=program,
+            binary=args["--binary"],
+            threads=threads,
+            batch_size=int(args["--batch_size"]),
+            cache=cache,
+        )
+        predict_stage.count("sequence_pairs", len(pairs) - cached_pairs)
+        predict_stage.count("cached_sequence_pairs", cached_pairs)
+    if cache_file:
+        with open(cache_file, "w") as cache_handle:
+            json.dump(cache, cache_handle)
+
+    # Merge the predictions into the annotation table
+    for fasta_file, keys in records.items():
+        suffix = get_column_suffix(fasta_file)
+        results = pd.DataFrame.from_dict(
+            {
+                index: predictions[key]
+                or {"structure": None, "position_seq01": None, "position_seq02": None, "energy": None}
+                for index, key in keys.items()
+            },
+            orient="index",
+        )
+        results.index = results.index.astype(annotation_table_df.index.dtype)
+        annotation_table_df = annotation_table_df.join(results.add_suffix(suffix))
+
+    output_dir = os.path.dirname(args["--output"])
+    if output_dir and not os.path.exists(output_dir):
+        os.makedirs(output_dir)
+    annotation_table_df.to_csv(args["--output"], sep="\t", index=False)
+
+    mh.write_metrics(args["--output"])
+
+
+if __name__ == "__main__":
+    mh.run_main(main)
@@ -0,0 +1,332 @@
+#!/usr/bin/env python3
+
+"""resource_planner.py
+
+Plans how the combination arrays are held while they are filled. Each segment
+pair is kept dense in memory, sparse (the corners of the filled rectangles,
+see array_handler.SparseArray) or as a memory-mapped .npy file on disk,
+whichever keeps the arrays within the memory budget of the task. A dense
+array takes 8 bytes per cell, a sparse one 96 bytes per interaction, so
+sparse pays off for large segments with few reads.
+
+Given a samples CSV (sample,fastq,genome,group) it prints the estimated
+memory and disk use of filling the arrays of each sample and of merging the
+arrays of each group, to size the SLURM requests before submitting. The
+number of reads is estimated from the size of the fastq files.
+
+Usage:
+    resource_planner.py <samples_csv> [--memory=<memory>] [--chimeric_fraction=<fraction>] [--intra_only]
+    resource_planner.py -h | --help
+
+Options:
+    -h --help                           Show this screen.
+    <samples_csv>                       The samples CSV of the pipeline.
+    --memory=<memory>                   Memory budget per task, e.g. 8G [default: 8G].
+    --chimeric_fraction=<fraction>      Expected fraction of the reads which are
+                                        chimeric [default: 1.0].
+    --intra_only                        Plan the intra-segment arrays.
+
+"""
+
+from docopt import docopt
+import gzip
+import os
+import numpy as np
+import helper as hp
+import array_handler as ah
+import metrics_handler as mh
+
+DENSE = "dense"
+SPARSE = "sparse"
+MEMMAP = "memmap"
+# Memory of the interpreter and the imported modules
+BASE_MEMORY = 256 * 1024**2
+# Share of the remaining memory given to the arrays, the rest is left to the
+# profiles, the parsing and the saving
+ARRAY_MEMORY_FRACTION = 0.75
+
+
+def estimate_number_of_lines(filepath, sample_lines=10000):
+    """
+    Estimate the number of lines of a (possibly gzipped) text file from the
+    size of its first lines.
+
+    Parameters
+    ----------
+    filepath : str
+        The file.
+    sample_lines : int, optional
+        Number of lines to measure.
+
+    Returns
+    -------
+    int
+        The estimated number of lines.
+    """
+    file_size = os.path.getsize(filepath)
+    if filepath.endswith(".gz"):
+        with open(filepath, "rb") as raw_file, gzip.open(raw_file, "rt") as file:
+            lines = sum(1 for _, _ in zip(range(sample_lines), file))
+            # Compressed bytes read for the sampled lines
+            sample_size = raw_file.tell()
+    else:
+        with open(filepath, "rb") as file:
+            lines = 0
+            sample_size = 0
+            for _, line in zip(range(sample_lines), file):
+                lines += 1
+                sample_size += len(line)
+    if lines < sample_lines or sample_size >= file_size:
+        return lines
+    return int(round(lines * file_size / sample_size))
+
+
+def get_array_estimates(segment_lengths, combinations, number_of_interactions, intra_only=False):
+    """
+    Estimate the dense and sparse memory of the array of each segment pair.
+    The interactions are assumed to spread over the pairs by their area.
+
+    Parameters
+    ----------
+    segment_lengths : dict
+        The length of each segment, see helper.get_segment_lengths.
+    combinations : list
+        The segment pairs, see helper.get_segment_combinations.
+    number_of_interactions : int
+        Expected number of interactions (at most the number of reads).
+    intra_only : bool, optional
+        Whether the arrays are intra-segment arrays, which are filled twice
+        per interaction.
+
+    Returns
+    -------
+    dict
+        The dense_bytes, sparse_bytes and expected interactions of each pair.
+    """
+    areas = {
+        combination: segment_lengths[combination[0]] * segment_lengths[combination[1]]
+        for combination in combinations
+    }
+    total_area = sum(areas.values()) or 1
+    estimates = {}
+    for combination, area in areas.items():
+        interactions = number_of_interactions * area / total_area
+        rectangles = 2 * interactions if intra_only else interactions
+        estimates[combination] = {
+            "dense_bytes": area * np.dtype(np.float64).itemsize,
+            "sparse_bytes": int(rectangles * ah.SparseArray.BYTES_PER_RECTANGLE),
+            "interactions": int(interactions),
+        }
+    return estimates
+
+
+def plan_arrays(estimates, memory_budget):
+    """
+    Choose the representation of each array. Arrays are dense unless they
+    exceed the budget, then the arrays saving the most memory become sparse
+    and, if that is not enough, the largest remaining arrays are memory-mapped.
+
+    Parameters
+    ----------
+    estimates : dict
+        The estimates of each pair, see get_array_estimates.
+    memory_budget : int
+        The memory budget of the task in bytes, None for no limit.
+
+    Returns
+    -------
+    dict
+        The representation (dense, sparse or memmap) of each pair.
+    """
+    plan = {combination: DENSE for combination in estimates}
+    if memory_budget is None:
+        return plan
+    budget = max(memory_budget - BASE_MEMORY, 0) * ARRAY_MEMORY_FRACTION
+    memory = sum(estimate["dense_bytes"] for estimate in estimates.values())
+
+    by_saving = sorted(
+        estimates,
+        key=lambda combination: estimates[combination]["dense_bytes"] - estimates[combination]["sparse_bytes"],
+        reverse=True,
+    )
+    for combination in by_saving:
+        if memory <= budget:
+            return plan
+        estimate = estimates[combination]
+        if estimate["sparse_bytes"] < estimate["dense_bytes"]:
+            plan[combination] = SPARSE
+            memory -= estimate["dense_bytes"] - estimate["sparse_bytes"]
+
+    # Memory-mapped arrays only take the page cache, which the kernel can evict
+    by_memory = sorted(
+        estimates,
+        key=lambda combination: estimates[combination][f"{plan[combination]}_bytes"],
+        reverse=True,
+    )
+    for combination in by_memory:
+        if memory <= budget:
+            break
+        memory -= estimates[combination][f"{plan[combination]}_bytes"]
+        plan[combination] = MEMMAP
+    return plan
+
+
+def get_resident_memory(estimates, plan):
+    """
+    Returns the estimated memory of the arrays in bytes under a plan.
+    """
+    return sum(
+        estimates[combination][f"{representation}_bytes"]
+        for combination, representation in plan.items()
+        if representation != MEMMAP
+    )
+
+
+def make_combination_array(genome_dict, plan, memmap_folder=None, intra_only=False):
+    """
+    Creates the combination arrays as helper.make_combination_array does,
+    each in the representation of the plan.
+
+    Parameters
+    ----------
+    genome_dict : dict
+        Dictionary of segment names and sequences.
+    plan : dict
+        The representation of each pair, see plan_arrays.
+    memmap_folder : str, optional
+        The folder of the memory-mapped arrays, required if the plan has any.
+    intra_only : bool, optional
+        Create the intra-segment instead of the inter-segment arrays.
+
+    Returns
+    -------
+    dict
+        Dictionary of numpy arrays, numpy memmaps and array_handler.SparseArrays.
+    """
+    combination_arrays = {}
+    for combination in hp.get_segment_combinations(genome_dict, intra_only=intra_only):
+        shape = (len(genome_dict[combination[0]]), len(genome_dict[combination[1]]))
+        representation = plan.get(combination, DENSE)
+        if representation == SPARSE:
+            combination_arrays[combination] = ah.SparseArray(shape)
+        elif representation == MEMMAP:
+            combination_arrays[combination] = np.lib.format.open_memmap(
+                os.path.join(memmap_folder, f"{combination[0]}-{combination[1]}.npy"),
+                mode="w+",
+                dtype=np.float64,
+                shape=shape,
+            )
+        else:
+            combination_arrays[combination] = np.zeros(shape)
+    return combination_arrays
+
+
+def find_file(filepath, samples_csv):
+    """
+    Find a file of the samples CSV, relative paths are tried from the working
+    directory and from the folder of the samples CSV.
+    """
+    for candidate in (filepath, os.path.join(os.path.dirname(samples_csv), filepath)):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def plan_samples(samples_csv, memory_budget, chimeric_fraction=1.0, intra_only=False):
+    """
+    Estimate the resources of filling the arrays of each sample of a samples
+    CSV and of merging the arrays of each group.
+
+    Parameters
+    ----------
+    samples_csv : str
+        The samples CSV, one sample,fastq,genome,group line per sample.
+    memory_budget : int
+        The memory budget per task in bytes.
+    chimeric_fraction : float, optional
+        Expected fraction of the reads which are chimeric.
+    intra_only : bool, optional
+        Plan the intra-segment arrays.
+
+    Returns
+    -------
+    pandas.DataFrame
+        One row per fill and merge task.
+    """
+    import pandas as pd
+
+    samples = pd.read_csv(samples_csv, header=None, names=["sample", "fastq", "genome", "group"])
+    rows = []
+    array_bytes = {}
+    for sample in samples.itertuples(index=False):
+        genome_file = find_file(sample.genome, samples_csv)
+        if genome_file is None:
+            print(f"WARNING: genome {sample.genome} of {sample.sample} not found, skipped")
+            continue
+        genome_dict = hp.parse_fasta(genome_file)
+        fastq_file = find_file(sample.fastq, samples_csv)
+        if fastq_file is None:
+            print(f"WARNING: reads {sample.fastq} of {sample.sample} not found, assuming no reads")
+            reads = 0
+        else:
+            reads = estimate_number_of_lines(fastq_file) // 4
+        estimates = get_array_estimates(
+            hp.get_segment_lengths(genome_dict),
+            hp.get_segment_combinations(genome_dict, intra_only=intra_only),
+            int(reads * chimeric_fraction),
+            intra_only=intra_only,
+        )
+        plan = plan_arrays(estimates, memory_budget)
+        dense_bytes = sum(estimate["dense_bytes"] for estimate in estimates.values())
+        array_bytes[sample.group] = array_bytes.get(sample.group, []) + [dense_bytes]
+        rows.append(
+            {
+                "task": "fill_arrays",
+                "name": sample.sample,
+                "reads": reads,
+                "pairs": len(plan),
+                DENSE: sum(representation == DENSE for representation in plan.values()),
+                SPARSE: sum(representation == SPARSE for representation in plan.values()),
+                MEMMAP: sum(representation == MEMMAP for representation in plan.values()),
+                "memory_mb": (BASE_MEMORY + get_resident_memory(estimates, plan)) / 1024**2,
+                "disk_mb": dense_bytes / 1024**2,
+            }
+        )
+    # Merging loads the arrays of all samples of a group and the merged arrays
+    for group, sample_bytes in array_bytes.items():
+        rows.append(
+            {
+                "task": "merge_arrays",
+                "name": group,
+                "reads": None,
+                "pairs": None,
+                DENSE: None,
+                SPARSE: None,
+                MEMMAP: None,
+                "memory_mb": (BASE_MEMORY + sum(sample_bytes) + max(sample_bytes)) / 1024**2,
+                "disk_mb": max(sample_bytes) / 1024**2,
+            }
+        )
+    return pd.DataFrame(rows)
+
+
+def main():
+    args = docopt(__doc__)
+    memory_budget = hp.parse_size(args["--memory"])
+    resources = plan_samples(
+        args["<samples_csv>"],
+        memory_budget,
+        chimeric_fraction=float(args["--chimeric_fraction"]),
+        intra_only=args["--intra_only"],
+    )
+    print(resources.to_string(index=False, float_format="{:.0f}".format, na_rep="-"))
+    if not resources.empty:
+        print(
+            f"\nLargest task: {resources['memory_mb'].max():.0f} MiB of memory"
+            f" (budget {memory_budget / 1024**2:.0f} MiB),"
+            f" {resources['disk_mb'].sum():.0f} MiB of arrays on disk"
+        )
+
+
+if __name__ == "__main__":
+    mh.run_main(main)
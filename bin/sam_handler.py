@@ -7,25 +7,27 @@ It outputs a tab-delimited file with the following columns: ref-chr, ref-pos, re
 The file is similar to the output of segemehl's trns command, but it contains only spliced reads that are within the same segment/chromosome.
 
 Usage:
-    sam_handler.py --sam <sam_file> --sngl <sngl_bed_file> -g <genome> -o <output_folder>
+    sam_handler.py --sam <sam_file> --sngl <sngl_bed_file> -g <genome> -o <output_folder> [--threads=<threads>]
     sam_handler.py -h | --help
 
 Options:
     -h --help                    Show this screen.
-    --sam=<sam_file>             Path to SAM file
+    --sam=<sam_file>             Path to SAM or BAM file
     --sngl=<sngl_bed_file>       Path to .sngl.bed file from segemehl
     -g --genome=<genome>         The genome filepath.
     -o --output=<output_folder>  The output folder.
+    --threads=<threads>          Number of cores to use, defaults to the cores
+                                 allocated to the task.
 """
 
 from docopt import docopt
 import pysam
 import os
+import multiprocessing as mp
 import numpy as np
-import pandas as pd
 import helper as hp
-import plot_heatmaps as ph
 import trns_handler as th
+import metrics_handler as mh
 
 
 def get_read_ids(bed_file):
@@ -39,11 +41,11 @@ def get_read_ids(bed_file):
 
     Returns
     -------
-    read_ids : list
-        List of read IDs
+    read_ids : set
+        Set of read IDs
     """
 
-    read_ids = []
+    read_ids = set()
 
     with open(bed_file, "r") as f:
         for line in f:
@@ -58,23 +60,41 @@ def get_read_ids(bed_file):
             else:
                 read_id = line.split("\t")[3]
                 read_id = read_id.split(";")[2]
-                read_ids.append(read_id)
+                read_ids.add(read_id)
 
     return read_ids
 
 
+def is_grouped_by_name(sam_file):
+    """
+    Check if the records of a read are adjacent in the SAM file, which the
+    header only guarantees for name-sorted (SO:queryname) or grouped
+    (GO:query) files. Without such a tag the records may be in any order.
+
+    Parameters
+    ----------
+    sam_file : pysam.AlignmentFile
+        SAM file
+
+    Returns
+    -------
+    bool
+        True if the header declares the records grouped by name, False otherwise
+    """
+    header = sam_file.header.to_dict().get("HD", {})
+    return header.get("SO") == "queryname" or header.get("GO") == "query"
+
+
 def get_intra_segment_chimeras(read_ids, sam_file):
     """
     Get intra-segment chimeras from SAM file
 
     Parameters
     ----------
-    read_ids : list
-        List of read IDs
+    read_ids : set
+        Set of read IDs
     sam_file : pysam.AlignmentFile
         SAM file
-    output_file : str
-        Path to output file
 
     Returns
     -------
@@ -83,10 +103,10 @@ def get_intra_segment_chimeras(read_ids, sam_file):
     """
     split_reads = {}
     # Iterate over mapped reads in SAM file
-    for read in sam_file.fetch():
+    for read in sam_file.fetch(until_eof=True):
         if read.is_unmapped:
             continue
-        # Check if read ID is in list of read IDs
+        # Check if read ID is in the set of read IDs
         if read.query_name in read_ids:
             # Check if read_id is already in dictionary
             if read.query_name in split_reads:
@@ -97,6 +117,38 @@ def get_intra_segment_chimeras(read_ids, sam_file):
     return split_reads
 
 
+def stream_intra_segment_chimeras(read_ids, sam_file):
+    """
+    Stream intra-segment chimeras from a SAM file whose records are grouped by
+    read name, yielding the segments of one read at a time
+
+    Parameters
+    ----------
+    read_ids : set
+        Set of read IDs
+    sam_file : pysam.AlignmentFile
+        SAM file
+
+    Yields
+    ------
+    split_read_list : list
+        List of pysam.AlignedSegment objects of the same read
+    """
+    current_name = None
+    split_read_list = []
+    for read in sam_file.fetch(until_eof=True):
+        if read.is_unmapped or read.query_name not in read_ids:
+            continue
+        if read.query_name != current_name:
+            if split_read_list:
+                yield split_read_list
+            current_name = read.query_name
+            split_read_list = []
+        split_read_list.append(read)
+    if split_read_list:
+        yield split_read_list
+
+
 def split_read_to_interaction(split_read_list):
     """
     Convert split read to interaction
@@ -171,17 +223,106 @@ def split_read_to_interaction(split_read_list):
     return interaction
 
 
-def segemehlSngl2heatmap(sngl_file, sam_file, interaction_arrays, min_gap=50):
+def open_alignment_file(sam_file, threads=1):
+    """
+    Open a SAM or BAM file, decompressing BAM files with htslib threads
+
+    Parameters
+    ----------
+    sam_file : str
+        Path to SAM or BAM file
+    threads : int
+        Number of htslib decompression threads
+
+    Returns
+    -------
+    pysam.AlignmentFile
+        The opened alignment file
+    """
+    mode = "rb" if sam_file.endswith(".bam") else "r"
+    return pysam.AlignmentFile(sam_file, mode, threads=threads)
+
+
+def fill_split_reads(split_reads, interaction_arrays, min_gap=50):
+    """
+    Convert split reads to interactions and fill the interaction_arrays
+
+    Parameters
+    ----------
+    split_reads : iterable
+        Lists of pysam.AlignedSegment objects, one list per read
+    interaction_arrays : dict
+        Dictionary of interaction arrays
+    min_gap : int
+        Minimum gap between the two parts of a split read
+
+    Returns
+    -------
+    None
+    """
+    for split_read_list in split_reads:
+        interaction = split_read_to_interaction(split_read_list)
+        if len(interaction) == 6 and interaction[5] - interaction[2] >= min_gap:
+            th.fill_heatmap(interaction, interaction_arrays, intra = True)
+
+
+# Read IDs shared with the worker processes of the region-parallel scan
+_worker_read_ids = None
+
+
+def _init_segment_worker(read_ids):
+    """
+    Initialise a worker process of the region-parallel scan
+    """
+    global _worker_read_ids
+    _worker_read_ids = read_ids
+
+
+def _fill_segment_array(arguments):
+    """
+    Fill the intra-segment array of a single reference segment from an indexed BAM file
+
+    Parameters
+    ----------
+    arguments : tuple
+        BAM file path, segment name, segment length and minimum gap
+
+    Returns
+    -------
+    tuple
+        The segment name and its filled intra-segment array
+    """
+    sam_file, segment, segment_length, min_gap = arguments
+    interaction_arrays = {(segment, segment): np.zeros((segment_length, segment_length))}
+    with open_alignment_file(sam_file) as alignment_file:
+        split_reads = {}
+        for read in alignment_file.fetch(contig=segment):
+            if read.is_unmapped or read.query_name not in _worker_read_ids:
+                continue
+            split_reads.setdefault(read.query_name, []).append(read)
+    fill_split_reads(split_reads.values(), interaction_arrays, min_gap=min_gap)
+    return segment, interaction_arrays[(segment, segment)]
+
+
+def segemehlSngl2heatmap(sngl_file, sam_file, interaction_arrays, min_gap=50, threads=1):
     """Parses the sngl file and fills the interaction_arrays
 
+    Coordinate-sorted and indexed BAM files are scanned in parallel, one
+    worker process per reference segment, each filling its own intra-segment
+    array. Other files are streamed with htslib decompression threads.
+
     Parameters
     ----------
     sngl_file : str
         Path to .sngl.bed file
     sam_file : str
-        Path to SAM file
+        Path to SAM or BAM file
     interaction_arrays : dict
         Dictionary of interaction arrays
+    min_gap : int
+        Minimum gap between the two parts of a split read
+    threads : int
+        Number of cores to use
 
     Returns
     -------
@@ -190,16 +331,38 @@ def segemehlSngl2heatmap(sngl_file, sam_file, interaction_arrays, min_gap=50):
     # Get read IDs from .sngl.bed file
     read_ids = get_read_ids(sngl_file)
     # Get SAM file and parse only mapped reads
-    sam_file = pysam.AlignmentFile(sam_file, "r")
-    # Get intra-segment chimeras
-    split_reads = get_intra_segment_chimeras(read_ids, sam_file)
-    # Close SAM file
-    sam_file.close()
+    alignment_file = open_alignment_file(sam_file, threads=threads)
+    # Scan the segments of coordinate-sorted, indexed BAM files in parallel
+    if (
+        threads > 1
+        and not is_grouped_by_name(alignment_file)
+        and alignment_file.is_bam
+        and alignment_file.has_index()
+    ):
+        segments = [
+            (sam_file, segment, interaction_arrays[(segment, segment)].shape[0], min_gap)
+            for segment, _ in interaction_arrays
+            if segment in alignment_file.references
+        ]
+        alignment_file.close()
+        with mp.Pool(
+            min(threads, len(segments)) or 1,
+            initializer=_init_segment_worker,
+            initargs=(read_ids,),
+        ) as pool:
+            for segment, segment_array in pool.imap_unordered(_fill_segment_array, segments):
+                interaction_arrays[(segment, segment)] += segment_array
+        return
+    # Get intra-segment chimeras, grouping the segments of each read on the fly
+    # when the records of a read are adjacent
+    if is_grouped_by_name(alignment_file):
+        split_reads = stream_intra_segment_chimeras(read_ids, alignment_file)
+    else:
+        split_reads = get_intra_segment_chimeras(read_ids, alignment_file).values()
     # Iterate over split reads
-    for read_id, split_read_list in split_reads.items():
-        interaction = split_read_to_interaction(split_read_list)
-        if interaction[5] - interaction[2] >= min_gap:
-            th.fill_heatmap(interaction, interaction_arrays, intra = True)
+    fill_split_reads(split_reads, interaction_arrays, min_gap=min_gap)
+    # Close SAM file
+    alignment_file.close()
 
 
 def main():
@@ -212,6 +375,10 @@ def main():
     sam_file = args["--sam"]
     genome_file = args["--genome"]
     output_folder = args["--output"]
+    if args["--threads"]:
+        threads = int(args["--threads"])
+    else:
+        threads = hp.get_available_cpus()
     sngl_file_name = os.path.basename(sngl_file)
     sngl_file_name = sngl_file_name.split(".")[0]
 
@@ -227,11 +394,20 @@ def main():
     )
 
     # fill the interaction arrays
-    segemehlSngl2heatmap(sngl_file, sam_file, combination_arrays)
+    with mh.stage("fill"):
+        segemehlSngl2heatmap(sngl_file, sam_file, combination_arrays, threads=threads)
+
+    # Plot heatmaps, matplotlib is only imported once the arrays are filled
+    import plot_heatmaps as ph
+
+    with mh.stage("plot") as plot_stage:
+        plot_stage.count(
+            "heatmaps",
+            ph.plot_heatmaps(combination_arrays, output_folder, color_palette="gist_stern"),
+        )
 
-    # Plot heatmaps
-    ph.plot_heatmaps(combination_arrays, output_folder, colour_palette="gist_stern")
+    mh.write_metrics(output_folder)
 
  
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
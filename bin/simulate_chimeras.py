@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+"""simulate_chimeras.py
+
+Simulates chimeric reads and writes them as a segemehl trns file, for
+reproducible large inputs to fill_arrays.py, make_counttable.py and
+annotate_interactions.py. Reads are drawn from the ground-truth interactions,
+a fraction of them (the noise rate) joins two random positions of the genome
+instead. The reads are generated in chunks, so the memory use does not depend
+on the number of reads. The same seed and chunk size give the same file.
+
+Each trns line holds the two arms of a read in the seven fields segemehl
+writes, <segment>,<position>,<strand>,<position in read>,<length>,<edit
+distance>,<score>, followed by the read name, which ends in the index of the
+simulated interaction (or noise). The arms are simulated without mismatches,
+so their edit distance is 0 and their score is their length.
+
+Usage:
+    simulate_chimeras.py -g <genome> -n <number_of_reads> -o <output_file> [-i <interactions>] [--noise=<noise>] [--length_mean=<length_mean>] [--length_sd=<length_sd>] [--min_length=<min_length>] [--max_length=<max_length>] [--seed=<seed>] [--chunk_size=<chunk_size>]
+    simulate_chimeras.py -h | --help
+
+Options:
+    -h --help                           Show this screen.
+    -g --genome=<genome>                The genome filepath.
+    -n --number_of_reads=<number_of_reads>  Number of reads to simulate.
+    -o --output=<output_file>           The trns file to write, gzipped if it ends in .gz.
+    -i --interactions=<interactions>    Ground-truth interactions, one per line as
+                                        segment,start,end,segment,start,end[,weight].
+                                        Without interactions all reads are noise.
+    --noise=<noise>                     Fraction of reads joining random positions [default: 0.1].
+    --length_mean=<length_mean>         Mean length of each arm of a read [default: 30].
+    --length_sd=<length_sd>             Standard deviation of the arm length [default: 10].
+    --min_length=<min_length>           Minimum arm length [default: 15].
+    --max_length=<max_length>           Maximum arm length [default: 100].
+    --seed=<seed>                       Seed of the random number generator [default: 0].
+    --chunk_size=<chunk_size>           Number of reads generated at once [default: 1000000].
+
+"""
+
+from docopt import docopt
+import gzip
+import numpy as np
+import helper as hp
+import metrics_handler as mh
+
+
+def parse_interactions(interactions, segments):
+    """
+    Parse a ground-truth interactions file.
+
+    Parameters
+    ----------
+    interactions : str
+        Path to the interactions file, one interaction per line as
+        segment,start,end,segment,start,end and an optional weight. Segments
+        are segment names or, as for art_templater.py, segment indices.
+    segments : list
+        The segment names of the genome.
+
+    Returns
+    -------
+    dict
+        Arrays of the segment indices (segment01, segment02), coordinates
+        (start01, end01, start02, end02) and weights of the interactions.
+    """
+    rows = []
+    with open(interactions) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            fields = line.strip().split(",")
+            if len(fields) not in (6, 7):
+                raise ValueError(f"Malformed interaction: {line.strip()}")
+            row = []
+            for segment, start, end in (fields[0:3], fields[3:6]):
+                if segment in segments:
+                    row.append(segments.index(segment))
+                elif segment.isdigit() and int(segment) < len(segments):
+                    row.append(int(segment))
+                else:
+                    raise ValueError(f"Segment {segment} not in the genome")
+                row += [int(start), int(end)]
+            row.append(float(fields[6]) if len(fields) == 7 else 1.0)
+            rows.append(row)
+    rows = np.array(rows, dtype=float).reshape(-1, 7)
+    return {
+        "segment01": rows[:, 0].astype(np.int64),
+        "start01": rows[:, 1].astype(np.int64),
+        "end01": rows[:, 2].astype(np.int64),
+        "segment02": rows[:, 3].astype(np.int64),
+        "start02": rows[:, 4].astype(np.int64),
+        "end02": rows[:, 5].astype(np.int64),
+        "weight": rows[:, 6] / rows[:, 6].sum() if len(rows) else rows[:, 6],
+    }
+
+
+def draw_lengths(rng, size, length_mean, length_sd, min_length, max_length):
+    """
+    Draw arm lengths from a normal distribution clipped to [min_length, max_length].
+    """
+    lengths = np.rint(rng.normal(length_mean, length_sd, size))
+    return np.clip(lengths, min_length, max_length).astype(np.int64)
+
+
+def draw_positions(rng, region_starts, region_ends, lengths, segment_lengths):
+    """
+    Draw arm positions uniformly, so that the arms start within their region
+    and end within their segment.
+    """
+    lengths = np.minimum(lengths, segment_lengths)
+    last_starts = np.minimum(np.maximum(region_ends - lengths, region_starts), segment_lengths - lengths)
+    region_starts = np.minimum(region_starts, last_starts)
+    positions = region_starts + np.floor(
+        rng.random(len(lengths)) * (last_starts - region_starts + 1)
+    ).astype(np.int64)
+    return positions, lengths
+
+
+def simulate_chunk(rng, size, first_read, interactions, segment_lengths, noise, length_parameters):
+    """
+    Simulate a chunk of chimeric reads.
+
+    Parameters
+    ----------
+    rng : numpy.random.Generator
+    size : int
+        Number of reads.
+    first_read : int
+        Index of the first read of the chunk, used in the read names.
+    interactions : dict
+        The interactions, see parse_interactions.
+    segment_lengths : numpy.ndarray
+        The length of each segment.
+    noise : float
+        Fraction of reads joining random positions.
+    length_parameters : tuple
+        length_mean, length_sd, min_length and max_length.
+
+    Returns
+    -------
+    dict
+        The segment, position, strand and length of both arms and the
+        interaction index (-1 for noise) of each read.
+    """
+    has_interactions = len(interactions["weight"]) > 0
+    if has_interactions:
+        labels = rng.choice(len(interactions["weight"]), size=size, p=interactions["weight"])
+        labels[rng.random(size) < noise] = -1
+    else:
+        labels = np.full(size, -1)
+    is_interaction = labels != -1
+    reads = {"label": labels, "first_read": first_read}
+
+    # Noise arms fall anywhere in segments drawn by their length
+    segment_weights = segment_lengths / segment_lengths.sum()
+    for arm in ("01", "02"):
+        segments = rng.choice(len(segment_lengths), size=size, p=segment_weights)
+        region_starts = np.zeros(size, dtype=np.int64)
+        if has_interactions:
+            segments[is_interaction] = interactions[f"segment{arm}"][labels[is_interaction]]
+            region_starts[is_interaction] = interactions[f"start{arm}"][labels[is_interaction]]
+        region_ends = segment_lengths[segments]
+        if has_interactions:
+            region_ends[is_interaction] = interactions[f"end{arm}"][labels[is_interaction]]
+        lengths = draw_lengths(rng, size, *length_parameters)
+        positions, lengths = draw_positions(
+            rng, region_starts, region_ends, lengths, segment_lengths[segments]
+        )
+        reads[f"segment{arm}"] = segments
+        reads[f"position{arm}"] = positions
+        reads[f"length{arm}"] = lengths
+        reads[f"strand{arm}"] = rng.random(size) < 0.5
+    return reads
+
+
+def format_chunk(reads, segments):
+    """
+    Format simulated reads as trns lines.
+    """
+    strands = np.array(["+", "-"])
+    segments = np.array(segments, dtype=object)
+    columns = zip(
+        segments[reads["segment01"]],
+        reads["position01"].tolist(),
+        strands[reads["strand01"].astype(int)],
+        reads["length01"].tolist(),
+        segments[reads["segment02"]],
+        reads["position02"].tolist(),
+        strands[reads["strand02"].astype(int)],
+        reads["length02"].tolist(),
+        range(reads["first_read"], reads["first_read"] + len(reads["label"])),
+        np.where(reads["label"] == -1, "noise", reads["label"].astype(str)),
+    )
+    return "".join(
+        f"{segment01},{position01},{strand01},1,{length01},0,{length01}\t"
+        f"{segment02},{position02},{strand02},{length01 + 1},{length02},0,{length02}\t"
+        f"read{read}_{label}\n"
+        for segment01, position01, strand01, length01, segment02, position02, strand02, length02, read, label in columns
+    )
+
+
+def simulate_trns_file(genome_dict, output_file, number_of_reads, interactions=None, noise=0.1, length_parameters=(30, 10, 15, 100), seed=0, chunk_size=1000000):
+    """
+    Simulate chimeric reads and write them as a segemehl trns file.
+
+    Parameters
+    ----------
+    genome_dict : dict
+        The genome, see helper.parse_fasta.
+    output_file : str
+        The trns file to write, gzipped if it ends in .gz.
+    number_of_reads : int
+        Number of reads to simulate.
+    interactions : dict
+        The interactions, see parse_interactions.
+    noise : float
+        Fraction of reads joining random positions.
+    length_parameters : tuple
+        length_mean, length_sd, min_length and max_length.
+    seed : int
+        Seed of the random number generator.
+    chunk_size : int
+        Number of reads generated at once.
+    """
+    segments = list(genome_dict.keys())
+    segment_lengths = np.array(list(hp.get_segment_lengths(genome_dict).values()), dtype=np.int64)
+    if interactions is None:
+        interactions = {"weight": np.zeros(0)}
+    rng = np.random.default_rng(seed)
+    opener = gzip.open if output_file.endswith(".gz") else open
+    with opener(output_file, "wt") as output:
+        for first_read in range(0, number_of_reads, chunk_size):
+            size = min(chunk_size, number_of_reads - first_read)
+            reads = simulate_chunk(
+                rng, size, first_read, interactions, segment_lengths, noise, length_parameters
+            )
+            output.write(format_chunk(reads, segments))
+
+
+def main():
+    args = docopt(__doc__)
+    genome_dict = hp.parse_fasta(args["--genome"])
+    interactions = None
+    if args["--interactions"]:
+        interactions = parse_interactions(args["--interactions"], list(genome_dict.keys()))
+    length_parameters = (
+        float(args["--length_mean"]),
+        float(args["--length_sd"]),
+        int(args["--min_length"]),
+        int(args["--max_length"]),
+    )
+    with mh.stage("simulate") as simulate_stage:
+        simulate_trns_file(
+            genome_dict,
+            args["--output"],
+            int(args["--number_of_reads"]),
+            interactions=interactions,
+            noise=float(args["--noise"]),
+            length_parameters=length_parameters,
+            seed=int(args["--seed"]),
+            chunk_size=int(args["--chunk_size"]),
+        )
+        simulate_stage.count("reads", int(args["--number_of_reads"]))
+
+    mh.write_metrics(args["--output"])
+
+
+if __name__ == "__main__":
+    mh.run_main(main)
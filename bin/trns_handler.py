@@ -1,6 +1,36 @@
+import gzip
+import io
 import itertools
+from collections import deque
+from multiprocessing.pool import ThreadPool
 import numpy as np
-import matplotlib.pyplot as plt
+import array_handler as ah
+import helper as hp
+
+TRNS_BLOCK_SIZE = 16 * 1024**2
+# Fields of a trns arm: ref-chr, ref-pos, ref-strand, start-in-read,
+# align-length, align-edist and score (older files may lack the last two)
+ARM_FIELDS = {"segment": 0, "start": 1, "length": 4}
+
+
+def get_trns_columns(fields_per_arm):
+    """Returns the columns of a trns line, once its tabs are read as commas,
+    holding the segment, start and length of the first and the second arm
+
+    Parameters
+    ----------
+    fields_per_arm : int
+        Number of comma-separated fields of an arm.
+
+    Returns
+    -------
+    list
+    """
+    return [
+        offset + ARM_FIELDS[field]
+        for offset in (0, fields_per_arm)
+        for field in ("segment", "start", "length")
+    ]
 
 
 def __convert_to_int(element):
@@ -70,42 +100,328 @@ def __extract_start_stop_segemehl(read):
     return [seg, start, stop]
 
 
-def segemehlTrans2heatmap(trnsFile, interaction_arrays, intra_only=False):
-    """Parses the trns file and fills the interaction_arrays
+def get_csv_engine():
+    """Returns the CSV engine to parse trns files with, the multi-threaded
+    pyarrow CSV reader if pyarrow is installed, the C engine of pandas
+    otherwise
+
+    Returns
+    -------
+    str
+    """
+    try:
+        import pyarrow  # noqa: F401
+    except ImportError:
+        return "c"
+    return "pyarrow"
+
+
+def iterate_trns_blocks(trnsFile, block_size=TRNS_BLOCK_SIZE):
+    """Yields the (possibly gzipped) trns file in blocks of whole lines
 
     Parameters
     ----------
     trnsFile : str
+    block_size : int
+        Approximate size of the blocks in bytes.
+
+    Yields
+    ------
+    bytes
+    """
+    opener = gzip.open if trnsFile.endswith(".gz") else open
+    with opener(trnsFile, "rb") as inputStream:
+        remainder = b""
+        for block in iter(lambda: inputStream.read(block_size), b""):
+            block = remainder + block
+            end = block.rfind(b"\n") + 1
+            remainder = block[end:]
+            if end:
+                yield block[:end]
+        if remainder.strip():
+            yield remainder
+
+
+def __parse_trns_lines(block):
+    """Parses a block of trns lines line by line, for the lines the CSV
+    engines cannot parse (e.g. read ids with commas)
+
+    Parameters
+    ----------
+    block : bytes
+
+    Returns
+    -------
+    tuple
+        See parse_trns_block.
+    """
+    segments = {}
+    codes = []
+    positions = []
+    for line in block.decode().splitlines():
+        line = line.strip().split()
+        if not line:
+            continue
+        firstRead = __extract_start_stop_segemehl(line[0].split(","))
+        secondRead = __extract_start_stop_segemehl(line[1].split(","))
+        codes.append([
+            segments.setdefault(firstRead[0], len(segments)),
+            segments.setdefault(secondRead[0], len(segments)),
+        ])
+        positions.append(firstRead[1:] + secondRead[1:])
+    return (
+        list(segments),
+        np.array(codes, dtype=np.int64).reshape(-1, 2),
+        np.array(positions, dtype=np.int64).reshape(-1, 4),
+    )
+
+
+def __read_csv_block(block, engine, columns):
+    """Reads the columns of a block whose tabs are replaced by commas
+
+    Parameters
+    ----------
+    block : bytes
+    engine : str
+    columns : list
+        The segment, start and length columns of both arms, see
+        get_trns_columns.
+
+    Returns
+    -------
+    tuple
+        The segment names, their codes (n, 2), the starts (n, 2) and the
+        lengths (n, 2) of both reads.
+    """
+    if engine == "pyarrow":
+        import pyarrow as pa
+        import pyarrow.csv as pacsv
+
+        segment_type = pa.dictionary(pa.int32(), pa.string())
+        names = [f"f{column}" for column in columns]
+        table = pacsv.read_csv(
+            pa.py_buffer(block),
+            read_options=pacsv.ReadOptions(autogenerate_column_names=True),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=names,
+                column_types={
+                    name: segment_type if i % 3 == 0 else pa.int64()
+                    for i, name in enumerate(names)
+                },
+            ),
+        )
+        if any(table[name].null_count for name in names):
+            raise ValueError("missing fields")
+        first_segments, second_segments = (table[names[i]].combine_chunks() for i in (0, 3))
+        segments = first_segments.dictionary.to_pylist() + second_segments.dictionary.to_pylist()
+        codes = np.stack([
+            first_segments.indices.to_numpy(),
+            second_segments.indices.to_numpy() + len(first_segments.dictionary),
+        ], axis=1)
+        starts = np.stack([table[names[1]].to_numpy(), table[names[4]].to_numpy()], axis=1)
+        lengths = np.stack([table[names[2]].to_numpy(), table[names[5]].to_numpy()], axis=1)
+        return segments, codes, starts, lengths
+
+    import pandas as pd
+
+    table = pd.read_csv(
+        io.BytesIO(block),
+        sep=",",
+        header=None,
+        usecols=columns,
+        dtype={column: str if i % 3 == 0 else np.int64 for i, column in enumerate(columns)},
+        engine=engine,
+    )
+    codes, segments = pd.factorize(
+        np.concatenate([table[columns[0]].to_numpy(), table[columns[3]].to_numpy()])
+    )
+    return (
+        list(segments),
+        codes.reshape(2, -1).T,
+        table[[columns[1], columns[4]]].to_numpy(),
+        table[[columns[2], columns[5]]].to_numpy(),
+    )
+
+
+def parse_trns_block(block, engine="c"):
+    """Parses a block of trns lines with a CSV engine, the tabs and the commas
+    are both read as separators so that the fields of the reads are parsed in
+    one pass
+
+    Parameters
+    ----------
+    block : bytes
+        Whole trns lines, see iterate_trns_blocks.
+    engine : str
+        The CSV engine, see get_csv_engine.
+
+    Returns
+    -------
+    tuple
+        The segment names of the block, the codes of the segments of both
+        reads of each line (n, 2) and their start and stop positions (n, 4).
+    """
+    # The second arm starts after the fields of the first, whose number is
+    # taken from the first line of the block
+    first_line = block.lstrip().split(b"\n", 1)[0]
+    fields_per_arm = first_line.split(b"\t", 1)[0].count(b",") + 1
+    try:
+        segments, codes, starts, lengths = __read_csv_block(
+            block.replace(b"\t", b","), engine, get_trns_columns(fields_per_arm)
+        )
+    except (ValueError, KeyError):
+        return __parse_trns_lines(block)
+    stops = starts + lengths
+    return segments, codes, np.stack([starts[:, 0], stops[:, 0], starts[:, 1], stops[:, 1]], axis=1)
+
+
+def __encode_block(parsed_block, segments, segment_codes):
+    """Returns the interactions of a parsed block with the segment codes of
+    the block replaced by those of the file, new segments are added to
+    segments
+
+    Parameters
+    ----------
+    parsed_block : tuple
+        See parse_trns_block.
+    segments : list
+    segment_codes : dict
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    block_segments, codes, positions = parsed_block
+    for segment in block_segments:
+        if segment not in segment_codes:
+            segment_codes[segment] = len(segments)
+            segments.append(segment)
+    file_codes = np.array([segment_codes[segment] for segment in block_segments], dtype=np.int64)
+    codes = file_codes[codes]
+    return np.column_stack([codes[:, 0], positions[:, :2], codes[:, 1], positions[:, 2:]])
+
+
+def read_trns(trnsFile, block_size=TRNS_BLOCK_SIZE, engine=None, threads=None):
+    """Reads the trns file in blocks, parsed in parallel by a CSV engine.
+    Each line becomes an interaction [segment, start, stop, segment, start,
+    stop] as __extract_start_stop_segemehl returns it, with the segments as
+    codes into the segment names read so far.
+
+    Parameters
+    ----------
+    trnsFile : str
+        A plain or gzipped trns file.
+    block_size : int
+        Approximate size of the blocks in bytes.
+    engine : str
+        The CSV engine, by default get_csv_engine().
+    threads : int
+        Number of blocks parsed at once, by default the available CPUs.
+
+    Yields
+    ------
+    tuple
+        The segment names (a list which grows as new segments are read) and
+        the interactions of a block, an int64 array with one row per line.
+    """
+    engine = engine or get_csv_engine()
+    threads = threads or hp.get_available_cpus()
+    segments = []
+    segment_codes = {}
+    with ThreadPool(threads) as pool:
+        # At most one block per thread is read ahead, to bound the memory
+        pending = deque()
+        for block in iterate_trns_blocks(trnsFile, block_size):
+            pending.append(pool.apply_async(parse_trns_block, (block, engine)))
+            if len(pending) > threads:
+                yield segments, __encode_block(pending.popleft().get(), segments, segment_codes)
+        while pending:
+            yield segments, __encode_block(pending.popleft().get(), segments, segment_codes)
+
+
+def check_interactions(interactions, segments, interaction_arrays=None):
+    """Applies __check_interaction to an array of interactions from read_trns,
+    in place: the start and stop of each read are ordered and, if
+    interaction_arrays are given, the reads of the interactions whose segment
+    pair is not in interaction_arrays are swapped
+
+    Parameters
+    ----------
+    interactions : numpy.ndarray
+    segments : list
+        The segment names of the codes.
     interaction_arrays : dict
 
     Returns
     -------
-    None
+    numpy.ndarray
     """
-    with open(trnsFile) as inputStream:
-        for line in inputStream:
-            line = line.strip().split()
-            firstRead = line[0].split(",")
-            secondRead = line[1].split(",")
-            currentRow = __extract_start_stop_segemehl(
-                firstRead
-            ) + __extract_start_stop_segemehl(secondRead)
-            interaction = __check_interaction(currentRow, interaction_arrays)
-            if intra_only:
-                if interaction[0] == interaction[3]:
-                    fill_heatmap(interaction, interaction_arrays, intra=True)
-            else:
-                if interaction[0] != interaction[3]:
-                    fill_heatmap(interaction, interaction_arrays)
+    interactions[:, 1:3] = np.sort(interactions[:, 1:3], axis=1)
+    interactions[:, 4:6] = np.sort(interactions[:, 4:6], axis=1)
+    if interaction_arrays and len(interactions):
+        pairs, inverse = np.unique(interactions[:, [0, 3]], axis=0, return_inverse=True)
+        reverse = np.array(
+            [(segments[first], segments[second]) not in interaction_arrays for first, second in pairs.tolist()]
+        )[inverse.ravel()]
+        interactions[reverse] = interactions[reverse][:, [3, 4, 5, 0, 1, 2]]
+    return interactions
+
+
+def iterate_interactions(interactions, segments):
+    """Yields the interactions as lists with the segment names, as
+    __check_interaction returns them
+
+    Parameters
+    ----------
+    interactions : numpy.ndarray
+    segments : list
+
+    Yields
+    ------
+    list
+    """
+    for interaction in interactions.tolist():
+        interaction[0] = segments[interaction[0]]
+        interaction[3] = segments[interaction[3]]
+        yield interaction
 
 
-def fill_heatmap(interaction, interaction_arrays, intra = False):
+def segemehlTrans2heatmap(trnsFile, interaction_arrays, intra_only=False, profile_arrays=None):
+    """Parses the trns file and fills the interaction_arrays
+
+    Parameters
+    ----------
+    trnsFile : str
+        A plain or gzipped trns file, see read_trns.
+    interaction_arrays : dict
+    profile_arrays : dict
+        Difference arrays from make_profile_arrays, filled alongside the
+        interaction_arrays if given.
+
+    Returns
+    -------
+    tuple
+        The number of reads parsed and of interactions filled.
+    """
+    number_of_reads = 0
+    number_of_interactions = 0
+    for segments, interactions in read_trns(trnsFile):
+        number_of_reads += len(interactions)
+        interactions = check_interactions(interactions, segments, interaction_arrays)
+        intra = interactions[:, 0] == interactions[:, 3]
+        for interaction in iterate_interactions(interactions[intra if intra_only else ~intra], segments):
+            number_of_interactions += fill_heatmap(interaction, interaction_arrays, intra=intra_only, profile_arrays=profile_arrays)
+    return number_of_reads, number_of_interactions
+
+
+def fill_heatmap(interaction, interaction_arrays, intra = False, profile_arrays=None):
     """Fills the interaction_arrays with the interaction
 
     Parameters
     ----------
     interaction : list
     interaction_arrays : dict
+    profile_arrays : dict
 
     Returns
     -------
@@ -113,16 +429,192 @@ def fill_heatmap(interaction, interaction_arrays, intra = False):
     """
     firstSegment = interaction[0]
     secondSegment = interaction[3]
-    interaction_arrays[(firstSegment, secondSegment)][
-        interaction[1] : interaction[2], interaction[4] : interaction[5]
-    ] += 1
+    ah.fill_rectangle(
+        interaction_arrays[(firstSegment, secondSegment)],
+        interaction[1], interaction[2], interaction[4], interaction[5],
+    )
     if intra:
-        interaction_arrays[(secondSegment, firstSegment)][
-            interaction[4] : interaction[5], interaction[1] : interaction[2]
-        ] += 1
+        ah.fill_rectangle(
+            interaction_arrays[(secondSegment, firstSegment)],
+            interaction[4], interaction[5], interaction[1], interaction[2],
+        )
+    if profile_arrays is not None:
+        fill_profiles(
+            profile_arrays[(firstSegment, secondSegment)],
+            interaction[1], interaction[2], interaction[4], interaction[5],
+        )
+        if intra:
+            fill_profiles(
+                profile_arrays[(secondSegment, firstSegment)],
+                interaction[4], interaction[5], interaction[1], interaction[2],
+            )
     return 1
 
 
+def make_profile_arrays(interaction_arrays):
+    """Returns empty difference arrays for the marginal profiles (the sums
+    along the columns and along the rows) of each of the interaction_arrays
+
+    Parameters
+    ----------
+    interaction_arrays : dict
+
+    Returns
+    -------
+    dict
+        The row and column difference arrays of each combination.
+    """
+    return {
+        combination: (
+            np.zeros(interaction_array.shape[0] + 1),
+            np.zeros(interaction_array.shape[1] + 1),
+        )
+        for combination, interaction_array in interaction_arrays.items()
+    }
+
+
+def fill_profiles(profile_array, row_start, row_end, column_start, column_end):
+    """Adds a filled rectangle of the interaction array to its profile
+    difference arrays, the ends are clipped as numpy slices are
+
+    Parameters
+    ----------
+    profile_array : tuple
+        The row and column difference arrays.
+    row_start, row_end, column_start, column_end : int
+
+    Returns
+    -------
+    None
+    """
+    row_diff, column_diff = profile_array
+    row_start, row_end = slice(row_start, row_end).indices(len(row_diff) - 1)[:2]
+    column_start, column_end = slice(column_start, column_end).indices(len(column_diff) - 1)[:2]
+    if row_end <= row_start or column_end <= column_start:
+        return
+    # Every row of the rectangle gains its width, every column its height
+    row_diff[row_start] += column_end - column_start
+    row_diff[row_end] -= column_end - column_start
+    column_diff[column_start] += row_end - row_start
+    column_diff[column_end] -= row_end - row_start
+
+
+def get_profiles(profile_arrays):
+    """Returns the marginal profiles from the difference arrays, they equal
+    np.sum(interaction_array, axis=1) and np.sum(interaction_array, axis=0)
+
+    Parameters
+    ----------
+    profile_arrays : dict
+
+    Returns
+    -------
+    dict
+        The row and column profiles of each combination.
+    """
+    return {
+        combination: (np.cumsum(row_diff)[:-1], np.cumsum(column_diff)[:-1])
+        for combination, (row_diff, column_diff) in profile_arrays.items()
+    }
+
+
+def __add_histograms(histogram, other_histogram):
+    """Returns the sum of two histograms of different lengths
+
+    Parameters
+    ----------
+    histogram : numpy.ndarray
+    other_histogram : numpy.ndarray
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if len(other_histogram) > len(histogram):
+        histogram, other_histogram = other_histogram, histogram
+    histogram = histogram.copy()
+    histogram[: len(other_histogram)] += other_histogram
+    return histogram
+
+
+def get_value_counts(interaction_array, block_bytes=64 * 1024**2):
+    """Returns how many cells of the interaction_array hold each value, the
+    array is read once in blocks of rows. Only non-negative integer values are
+    counted, e.g. NaN cells or fractional values of normalised arrays are not.
+
+    Parameters
+    ----------
+    interaction_array : numpy.ndarray
+    block_bytes : int
+
+    Returns
+    -------
+    numpy.ndarray
+        The number of cells holding the value of each index.
+    """
+    value_counts = np.zeros(0, dtype=np.int64)
+    if interaction_array.size == 0:
+        return value_counts
+    interaction_array = interaction_array.reshape(interaction_array.shape[0], -1)
+    row_bytes = max(1, interaction_array[0].nbytes)
+    rows_per_block = max(1, block_bytes // row_bytes)
+    for start in range(0, interaction_array.shape[0], rows_per_block):
+        block = np.asarray(interaction_array[start : start + rows_per_block]).ravel()
+        if np.issubdtype(block.dtype, np.integer):
+            block = block[block >= 0]
+        else:
+            block = block[(block >= 0) & (block == np.floor(block))]
+        value_counts = __add_histograms(
+            value_counts, np.bincount(block.astype(np.int64, copy=False))
+        )
+    return value_counts
+
+
+def accumulate_histogram(interaction_arrays, histogram=None):
+    """Adds the value counts of all interaction_arrays to the histogram, so that
+    the histogram of several samples can be accumulated one sample at a time
+
+    Parameters
+    ----------
+    interaction_arrays : dict
+    histogram : numpy.ndarray
+
+    Returns
+    -------
+    numpy.ndarray
+    """
+    if histogram is None:
+        histogram = np.zeros(0, dtype=np.int64)
+    for interaction_array in interaction_arrays.values():
+        histogram = __add_histograms(histogram, get_value_counts(interaction_array))
+    return histogram
+
+
+def get_log_binned_histogram(histogram, bins_per_decade=10):
+    """Returns the histogram in logarithmic bins, cells with the value 0 are
+    left out
+
+    Parameters
+    ----------
+    histogram : numpy.ndarray
+    bins_per_decade : int
+
+    Returns
+    -------
+    tuple
+        The bin edges (the first value in each bin and the end of the last
+        bin) and the number of cells in each bin.
+    """
+    if len(histogram) < 2:
+        return np.ones(1, dtype=np.int64), np.zeros(0, dtype=np.int64)
+    decades = np.log10(len(histogram))
+    bin_edges = np.floor(
+        np.logspace(0, decades, int(np.ceil(decades * bins_per_decade)) + 1)
+    ).astype(np.int64)
+    bin_edges = np.unique(np.append(bin_edges[bin_edges < len(histogram)], len(histogram)))
+    return bin_edges, np.add.reduceat(histogram, bin_edges[:-1])
+
+
 def get_histogram_dict(interaction_arrays):
     """Returns the diversity of the interaction_arrays
 
@@ -134,24 +626,19 @@ def get_histogram_dict(interaction_arrays):
     -------
     dict
     """
-    histogram_dict = {}
-    for combination, interaction_array in interaction_arrays.items():
-        highest_point = int(np.nanmax(interaction_array))
-        for i in range(0, highest_point):
-            if i in histogram_dict.keys():
-                histogram_dict[i] = histogram_dict[i] + (interaction_array == i).sum()
-            else:
-                histogram_dict[i] = (interaction_array == i).sum()
+    histogram = accumulate_histogram(interaction_arrays)
+    return {value: count for value, count in enumerate(histogram)}
 
-    return histogram_dict
 
-
-def get_pairwise_arrays(interaction_arrays, genome_dict):
+def get_pairwise_arrays(interaction_arrays, genome_dict, profiles=None):
     """Returns the pairwise arrays of the interaction_arrays
 
     Parameters
     ----------
     interaction_arrays : dict
+    profiles : dict
+        Marginal profiles from get_profiles, used instead of summing the
+        interaction_arrays if given.
 
     Returns
     -------
@@ -159,6 +646,16 @@ def get_pairwise_arrays(interaction_arrays, genome_dict):
     """
     pairwise_arrays = {}
 
+    if profiles is not None:
+        for segment_combination in itertools.permutations(genome_dict.keys(), 2):
+            if segment_combination in profiles:
+                pairwise_arrays[segment_combination] = profiles[segment_combination][0]
+            elif segment_combination[::-1] in profiles:
+                pairwise_arrays[segment_combination] = profiles[segment_combination[::-1]][1]
+            else:
+                raise KeyError(f"{segment_combination} not in the profiles")
+        return pairwise_arrays
+
     for segment_combination in itertools.permutations(genome_dict.keys(), 2):
         if segment_combination in interaction_arrays.keys():
             pairwise_arrays[segment_combination] = np.sum(
@@ -177,7 +674,7 @@ def get_pairwise_arrays(interaction_arrays, genome_dict):
     return pairwise_arrays
 
 
-def plot_pairwise_arrays(interaction_arrays, genome_dict, foldername):
+def plot_pairwise_arrays(interaction_arrays, genome_dict, foldername, profiles=None):
     """Plots the pairwise arrays of the interaction_arrays
 
     Parameters
@@ -185,12 +682,15 @@ def plot_pairwise_arrays(interaction_arrays, genome_dict, foldername):
     interaction_arrays : dict
     genome_dict : dict
     folderpath : str
+    profiles : dict
 
     Returns
     -------
     None
     """
-    pairwise_arrays = get_pairwise_arrays(interaction_arrays, genome_dict)
+    import matplotlib.pyplot as plt
+
+    pairwise_arrays = get_pairwise_arrays(interaction_arrays, genome_dict, profiles=profiles)
 
     # Plotting the pairwise arrays
     for segment in genome_dict.keys():
@@ -2,8 +2,12 @@
 
 """trns_parser.py
 
+Extracts the reads listed in a trns file from a fastq file. The read ids are
+collected from the trns file first and the fastq file (plain or gzipped) is
+then scanned once, writing matching reads as they are found.
+
 Usage:
-  trns_parser.py -t <trns_file> -f <fastq_file> [-o <output_file>]
+  trns_parser.py -t <trns_file> -f <fastq_file> [-o <output_file>] [--index=<index_file>]
   trns_parser.py -h | --help
 
 Options:
@@ -11,9 +15,34 @@ Options:
   -t --trns_file=<trns_file>        trns file to parse.
   -f --fastq_file=<fastq_file>      fastq file to parse.
   -o --output_file=<output_file>    output file to write to.
+  --index=<index_file>              offset index of the fastq file, built on
+                                    first use and reused for random access on
+                                    later queries (uncompressed fastq only).
 """
 
 from docopt import docopt
+from collections import Counter
+import gzip
+import os
+import sys
+import metrics_handler as mh
+
+
+def open_fastq(fastq_file, mode="rt"):
+    """
+    Open a plain or gzipped fastq file.
+
+    Args:
+        fastq_file (str): Path to fastq file.
+        mode (str): File mode.
+
+    Returns:
+        file: File object.
+    """
+    if fastq_file.endswith(".gz"):
+        return gzip.open(fastq_file, mode)
+    return open(fastq_file, mode)
+
 
 def load_fastq_to_dict(fastq_file):
     """
@@ -26,7 +55,22 @@ def load_fastq_to_dict(fastq_file):
         dict: Dictionary with read ids as keys and fastq sequences as values.
     """
     fastq_dict = {}
-    with open(fastq_file) as file:
+    for read_id, read in iterate_fastq(fastq_file):
+        fastq_dict[read_id] = read.rstrip("\n")
+    return fastq_dict
+
+
+def iterate_fastq(fastq_file):
+    """
+    Iterate over the records of a fastq file.
+
+    Args:
+        fastq_file (str): Path to fastq file.
+
+    Yields:
+        tuple: Read id and fastq record (four lines, newline terminated).
+    """
+    with open_fastq(fastq_file) as file:
         while True:
             header = file.readline().strip()
             if not header:
@@ -35,8 +79,23 @@ def load_fastq_to_dict(fastq_file):
             _ = file.readline()  # + line
             quality = file.readline().strip()
             read_id = header.split(" ")[0][1:]  # remove '@'
-            fastq_dict[read_id] = f"{header}\n{sequence}\n+\n{quality}"
-    return fastq_dict
+            yield read_id, format_record(header, sequence, quality)
+
+
+def format_record(header, sequence, quality):
+    """
+    Format a fastq record with a bare + line, as written by both extraction
+    paths.
+
+    Args:
+        header (str): Header line, including the '@'.
+        sequence (str): Sequence line.
+        quality (str): Quality line.
+
+    Returns:
+        str: Fastq record (four lines, newline terminated).
+    """
+    return f"{header}\n{sequence}\n+\n{quality}\n"
 
 
 def trns_line_to_read_id(line):
@@ -52,30 +111,162 @@ def trns_line_to_read_id(line):
     return line.strip().split("\t")[2]
 
 
+def collect_read_ids(trns_file):
+    """
+    Collect the read ids of a trns file.
+
+    Args:
+        trns_file (str): Path to trns file.
+
+    Returns:
+        Counter: Number of trns lines per read id.
+    """
+    with open(trns_file) as file:
+        return Counter(trns_line_to_read_id(line) for line in file if line.strip())
+
+
+def build_fastq_index(fastq_file, index_file):
+    """
+    Build an offset index of an uncompressed fastq file, a tab-separated file
+    with the read id, the byte offset and the byte length of each record.
+
+    Args:
+        fastq_file (str): Path to fastq file.
+        index_file (str): Path to index file.
+    """
+    with open(fastq_file, "rb") as file, open(index_file, "w") as index:
+        offset = 0
+        while True:
+            header = file.readline()
+            if not header.strip():
+                break
+            record_length = len(header)
+            for _ in range(3):
+                record_length += len(file.readline())
+            read_id = header.decode().split(" ")[0][1:].strip()
+            index.write(f"{read_id}\t{offset}\t{record_length}\n")
+            offset += record_length
+
+
+def check_found(read_ids, found):
+    """
+    Check that all read ids of the trns file were found in the fastq file.
+
+    Args:
+        read_ids (Counter): Number of copies to write per read id.
+        found (set): Read ids which were found.
+
+    Raises:
+        ValueError: If a read id was not found.
+    """
+    missing = [read_id for read_id in read_ids if read_id not in found]
+    if missing:
+        raise ValueError(f"Read not found: {', '.join(missing[:10])}")
+
+
+def extract_reads_streaming(fastq_file, read_ids, output):
+    """
+    Scan the fastq file once and write the wanted reads incrementally.
+
+    Args:
+        fastq_file (str): Path to fastq file.
+        read_ids (Counter): Number of copies to write per read id.
+        output (file): File object to write to.
+
+    Returns:
+        set: Read ids which were found.
+    """
+    found = set()
+    for read_id, read in iterate_fastq(fastq_file):
+        if read_id in read_ids:
+            output.write(read * read_ids[read_id])
+            found.add(read_id)
+            if len(found) == len(read_ids):
+                break
+    return found
+
+
+def extract_reads_indexed(fastq_file, index_file, read_ids, output):
+    """
+    Write the wanted reads using the offset index for random access. All read
+    ids are looked up in the index before any read is written.
+
+    Args:
+        fastq_file (str): Path to fastq file.
+        index_file (str): Path to index file.
+        read_ids (Counter): Number of copies to write per read id.
+        output (file): File object to write to.
+
+    Returns:
+        set: Read ids which were found.
+
+    Raises:
+        ValueError: If a read id is not in the index.
+    """
+    offsets = []
+    with open(index_file) as index:
+        for line in index:
+            read_id, offset, record_length = line.rstrip("\n").split("\t")
+            if read_id in read_ids:
+                offsets.append((int(offset), int(record_length), read_id))
+    found = {read_id for _, _, read_id in offsets}
+    check_found(read_ids, found)
+    # Read the records in file order to keep the disk access sequential
+    offsets.sort()
+    with open(fastq_file, "rb") as file:
+        for offset, record_length, read_id in offsets:
+            file.seek(offset)
+            header, sequence, _, quality = file.read(record_length).decode().splitlines()[:4]
+            read = format_record(header.strip(), sequence.strip(), quality.strip())
+            output.write(read * read_ids[read_id])
+    return found
+
+
+def extract_reads(trns_file, fastq_file, output, index_file=None):
+    """
+    Write the reads listed in the trns file to the output.
+
+    Args:
+        trns_file (str): Path to trns file.
+        fastq_file (str): Path to fastq file.
+        output (file): File object to write to.
+        index_file (str): Path to the offset index of the fastq file.
+    """
+    read_ids = collect_read_ids(trns_file)
+    if index_file and not fastq_file.endswith(".gz"):
+        # Rebuild the index if it is missing or older than the fastq file
+        if not os.path.exists(index_file) or os.path.getmtime(index_file) < os.path.getmtime(fastq_file):
+            build_fastq_index(fastq_file, index_file)
+        found = extract_reads_indexed(fastq_file, index_file, read_ids, output)
+    else:
+        found = extract_reads_streaming(fastq_file, read_ids, output)
+    check_found(read_ids, found)
+
+
 def main():
     arguments = docopt(__doc__)
     trns_file = arguments["--trns_file"]
     fastq_file = arguments["--fastq_file"]
     output_file = arguments["--output_file"]
-
-    fastq_dict = load_fastq_to_dict(fastq_file)
-    output_fastq = []
-
-    with open(trns_file) as file:
-        for line in file:
-            read_id = trns_line_to_read_id(line)
-            read = fastq_dict.get(read_id)
-            if read:
-                output_fastq.append(read)
-            else:
-                raise ValueError("Read not found")
+    index_file = arguments["--index"]
 
     if output_file:
-        with open(output_file, "w") as output:
-            output.write("\n".join(output_fastq))
+        # The reads are written to a temporary file which replaces the output
+        # file once all of them were found, so no partial output is left
+        temporary_file = f"{output_file}.tmp"
+        try:
+            with mh.stage("extract"):
+                with open(temporary_file, "w") as output:
+                    extract_reads(trns_file, fastq_file, output, index_file=index_file)
+            os.replace(temporary_file, output_file)
+        finally:
+            if os.path.exists(temporary_file):
+                os.remove(temporary_file)
+        # Metrics are only written next to an output file, not mixed into stdout
+        mh.write_metrics(output_file)
     else:
-        print("\n".join(output_fastq))
+        extract_reads(trns_file, fastq_file, sys.stdout, index_file=index_file)
 
 
 if __name__ == "__main__":
-    main()
+    mh.run_main(main)
@@ -83,6 +83,8 @@ include { mergeCountTables as mergeAllCountTables } from './modules/differential
 include { deduplicateAnnotations } from './modules/annotate_interactions.nf'
 // generate circos plots
 include { makeCircosTable_deseq2; makeCircosTable_count_table; runCircos_single; runCircos_comb } from './modules/data_visualization.nf'
+// aggregate the metrics of the scripts
+include { aggregateMetrics } from './modules/reports_generation.nf'
 workflow {
     if ( params.help ) {
         println("""
@@ -162,10 +164,11 @@ workflow {
     segemehl_mapping( preprocessing.out[0], genomes_ch )
 
     // fill arrays with the segemehl output
-    array_ch = fillArrays(
+    fillArrays(
         segemehl_mapping.out[0]
         .map( it -> [ it[0], it[1], it[5], it[6] ] )        // sample name, trns file, group name, genome
     )
+    array_ch = fillArrays.out.arrays
 
     // plot heatmaps using the filled arrays
     plotHeatmapsRaw( 
@@ -180,7 +183,8 @@ workflow {
         .map( it -> [ it[2], it[3][0], it[4].flatten()] )   // group name, genome, arrays
     
     // merge arrays with the same group name
-    merged_arrays_ch = mergeArrays( groupped_arrays_ch )
+    mergeArrays( groupped_arrays_ch )
+    merged_arrays_ch = mergeArrays.out.arrays
 
     // plot heatmaps using the merged arrays
     plotHeatmapsMerged( merged_arrays_ch )
@@ -195,9 +199,10 @@ workflow {
             .combine( Channel.fromPath( params.annotation_table, checkIfExists: true ) )
     } else {
         // Annotate interactions de novo
-        annotated_arrays_ch = annotateArrays( 
+        annotateArrays( 
             merged_arrays_ch 
             )
+        annotated_arrays_ch = annotateArrays.out.annotations
         // collect annotations from the annotated_arrays_ch channel and merge them
         mergeAnnotations(
             annotated_arrays_ch
@@ -206,7 +211,7 @@ workflow {
         //
         annotated_trns_ch = segemehl_mapping.out[0]
             .map( it -> [ it[0], it[1], it[5] ] ) // sample name, trns file, group name
-            .combine( mergeAnnotations.out )
+            .combine( mergeAnnotations.out.annotations )
     }
 
     // Plot the annotations on the heatmaps
@@ -216,20 +221,23 @@ workflow {
 
     // Generate count tables
     annotated_trns_ch
-    count_tables_ch = generateCountTables( annotated_trns_ch )
-    merged_count_tables_ch = mergeCountTables(
+    generateCountTables( annotated_trns_ch )
+    count_tables_ch = generateCountTables.out.count_table
+    mergeCountTables(
         count_tables_ch
             .groupTuple( by: 2 )
             .map( it -> [ it[2], it[1] ] ) // group name, count tables
     )
+    merged_count_tables_ch = mergeCountTables.out.count_table
 
     // Merge all count tables independently of the group by collecting all count tables
-    merged_count_tables_all_ch = mergeAllCountTables(
+    mergeAllCountTables(
         count_tables_ch
             .map( it -> [ it[1] ] ) // count tables
             .collect()
             .map( it -> [ "all", it ] ) // group name, count tables
     )
+    merged_count_tables_all_ch = mergeAllCountTables.out.count_table
 
     if ( params.annotation_table ) {
         // Plot annotations on the heatmaps
@@ -238,7 +246,7 @@ workflow {
     } else {
         // Deduplicate annotations
         deduplicate_annotations_input_ch = merged_count_tables_all_ch // group_name, merged_count_table
-                .combine( mergeAnnotations.out ) // merged_annotations
+                .combine( mergeAnnotations.out.annotations ) // merged_annotations
                 .map( it -> [ it[0], it[2], it[1] ] ) // group name, count table, annotations
         deduplicate_annotations_input_ch
         deduplicateAnnotations( deduplicate_annotations_input_ch )
@@ -246,7 +254,7 @@ workflow {
         // Plot deduplicated annotations on the heatmaps
         dedup_heatmaps_ch = annotated_arrays_ch
             .map( it -> [ it[0], it[1], it[2], it[3] ] ) // sample name, genome, array, annotations
-            .combine( deduplicateAnnotations.out )
+            .combine( deduplicateAnnotations.out.annotations )
         dedup_heatmaps_ch
         plotHeatmapsAnnotatedDedup( dedup_heatmaps_ch )
     }
@@ -285,11 +293,11 @@ workflow {
                         .map( it -> [ it[1], it[0], it[3], it[2] ] )
                         .combine( genomes_ch, by: 0 )
                         .map( it -> [ it[1], it[2], it[0], it[4], it[3] ] )
-                        .combine( deduplicateAnnotations.out )
+                        .combine( deduplicateAnnotations.out.annotations )
         circos_count_table_ch = merged_count_tables_ch
                         .combine( genomes_ch, by: 0 )
                         .map( it -> [ it[0], it[2], it[1] ] )
-                        .combine( deduplicateAnnotations.out )
+                        .combine( deduplicateAnnotations.out.annotations )
     }
     circos_deseq2_ch
     // Create circos tables
@@ -298,6 +306,29 @@ workflow {
 
 
     // Render circos plots
-    runCircos_single( makeCircosTable_count_table.out )
-    runCircos_comb( makeCircosTable_deseq2.out )
+    runCircos_single( makeCircosTable_count_table.out.circos )
+    runCircos_comb( makeCircosTable_deseq2.out.circos )
+
+    // Aggregate the timing and memory metrics of the scripts into one table
+    metrics_ch = fillArrays.out.metrics
+        .mix(
+            mergeArrays.out.metrics,
+            plotHeatmapsRaw.out.metrics,
+            plotHeatmapsMerged.out.metrics,
+            plotHeatmapsAnnotated.out.metrics,
+            plotHeatmapsAnnotatedDedup.out.metrics,
+            generateCountTables.out.metrics,
+            mergeCountTables.out.metrics,
+            mergeAllCountTables.out.metrics,
+            makeCircosTable_count_table.out.metrics,
+            makeCircosTable_deseq2.out.metrics
+        )
+    if ( !params.annotation_table ) {
+        metrics_ch = metrics_ch.mix(
+            annotateArrays.out.metrics,
+            mergeAnnotations.out.metrics,
+            deduplicateAnnotations.out.metrics
+        )
+    }
+    aggregateMetrics( metrics_ch.collect() )
 }
\ No newline at end of file
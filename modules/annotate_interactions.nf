@@ -8,7 +8,8 @@ process annotateArrays {
     tuple val(sample_name), path(genome), path(sample_arrays)
 
     output:
-    tuple val(sample_name), path(genome), path(sample_arrays), path("${sample_name}_annotations/${sample_name}_annotations.csv"), path("${sample_name}_annotations/${sample_name}_annotations_gmms.pickle")
+    tuple val(sample_name), path(genome), path(sample_arrays), path("${sample_name}_annotations/${sample_name}_annotations.csv"), path("${sample_name}_annotations/${sample_name}_annotations_gmms.pickle"), emit: annotations
+    path("${sample_name}_annotations/*.metrics.json"), emit: metrics
 
     publishDir "${params.output}/06-annotations", mode: 'copy'
 
@@ -29,7 +30,8 @@ process mergeAnnotations {
     path(annotations)
 
     output:
-    path("merged_annotations.tsv")
+    path("merged_annotations.tsv"), emit: annotations
+    path("merged_annotations.metrics.json"), emit: metrics
 
     publishDir "${params.output}/06-annotations" , mode: 'copy'
 
@@ -50,7 +52,8 @@ process deduplicateAnnotations {
     tuple val(group), path(annotation_table), path(count_table)
 
     output:
-    tuple val(group), path("deduplicated_annotations/annotation_table_deduplicated.tsv"), path("deduplicated_annotations/count_table_deduplicated.tsv")
+    tuple val(group), path("deduplicated_annotations/annotation_table_deduplicated.tsv"), path("deduplicated_annotations/count_table_deduplicated.tsv"), emit: annotations
+    path("deduplicated_annotations/*.metrics.json"), emit: metrics
 
     publishDir "${params.output}/06-annotations" , mode: 'copy'
 
@@ -9,7 +9,8 @@ process plotHeatmaps {
     tuple val(sample_name), path(genome), path(arrays)
 
     output:
-    tuple val(sample_name), path("${sample_name}_heatmaps")
+    tuple val(sample_name), path("${sample_name}_heatmaps"), emit: heatmaps
+    path("${sample_name}_heatmaps/*.metrics.json"), emit: metrics
 
     publishDir "${params.output}/05-stats_and_plots/heatmaps", mode: 'copy'
 
@@ -17,7 +18,7 @@ process plotHeatmaps {
     """
     mkdir tmp
     mkdir ${sample_name}_heatmaps
-    plot_heatmaps.py -d ${arrays} -g ${genome} -o ${sample_name}_heatmaps
+    plot_heatmaps.py -d ${arrays} -g ${genome} -o ${sample_name}_heatmaps --threads ${task.cpus}
     """
 }
 
@@ -32,14 +33,15 @@ process plotHeatmapsAnnotated {
     tuple val(sample_name), path(genome), path(arrays), path(annotation_table)
 
     output:
-    tuple val(sample_name), path("${sample_name}_heatmaps")
+    tuple val(sample_name), path("${sample_name}_heatmaps"), emit: heatmaps
+    path("${sample_name}_heatmaps/*.metrics.json"), emit: metrics
 
     publishDir "${params.output}/05-stats_and_plots/heatmaps_annotated", mode: 'copy'
 
     script:
     """
     mkdir ${sample_name}_heatmaps
-    plot_heatmaps.py -d ${arrays} -g ${genome} -a ${annotation_table} -o ${sample_name}_heatmaps
+    plot_heatmaps.py -d ${arrays} -g ${genome} -a ${annotation_table} -o ${sample_name}_heatmaps --threads ${task.cpus}
     """
 }
 
@@ -53,7 +55,8 @@ process makeCircosTable_count_table {
     tuple val(genome_name), path(genome), path(genome_count_table), val(group_name), path(annotation_table), path(global_count_table)
 
     output:
-    tuple val(genome_name), path("${genome_name}_circos")
+    tuple val(genome_name), path("${genome_name}_circos"), emit: circos
+    path("${genome_name}_circos/*.metrics.json"), emit: metrics
 
     script:
     """
@@ -71,7 +74,8 @@ process makeCircosTable_deseq2 {
     tuple val(genome_name_01), path(genome_01), val(genome_name_02), path(genome_02), path(results_DESeq2), val(group_name), path(annotation_table), path(global_count_table)
 
     output:
-    tuple val(genome_name_01), val(genome_name_02), path("${genome_name_01}_${genome_name_02}_circos")
+    tuple val(genome_name_01), val(genome_name_02), path("${genome_name_01}_${genome_name_02}_circos"), emit: circos
+    path("${genome_name_01}_${genome_name_02}_circos/*.metrics.json"), emit: metrics
 
     script:
     // It would be important to check if the genomes are of the same size
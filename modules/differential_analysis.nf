@@ -9,7 +9,8 @@ process generateCountTables {
     tuple val(sample_name), path(trns_file), val(group_name), path(annotation_table)
 
     output:
-    tuple val(sample_name), path("${sample_name}_count_table.tsv"), val(group_name)
+    tuple val(sample_name), path("${sample_name}_count_table.tsv"), val(group_name), emit: count_table
+    path("${sample_name}_count_table.metrics.json"), emit: metrics
 
     publishDir "${params.output}/07-count_analysis/count_tables", mode: 'copy'
 
@@ -30,7 +31,8 @@ process mergeCountTables {
     tuple val(group_name), path(count_tables)
     
     output:
-    tuple val(group_name), path("${group_name}_count_table.tsv")
+    tuple val(group_name), path("${group_name}_count_table.tsv"), emit: count_table
+    path("${group_name}_count_table.metrics.json"), emit: metrics
 
     publishDir "${params.output}/07-count_analysis/count_tables", mode: 'copy'
 
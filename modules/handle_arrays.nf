@@ -9,14 +9,15 @@ process fillArrays {
     tuple val(sample_name), path(trns_files), val(group_name), path(genome)
 
     output:
-    tuple val(sample_name), path(trns_files), val(group_name), path(genome), path("${sample_name}_arrays")
+    tuple val(sample_name), path(trns_files), val(group_name), path(genome), path("${sample_name}_arrays"), emit: arrays
+    path("${sample_name}_arrays/*.metrics.json"), emit: metrics
 
     publishDir "${params.output}/03-arrays", mode: 'copy'
 
     script:
     """
     mkdir ${sample_name}_arrays
-    fill_arrays.py ${trns_files} -g ${genome} -o ${sample_name}_arrays
+    fill_arrays.py ${trns_files} -g ${genome} -o ${sample_name}_arrays ${task.memory ? "--memory ${task.memory.toBytes()}" : ""}
     echo ${sample_name}_arrayss
     """
 }
@@ -32,7 +33,8 @@ process mergeArrays {
     tuple val(group_name), path(genome), path(arrays)
 
     output:
-    tuple val(group_name), path(genome), path("${group_name}_merged_arrays")
+    tuple val(group_name), path(genome), path("${group_name}_merged_arrays"), emit: arrays
+    path("${group_name}_merged_arrays/*.metrics.json"), emit: metrics
 
     publishDir "${params.output}/04-merged-arrays", mode: 'copy'
 
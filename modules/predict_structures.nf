@@ -2,10 +2,21 @@
 * annotation table to fasta
 **************************************************************************/
 process annotationTableToFasta {
-    label: "RNAswarm_small"
+    label 'RNAswarm_small'
 
     input:
-    tuple
+    tuple val(group), path(genome), path(annotation_table)
+
+    output:
+    tuple val(group), path(genome), path(annotation_table), path("${group}_viennaRNA_input/*.fasta")
+
+    publishDir "${params.output}/09-structures", mode: 'copy'
+
+    script:
+    """
+    mkdir ${group}_viennaRNA_input
+    annotation_table_to_viennaRNA_input.py -g ${genome} -a ${annotation_table} -o ${group}_viennaRNA_input
+    """
 }
 
 
@@ -13,10 +24,37 @@ process annotationTableToFasta {
 * predict RNA-RNA structures
 **************************************************************************/
 process runRNAcofold {
-    label: "viennarna"
+    label 'viennarna'
 
     input:
-    tuple 
+    tuple val(group), path(genome), path(annotation_table), path(fasta_files)
+
+    output:
+    tuple val(group), path("${group}_structures.tsv")
+
+    publishDir "${params.output}/09-structures", mode: 'copy'
+
+    script:
+    """
+    predict_structures.py ${fasta_files} -a ${annotation_table} -o ${group}_structures.tsv --program RNAcofold --threads ${task.cpus}
+    """
+}
+
+process runRNAduplex {
+    label 'viennarna'
+
+    input:
+    tuple val(group), path(genome), path(annotation_table), path(fasta_files)
+
+    output:
+    tuple val(group), path("${group}_structures.tsv")
+
+    publishDir "${params.output}/09-structures", mode: 'copy'
+
+    script:
+    """
+    predict_structures.py ${fasta_files} -a ${annotation_table} -o ${group}_structures.tsv --program RNAduplex --threads ${task.cpus}
+    """
 }
 
 // import os
@@ -160,4 +160,26 @@ process runMultiQC {
   """
   multiqc -d .
   """
-}
\ No newline at end of file
+}
+
+/*************************************************************************
+* Aggregate the timing and memory metrics of the scripts
+*************************************************************************/
+
+process aggregateMetrics {
+  label 'RNAswarm_small'
+
+  input:
+  // The scripts name their metrics alike, each file is staged in its own folder
+  path(metrics_files, stageAs: "metrics*/*")
+
+  output:
+  path("metrics.tsv")
+
+  publishDir "${params.output}/04-stats_and_plots", mode: 'copy'
+
+  script:
+  """
+  aggregate_metrics.py ${metrics_files} -o metrics.tsv
+  """
+}
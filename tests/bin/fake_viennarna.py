@@ -0,0 +1,40 @@
+#!/usr/bin/env python3
+
+"""Stand-in for RNAduplex and RNAcofold (with --noPS) in the tests.
+
+Reads the fasta records of a batch from stdin and prints a prediction per
+record in the output format of the program: every base unpaired and an
+energy of minus a tenth of the total length. If FAKE_VIENNARNA_LOG is set,
+the number of records of each call is appended to it.
+"""
+
+import os
+import sys
+
+
+def main():
+    cofold = "--noPS" in sys.argv[1:]
+    lines = [line.strip() for line in sys.stdin if line.strip()]
+    records = []
+    if cofold:
+        for header, sequence in zip(lines[0::2], lines[1::2]):
+            records.append((header, *sequence.split("&")))
+    else:
+        records = list(zip(lines[0::3], lines[1::3], lines[2::3]))
+    for header, sequence01, sequence02 in records:
+        structure = f"{'.' * len(sequence01)}&{'.' * len(sequence02)}"
+        energy = -(len(sequence01) + len(sequence02)) / 10
+        print(header)
+        if cofold:
+            print(f"{sequence01}&{sequence02}")
+            print(f"{structure} ({energy:6.2f})")
+        else:
+            print(f"{structure}   1,{len(sequence01)}  :   1,{len(sequence02)}   ({energy:.2f})")
+    log_file = os.environ.get("FAKE_VIENNARNA_LOG")
+    if log_file:
+        with open(log_file, "a") as log:
+            log.write(f"{len(records)}\n")
+
+
+if __name__ == "__main__":
+    main()
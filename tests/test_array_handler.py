@@ -0,0 +1,32 @@
+import os
+import sys
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+
+import array_handler as ah  # noqa: E402
+
+
+def test_save_combination_arrays_moves_temporary_memmaps(tmp_path):
+    temporary_folder = tmp_path / "temporary"
+    kept_folder = tmp_path / "kept"
+    output_folder = tmp_path / "output"
+    for folder in (temporary_folder, kept_folder, output_folder):
+        folder.mkdir()
+    temporary_array = np.lib.format.open_memmap(temporary_folder / "a-b.npy", mode="w+", dtype=np.float64, shape=(3, 4))
+    temporary_array[1, 2] = 5
+    np.save(kept_folder / "a-c.npy", np.full((3, 2), 2.0))
+    kept_array = np.load(kept_folder / "a-c.npy", mmap_mode="r")
+
+    ah.save_combination_arrays(
+        {("a", "b"): temporary_array, ("a", "c"): kept_array, ("b", "c"): np.eye(4, 2)},
+        output_folder,
+        temporary_folder=temporary_folder,
+    )
+
+    assert not (temporary_folder / "a-b.npy").exists()
+    assert (kept_folder / "a-c.npy").exists()
+    assert np.load(output_folder / "a-b.npy")[1, 2] == 5
+    np.testing.assert_array_equal(np.load(output_folder / "a-c.npy"), np.full((3, 2), 2.0))
+    np.testing.assert_array_equal(np.load(output_folder / "b-c.npy"), np.eye(4, 2))
@@ -0,0 +1,39 @@
+import os
+import subprocess
+import sys
+
+import pandas as pd
+
+BIN_DIR = os.path.join(os.path.dirname(__file__), "..", "bin")
+
+
+def write_count_table(count_table, columns):
+    pd.DataFrame(columns, index=pd.Index(["a", "b"], name="id")).to_csv(count_table, sep="\t")
+
+
+def run_merge_counttable(tmp_path, *count_tables):
+    return subprocess.run(
+        [sys.executable, os.path.join(BIN_DIR, "merge_counttable.py"), *count_tables, "-o", str(tmp_path / "merged.tsv")],
+        capture_output=True,
+        text=True,
+    )
+
+
+def test_merge_counttable(tmp_path):
+    write_count_table(tmp_path / "sample1.tsv", {"sample1": [1, 2]})
+    write_count_table(tmp_path / "sample2.tsv", {"sample2": [3, 4], "sample3": [5, 6]})
+
+    assert run_merge_counttable(tmp_path, str(tmp_path / "sample1.tsv"), str(tmp_path / "sample2.tsv")).returncode == 0
+    merged = pd.read_csv(tmp_path / "merged.tsv", sep="\t", index_col=0)
+    assert merged.columns.tolist() == ["sample1", "sample2", "sample3"]
+    assert merged.loc["b"].tolist() == [2, 4, 6]
+
+
+def test_merge_counttable_duplicate_columns(tmp_path):
+    write_count_table(tmp_path / "sample1.tsv", {"sample1": [1, 2]})
+    write_count_table(tmp_path / "sample1_again.tsv", {"sample1": [3, 4]})
+
+    result = run_merge_counttable(tmp_path, str(tmp_path / "sample1.tsv"), str(tmp_path / "sample1_again.tsv"))
+    assert result.returncode != 0
+    assert "The count tables share the columns sample1." in result.stderr
+    assert not (tmp_path / "merged.tsv").exists()
@@ -0,0 +1,49 @@
+import os
+import sys
+
+import numpy as np
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+
+import parse_peaks as pp  # noqa: E402
+
+
+def make_annotation_table(segment01, segment02, start01, end01, start02, end02):
+    return pd.DataFrame(
+        {
+            "segment01": [segment01],
+            "segment02": [segment02],
+            "start01": [start01],
+            "end01": [end01],
+            "start02": [start02],
+            "end02": [end02],
+        }
+    )
+
+
+def test_get_peak_cells_region_clipped_at_array_edge():
+    array = np.zeros((10, 8))
+    array[9, 7] = 5
+    combination_arrays = [{("a", "b"): array}]
+
+    peaks = pp.get_peak_cells(combination_arrays, make_annotation_table("a", "b", 5, 12, 4, 20))
+    assert peaks.loc[0, "segment01_peak"] == 9
+    assert peaks.loc[0, "segment02_peak"] == 7
+    assert peaks.loc[0, "value_peak"] == 5
+
+    # The same region given for the reversed segment combination
+    peaks = pp.get_peak_cells(combination_arrays, make_annotation_table("b", "a", 4, 20, 5, 12))
+    assert peaks.loc[0, "segment01_peak"] == 7
+    assert peaks.loc[0, "segment02_peak"] == 9
+
+
+def test_get_peak_cells_region_with_negative_start():
+    array = np.zeros((10, 8))
+    array[1, 2] = 3
+    combination_arrays = [{("a", "b"): array}]
+
+    peaks = pp.get_peak_cells(combination_arrays, make_annotation_table("a", "b", -4, 3, -2, 5))
+    assert peaks.loc[0, "segment01_peak"] == 1
+    assert peaks.loc[0, "segment02_peak"] == 2
+    assert peaks.loc[0, "value_peak"] == 3
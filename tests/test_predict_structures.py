@@ -0,0 +1,79 @@
+import json
+import os
+import subprocess
+import sys
+
+import pandas as pd
+import pytest
+
+BIN_DIR = os.path.join(os.path.dirname(__file__), "..", "bin")
+FAKE_VIENNARNA = os.path.join(os.path.dirname(__file__), "bin", "fake_viennarna.py")
+
+SEQUENCES = [("ACGUACGU", "GGCC"), ("AAAAA", "UUUUUU"), ("ACGUACGU", "GGCC")]
+EXTENDED_SEQUENCES = [("GACGUACGUG", "AGGCCA"), ("GAAAAAG", "AUUUUUUA"), ("GACGUACGUG", "AGGCCA")]
+
+
+def write_fasta(fasta_file, sequence_pairs):
+    with open(fasta_file, "w") as fasta:
+        for index, (sequence01, sequence02) in enumerate(sequence_pairs):
+            fasta.write(f">{index}\n{sequence01}\n{sequence02}\n")
+
+
+def run_predict_structures(tmp_path, program):
+    command = [
+        sys.executable,
+        os.path.join(BIN_DIR, "predict_structures.py"),
+        str(tmp_path / "genome_annotations.fasta"),
+        str(tmp_path / "genome_annotations_extended_1.fasta"),
+        "-a", str(tmp_path / "annotations.tsv"),
+        "-o", str(tmp_path / "output" / "annotations_structures.tsv"),
+        f"--program={program}",
+        f"--binary={FAKE_VIENNARNA}",
+        "--threads=2",
+        "--batch_size=1",
+        f"--cache={tmp_path / 'cache.json'}",
+    ]
+    env = dict(os.environ, FAKE_VIENNARNA_LOG=str(tmp_path / "calls.log"))
+    subprocess.run(command, check=True, env=env)
+    with open(tmp_path / "output" / "annotations_structures.metrics.json") as metrics:
+        counts = {stage["name"]: stage.get("counts", {}) for stage in json.load(metrics)["stages"]}
+    with open(tmp_path / "calls.log") as log:
+        calls = [int(line) for line in log]
+    return pd.read_csv(tmp_path / "output" / "annotations_structures.tsv", sep="\t"), counts["predict"], calls
+
+
+@pytest.mark.parametrize("program", ["RNAduplex", "RNAcofold"])
+def test_predict_structures_with_cache(tmp_path, program):
+    pd.DataFrame(
+        {
+            "id": ["a", "b", "c"],
+            "segment01": ["PB1", "PB2", "PB1"],
+            "start01": [1, 11, 1],
+            "end01": [8, 15, 8],
+            "segment02": ["PA", "NP", "PA"],
+            "start02": [21, 31, 21],
+            "end02": [24, 36, 24],
+        }
+    ).to_csv(tmp_path / "annotations.tsv", sep="\t", index=False)
+    write_fasta(tmp_path / "genome_annotations.fasta", SEQUENCES)
+    write_fasta(tmp_path / "genome_annotations_extended_1.fasta", EXTENDED_SEQUENCES)
+
+    table, counts, calls = run_predict_structures(tmp_path, program)
+    # Four distinct sequence pairs, one per batch, the repeated ones predicted once
+    assert calls == [1, 1, 1, 1]
+    assert counts == {"sequence_pairs": 4, "cached_sequence_pairs": 0}
+    assert table["id"].tolist() == ["a", "b", "c"]
+    assert table["structure"].tolist() == ["........&....", ".....&......", "........&...."]
+    assert table["energy"].tolist() == [-1.2, -1.1, -1.2]
+    assert table["structure_extended_1"].tolist() == [
+        "..........&......",
+        ".......&........",
+        "..........&......",
+    ]
+    assert table["energy_extended_1"].tolist() == [-1.6, -1.5, -1.6]
+
+    # A second run takes every prediction from the cache
+    cached_table, counts, calls = run_predict_structures(tmp_path, program)
+    assert calls == [1, 1, 1, 1]
+    assert counts == {"sequence_pairs": 0, "cached_sequence_pairs": 4}
+    pd.testing.assert_frame_equal(cached_table, table)
@@ -0,0 +1,48 @@
+import os
+import sys
+
+import numpy as np
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "bin"))
+
+import trns_handler as th  # noqa: E402
+
+TRNS_FILE = os.path.join(os.path.dirname(__file__), "data", "segemehl.trns.txt")
+ENGINES = ["c", pytest.param("pyarrow", marks=pytest.mark.skipif(th.get_csv_engine() != "pyarrow", reason="pyarrow is not installed"))]
+
+
+def fail_line_by_line(block):
+    raise AssertionError("the block was parsed line by line")
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_parse_trns_block_seven_field_arms(engine, monkeypatch):
+    monkeypatch.setattr(th, "__parse_trns_lines", fail_line_by_line)
+    with open(TRNS_FILE, "rb") as file:
+        segments, codes, positions = th.parse_trns_block(file.read(), engine)
+
+    assert [[segments[code] for code in line] for line in codes.tolist()] == [
+        ["SC35M_PB1", "SC35M_PB2"],
+        ["SC35M_PB2", "SC35M_PB2"],
+        ["SC35M_PA", "SC35M_PB1"],
+    ]
+    assert positions.tolist() == [
+        [1882, 1916, 1591, 1622],
+        [6, 49, 901, 924],
+        [1974, 2013, 313, 334],
+    ]
+
+
+@pytest.mark.parametrize("engine", ENGINES)
+def test_read_trns_seven_field_arms(engine, monkeypatch):
+    monkeypatch.setattr(th, "__parse_trns_lines", fail_line_by_line)
+    blocks = list(th.read_trns(TRNS_FILE, block_size=64, engine=engine, threads=2))
+
+    segments = blocks[-1][0]
+    interactions = np.concatenate([interactions for _, interactions in blocks])
+    assert list(th.iterate_interactions(interactions, segments)) == [
+        ["SC35M_PB1", 1882, 1916, "SC35M_PB2", 1591, 1622],
+        ["SC35M_PB2", 6, 49, "SC35M_PB2", 901, 924],
+        ["SC35M_PA", 1974, 2013, "SC35M_PB1", 313, 334],
+    ]
@@ -0,0 +1,72 @@
+import io
+import os
+import subprocess
+import sys
+
+import pytest
+
+BIN_DIR = os.path.join(os.path.dirname(__file__), "..", "bin")
+sys.path.insert(0, BIN_DIR)
+
+import trns_parser as tp  # noqa: E402
+
+FASTQ = (
+    "@read1 1:N:0\nACGT\n+read1 1:N:0\nIIII\n"
+    "@read2 1:N:0\nGGCCA\n+\nIIIII\n"
+    "@read3 1:N:0\nUUAA\n+read3\nJJJJ\n"
+)
+
+
+def write_trns(trns_file, read_ids):
+    with open(trns_file, "w") as trns:
+        for read_id in read_ids:
+            trns.write(f"PB1,10,+,1,20,0,40\tPA,50,+,21,20,0,40\t{read_id}\t0\n")
+
+
+def run_trns_parser(*arguments):
+    return subprocess.run(
+        [sys.executable, os.path.join(BIN_DIR, "trns_parser.py"), *arguments],
+        capture_output=True,
+        text=True,
+    )
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_extract_reads_identical_records(tmp_path, indexed):
+    (tmp_path / "reads.fastq").write_text(FASTQ)
+    write_trns(tmp_path / "reads.trns", ["read3", "read1", "read3"])
+    arguments = ["-t", str(tmp_path / "reads.trns"), "-f", str(tmp_path / "reads.fastq"), "-o", str(tmp_path / "out.fastq")]
+    if indexed:
+        arguments.append(f"--index={tmp_path / 'reads.fastq.idx'}")
+
+    assert run_trns_parser(*arguments).returncode == 0
+    assert (tmp_path / "out.fastq").read_text() == (
+        "@read1 1:N:0\nACGT\n+\nIIII\n"
+        "@read3 1:N:0\nUUAA\n+\nJJJJ\n"
+        "@read3 1:N:0\nUUAA\n+\nJJJJ\n"
+    )
+
+
+@pytest.mark.parametrize("indexed", [False, True])
+def test_extract_reads_missing_read_leaves_no_output(tmp_path, indexed):
+    (tmp_path / "reads.fastq").write_text(FASTQ)
+    write_trns(tmp_path / "reads.trns", ["read1", "read4"])
+    arguments = ["-t", str(tmp_path / "reads.trns"), "-f", str(tmp_path / "reads.fastq"), "-o", str(tmp_path / "out.fastq")]
+    if indexed:
+        arguments.append(f"--index={tmp_path / 'reads.fastq.idx'}")
+
+    result = run_trns_parser(*arguments)
+    assert result.returncode != 0
+    assert "Read not found: read4" in result.stderr
+    assert sorted(os.listdir(tmp_path)) == sorted(["reads.fastq", "reads.trns"] + (["reads.fastq.idx"] if indexed else []))
+
+
+def test_extract_reads_indexed_checks_before_writing(tmp_path):
+    (tmp_path / "reads.fastq").write_text(FASTQ)
+    tp.build_fastq_index(str(tmp_path / "reads.fastq"), str(tmp_path / "reads.fastq.idx"))
+    output = io.StringIO()
+    with pytest.raises(ValueError, match="read4"):
+        tp.extract_reads_indexed(
+            str(tmp_path / "reads.fastq"), str(tmp_path / "reads.fastq.idx"), {"read1": 1, "read4": 1}, output
+        )
+    assert output.getvalue() == ""